@@ -22,7 +22,8 @@ sudo chown $MY_USER "${JOB_CONTROL_DIR}"
 
 
 RUNNING_FILE="${JOB_CONTROL_DIR}/RUNNING"
-echo $$ > "${RUNNING_FILE}"
+# Written then renamed, so the status checks never read it empty
+echo $$ > "${RUNNING_FILE}.tmp" && mv -f "${RUNNING_FILE}.tmp" "${RUNNING_FILE}"
 
 notify_error_and_exit() {
     description="${1}"
@@ -58,10 +59,26 @@ MAIN_CLASS="ignition.jobs.Runner"
 
 cd "${DIR}" || notify_error_and_exit "Internal script error for job ${JOB_WITH_TAG}"
 
-JAR_PATH_SRC=$(echo "${DIR}"/*assembly*.jar)
+JAR_PATH_SRC=$(readlink -f "$(echo "${DIR}"/*assembly*.jar)")
 JAR_PATH="${JOB_CONTROL_DIR}/Ignition.jar"
 
-cp ${JAR_PATH_SRC} ${JAR_PATH}
+# The jar is linked from an artifact store shared by all jobs, so link to it
+# instead of copying. A hard link keeps it alive even if the store evicts it while
+# we run, so copy it when the control dir is on another filesystem.
+ln -f "${JAR_PATH_SRC}" "${JAR_PATH}" 2> /dev/null || cp -f "${JAR_PATH_SRC}" "${JAR_PATH}"
+
+# On layered uploads the jar above has only the application classes and the
+# dependencies come in a separate jar
+DEPS_JAR_SRC="${DIR}/dependencies.jar"
+JARS_PARAM=()
+CLASSPATH_JARS="${JAR_PATH}"
+if [[ -e "${DEPS_JAR_SRC}" ]]; then
+    DEPS_JAR_SRC=$(readlink -f "${DEPS_JAR_SRC}")
+    DEPS_JAR_PATH="${JOB_CONTROL_DIR}/Dependencies.jar"
+    ln -f "${DEPS_JAR_SRC}" "${DEPS_JAR_PATH}" 2> /dev/null || cp -f "${DEPS_JAR_SRC}" "${DEPS_JAR_PATH}"
+    JARS_PARAM=(--jars "${DEPS_JAR_PATH}")
+    CLASSPATH_JARS="${JAR_PATH},${DEPS_JAR_PATH}"
+fi
 
 export JOB_MASTER=${MASTER}
 
@@ -75,12 +92,12 @@ fi
 
 
 if [[ "${JOB_NAME}" == "shell" ]]; then
-    export ADD_JARS=${JAR_PATH}
+    export ADD_JARS=${CLASSPATH_JARS}
     sudo -E ${SPARK_HOME}/bin/spark-shell || notify_error_and_exit "Execution failed for shell"
 else
     JOB_OUTPUT="${JOB_CONTROL_DIR}/output.log"
     tail -F "${JOB_OUTPUT}" &
-    sudo -E "${SPARK_HOME}/bin/spark-submit" --master "${JOB_MASTER}" --driver-memory 25000M --driver-java-options "-Djava.io.tmpdir=/mnt -verbose:gc -XX:-PrintGCDetails -XX:+PrintGCTimeStamps" --class "${MAIN_CLASS}" ${JAR_PATH} "${JOB_NAME}" --runner-date "${JOB_DATE}" --runner-tag "${JOB_TAG}" --runner-user "${JOB_USER}" --runner-master "${JOB_MASTER}" --runner-executor-memory "${SPARK_MEM_PARAM}" >& "${JOB_OUTPUT}" || notify_error_and_exit "Execution failed for job ${JOB_WITH_TAG}"
+    sudo -E "${SPARK_HOME}/bin/spark-submit" --master "${JOB_MASTER}" --driver-memory 25000M --driver-java-options "-Djava.io.tmpdir=/mnt -verbose:gc -XX:-PrintGCDetails -XX:+PrintGCTimeStamps" "${JARS_PARAM[@]}" --class "${MAIN_CLASS}" ${JAR_PATH} "${JOB_NAME}" --runner-date "${JOB_DATE}" --runner-tag "${JOB_TAG}" --runner-user "${JOB_USER}" --runner-master "${JOB_MASTER}" --runner-executor-memory "${SPARK_MEM_PARAM}" >& "${JOB_OUTPUT}" || notify_error_and_exit "Execution failed for job ${JOB_WITH_TAG}"
 fi
 
 touch "${JOB_CONTROL_DIR}/SUCCESS"
@@ -0,0 +1,88 @@
+#!/usr/bin/env python
+"""
+Compares how fast check_call_with_timeout copies the output of a chatty
+command before and after pump_output: the old code read the child's pipes one
+byte at a time, with a select call per byte, and slept 0.5 s between rounds.
+
+The command writes --megabytes of zeros to stdout, copied into /dev/null, and
+a short 'echo; sleep 0.05' measures the latency a quick command pays.
+
+    python benchmarks/check_call_output.py --megabytes 20
+"""
+import argparse
+import os
+import select
+import subprocess
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+
+from utils import check_call_with_timeout
+
+
+def read_non_blocking(f):
+    result = []
+    while select.select([f], [], [], 0)[0]:
+        c = f.read(1)
+        if c:
+            result.append(c)
+        else:
+            break
+    return ''.join(result) if result else None
+
+
+def read_from_to(_from, to):
+    data = read_non_blocking(_from)
+    read_data = False
+    while data is not None:
+        read_data = True
+        to.write(data)
+        data = read_non_blocking(_from)
+    to.flush()
+    return read_data
+
+
+def check_call_before(args, stdout=None, stderr=None, shell=False):
+    # The loop before pump_output, without the timeouts, which never fire here
+    p = subprocess.Popen(args, stdout=subprocess.PIPE, stderr=subprocess.PIPE, shell=shell)
+    while True:
+        read_from_to(p.stdout, stdout)
+        read_from_to(p.stderr, stderr)
+        if p.poll() is not None:
+            break
+        time.sleep(0.5)
+    read_from_to(p.stdout, stdout)
+    read_from_to(p.stderr, stderr)
+    if p.returncode != 0:
+        raise subprocess.CalledProcessError(p.returncode, args)
+    return p.returncode
+
+
+def run(label, check_call, command, devnull):
+    begin_wall = time.time()
+    begin_cpu = os.times()
+    check_call(command, stdout=devnull, stderr=devnull, shell=True)
+    end_cpu = os.times()
+    elapsed = time.time() - begin_wall
+    # Our own CPU time, the child's is the same for both
+    cpu = (end_cpu[0] - begin_cpu[0]) + (end_cpu[1] - begin_cpu[1])
+    print('{0:<7} {1:>8.2f} s {2:>8.2f} s CPU'.format(label, elapsed, cpu))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--megabytes', type=int, default=20)
+    args = parser.parse_args()
+    with open(os.devnull, 'wb') as devnull:
+        print('{0} MB on stdout'.format(args.megabytes))
+        command = 'head -c {0} /dev/zero'.format(args.megabytes * 1024 * 1024)
+        run('before', check_call_before, command, devnull)
+        run('after', check_call_with_timeout, command, devnull)
+        print('echo; sleep 0.05')
+        run('before', check_call_before, 'echo; sleep 0.05', devnull)
+        run('after', check_call_with_timeout, 'echo; sleep 0.05', devnull)
+
+
+if __name__ == '__main__':
+    main()
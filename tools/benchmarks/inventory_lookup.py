@@ -0,0 +1,133 @@
+#!/usr/bin/env python
+"""
+Compares the lookup of a cluster's instances before and after filtering on
+the EC2 side: the old code described every reservation of the region and
+filtered by group in Python, the new one sends the group and state filters
+and reads only the cluster's reservations, page by page.
+
+EC2 is simulated: each call waits --latency-ms and its DescribeInstances
+response is generated and parsed with boto, so the numbers include boto's
+XML parsing of whatever the call returns.
+
+    python benchmarks/inventory_lookup.py --region-instances 2000 --cluster-instances 20
+"""
+import argparse
+import os
+import sys
+import time
+import xml.sax
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.realpath(__file__))), 'spark-ec2'))
+
+import boto.handler
+from boto.ec2.instance import Reservation
+from boto.resultset import ResultSet
+
+from spark_ec2 import get_cluster_instances
+
+INSTANCE_XML = """
+<item>
+  <instanceId>i-{id:08x}</instanceId><imageId>ami-5bb18832</imageId>
+  <instanceState><code>16</code><name>running</name></instanceState>
+  <privateDnsName>ip-10-0-{a}-{b}.ec2.internal</privateDnsName>
+  <dnsName>ec2-54-0-{a}-{b}.compute-1.amazonaws.com</dnsName>
+  <reason/><keyName>ignition_key</keyName><amiLaunchIndex>0</amiLaunchIndex>
+  <instanceType>r3.xlarge</instanceType><launchTime>2015-04-01T10:00:00.000Z</launchTime>
+  <placement><availabilityZone>us-east-1b</availabilityZone><groupName/><tenancy>default</tenancy></placement>
+  <kernelId>aki-919dcaf8</kernelId><monitoring><state>disabled</state></monitoring>
+  <privateIpAddress>10.0.{a}.{b}</privateIpAddress><ipAddress>54.0.{a}.{b}</ipAddress>
+  <groupSet><item><groupId>sg-{group:08x}</groupId><groupName>{group_name}</groupName></item></groupSet>
+  <architecture>x86_64</architecture><rootDeviceType>ebs</rootDeviceType><rootDeviceName>/dev/xvda</rootDeviceName>
+  <blockDeviceMapping><item><deviceName>/dev/xvda</deviceName>
+    <ebs><volumeId>vol-{id:08x}</volumeId><status>attached</status>
+    <attachTime>2015-04-01T10:00:05.000Z</attachTime><deleteOnTermination>true</deleteOnTermination></ebs>
+  </item></blockDeviceMapping>
+  <virtualizationType>hvm</virtualizationType><hypervisor>xen</hypervisor>
+  <tagSet>
+    <item><key>Name</key><value>{group_name}-i-{id:08x}</value></item>
+    <item><key>spark_cluster_name</key><value>{cluster}</value></item>
+    <item><key>env</key><value>prod</value></item>
+  </tagSet>
+  <ebsOptimized>false</ebsOptimized>
+</item>"""
+
+RESERVATION_XML = """
+<item><reservationId>r-{id:08x}</reservationId><ownerId>123456789012</ownerId>
+  <groupSet/><instancesSet>{instances}</instancesSet>
+</item>"""
+
+
+class FakeEC2(object):
+    """
+    Answers get_all_reservations for a region of clusters with one reservation
+    of slaves and one of a master each, honoring the group filter.
+    """
+
+    def __init__(self, num_clusters, slaves_per_cluster, latency):
+        self.latency = latency
+        self.calls = 0
+        self.bytes = 0
+        self.reservations = []
+        next_id = 1
+        for c in range(num_clusters):
+            cluster = 'cluster-{0}'.format(c)
+            for group_name, count in ((cluster + '-master', 1), (cluster + '-slaves', slaves_per_cluster)):
+                instances = []
+                for i in range(count):
+                    instances.append(INSTANCE_XML.format(id=next_id, a=next_id // 250 % 250, b=next_id % 250,
+                                                         group=c, group_name=group_name, cluster=cluster))
+                    next_id += 1
+                self.reservations.append((group_name, RESERVATION_XML.format(id=next_id,
+                                                                             instances=''.join(instances))))
+
+    def get_all_reservations(self, filters=None, max_results=None, next_token=None):
+        self.calls += 1
+        time.sleep(self.latency)
+        groups = (filters or {}).get('instance.group-name')
+        matching = [body for group_name, body in self.reservations if groups is None or group_name in groups]
+        start = int(next_token or 0)
+        end = len(matching) if max_results is None else start + max_results
+        page_token = '<nextToken>{0}</nextToken>'.format(end) if end < len(matching) else ''
+        body = ('<DescribeInstancesResponse xmlns="http://ec2.amazonaws.com/doc/2014-10-01/">'
+                '<requestId>0</requestId><reservationSet>{0}</reservationSet>{1}'
+                '</DescribeInstancesResponse>').format(''.join(matching[start:end]), page_token)
+        self.bytes += len(body)
+        rs = ResultSet([('item', Reservation)])
+        xml.sax.parseString(body, boto.handler.XmlHandler(rs, self))
+        return rs
+
+
+def lookup_before(conn, cluster_name):
+    # The code before filtering: every reservation of the region
+    return [i for res in conn.get_all_reservations() for i in res.instances
+            if i.state in ['pending', 'running', 'stopping', 'stopped'] and
+            set([cluster_name + '-master', cluster_name + '-slaves']) & set(g.name for g in i.groups)]
+
+
+def run(label, lookup, conn, repeat):
+    conn.calls = conn.bytes = 0
+    begin = time.time()
+    for _ in range(repeat):
+        instances = lookup(conn, 'cluster-0')
+    elapsed = (time.time() - begin) / repeat
+    print('{0:<7} {1:>8.1f} ms/lookup {2:>5} calls {3:>10} bytes {4:>4} instances'.format(
+        label, elapsed * 1000, conn.calls // repeat, conn.bytes // repeat, len(instances)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--region-instances', type=int, default=2000)
+    parser.add_argument('--cluster-instances', type=int, default=20)
+    parser.add_argument('--latency-ms', type=float, default=100)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+    num_clusters = max(1, args.region_instances // args.cluster_instances)
+    conn = FakeEC2(num_clusters, args.cluster_instances - 1, args.latency_ms / 1000.0)
+    print('{0} clusters of {1} instances, {2:.0f} ms per call'.format(num_clusters, args.cluster_instances,
+                                                                    args.latency_ms))
+    run('before', lookup_before, conn, args.repeat)
+    run('after', get_cluster_instances, conn, args.repeat)
+
+
+if __name__ == '__main__':
+    main()
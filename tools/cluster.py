@@ -13,16 +13,31 @@ from argh.decorators import named, arg
 import subprocess
 from subprocess import check_output, check_call
 from itertools import chain
-from utils import tag_instances, get_masters, get_active_nodes
-from utils import check_call_with_timeout, ProcessTimeoutException
+from utils import tag_instances, get_masters, get_active_nodes, invalidate_inventory
+from utils import check_call_with_timeout, ProcessTimeoutException, pump_output
+from utils import run_command, run_commands, ssh_binary
+from utils import get_ssh_options, get_ssh_control_dir, ssh_multiplexing
+from utils import get_tagged_clusters, parallel_map, destroy_clusters, get_connection
+from placement import plan_placement, format_placements
 import os
 import sys
-from datetime import datetime
+from datetime import datetime, timedelta
 import time
+import threading
 import logging
 import getpass
 import json
+import hashlib
 import glob
+import inspect
+import uuid
+import zipfile
+from collections import OrderedDict
+import select
+import signal
+from contextlib import contextmanager
+
+import spark_ec2
 
 
 log = logging.getLogger()
@@ -37,6 +52,7 @@ script_path = os.path.dirname(os.path.realpath(__file__))
 
 default_instance_type = 'r3.xlarge'
 default_spot_price = '0.10'
+default_placement_instance_types = 'r3.xlarge,r3.2xlarge,r3.4xlarge,r3.8xlarge,i2.xlarge,i2.2xlarge,d2.xlarge,d2.2xlarge'
 default_worker_instances = '1'
 default_master_instance_type = 'm3.xlarge'
 default_region = 'us-east-1'
@@ -51,9 +67,14 @@ default_spark_repo = 'https://github.com/chaordic/spark'
 default_remote_user = 'ec2-user'
 default_remote_control_dir = '/tmp/Ignition'
 default_collect_results_dir = '/tmp'
+default_remote_artifacts_dir = '/home/{0}/.ignition-artifacts'.format(default_remote_user)
+default_remote_artifacts_max_mb = 2048
 default_user_data = os.path.join(script_path, 'scripts', 'S05mount-disks')
 default_defaults_filename = 'cluster_defaults.json'
 
+default_remote_concurrency = 8
+default_remote_timeout_seconds = 300
+
 default_spark_ec2_git_repo = 'https://github.com/chaordic/spark-ec2'
 default_spark_ec2_git_branch = 'v4-yarn'
 
@@ -111,20 +132,43 @@ def logged_call(args, tries=1):
     return logged_call_base(check_call, args, tries)
 
 
-def ssh_call(user, host, key_file, args=(), allocate_terminal=True, get_output=False):
-    base = ['ssh', '-q']
+def ssh_args(user, host, key_file, args=(), allocate_terminal=True):
+    base = [ssh_binary, '-q']
     if allocate_terminal:
         base += ['-tt']
     base += ['-i', key_file,
-             '-o', 'StrictHostKeyChecking=no',
-             '{0}@{1}'.format(user, host)]
-    base += args
+             '-o', 'StrictHostKeyChecking=no']
+    base += get_ssh_options()
+    base += ['{0}@{1}'.format(user, host)]
+    return base + list(args)
+
+
+def ssh_call(user, host, key_file, args=(), allocate_terminal=True, get_output=False):
+    base = ssh_args(user, host, key_file, args=args, allocate_terminal=allocate_terminal)
     if get_output:
-        return logged_call_output(base)
+        return remote_call(base)
     else:
         return logged_call(base)
 
 
+def remote_call(args, timeout_seconds=default_remote_timeout_seconds):
+    log.debug('Calling: %s', args)
+    return run_command(args, timeout_seconds=timeout_seconds).check_returncode().output
+
+
+def ssh_run_many(user, host, key_file, commands,
+                 max_concurrency=default_remote_concurrency,
+                 timeout_seconds=default_remote_timeout_seconds):
+    """
+    Runs each command of commands on the host, concurrently, and returns
+    their CommandResult in the same order. Failures are not raised.
+    """
+    return run_commands([ssh_args(user, host, key_file, args=command, allocate_terminal=False)
+                         for command in commands],
+                        max_concurrency=max_concurrency,
+                        timeout_seconds=timeout_seconds)
+
+
 def chdir_to_ec2_script_and_get_path():
     ec2_script_base = os.path.join(script_path, 'spark-ec2')
     os.chdir(ec2_script_base)
@@ -132,12 +176,136 @@ def chdir_to_ec2_script_and_get_path():
     return ec2_script_path
 
 
+# Run spark_ec2 as a library in this process, sharing its EC2 connection and
+# skipping the interpreter startup on each try. It needs SIGALRM for the
+# timeouts, so calls from other threads still start a subprocess.
+ec2_script_in_process = os.getenv('IGNITION_EC2_IN_PROCESS', 'yes') != 'no'
+
+
+@contextmanager
+def ec2_script_timeouts(timeout_total_minutes, timeout_inactivity_minutes):
+    """
+    Raises ProcessTimeoutException in the main thread, through SIGALRM, when
+    the block runs for longer than the total timeout or writes nothing for
+    longer than the inactivity timeout. Output, including that of child
+    processes, goes through pipes to tell when it is active.
+    The script may catch the exception, so it is raised again every few
+    seconds and once more when the block ends. The ssh processes of the
+    script are killed then, as its parallel_map workers keep running.
+    """
+    spark_ec2.resume_ssh_processes()
+    start_time = time.time()
+    last_output = [start_time]
+    timed_out = []
+    sys.stdout.flush()
+    sys.stderr.flush()
+    outputs = {}
+    saved_fds = {}
+    for fd in (1, 2):
+        saved_fds[fd] = os.dup(fd)
+        read_fd, write_fd = os.pipe()
+        os.dup2(write_fd, fd)
+        os.close(write_fd)
+        outputs[read_fd] = os.fdopen(os.dup(saved_fds[fd]), 'w')
+    done = threading.Event()
+
+    def copy_output():
+        # pump_output forgets the pipes that are closed, so give it a copy
+        pending = dict(outputs)
+        while not done.is_set():
+            if pump_output(pending, timeout=0.5):
+                last_output[0] = time.time()
+        while pending and select.select(list(pending), [], [], 0)[0]:
+            pump_output(pending, timeout=0)
+
+    def set_alarm():
+        deadlines = []
+        if timeout_total_minutes > 0:
+            deadlines.append(start_time + timeout_total_minutes * 60)
+        if timeout_inactivity_minutes > 0:
+            deadlines.append(last_output[0] + timeout_inactivity_minutes * 60)
+        if deadlines:
+            signal.setitimer(signal.ITIMER_REAL, max(0.1, min(deadlines) - time.time()))
+
+    def on_alarm(signum, frame):
+        now = time.time()
+        if timeout_total_minutes > 0 and now - start_time > timeout_total_minutes * 60:
+            timed_out.append('Terminated by total timeout')
+        elif timeout_inactivity_minutes > 0 and now - last_output[0] > timeout_inactivity_minutes * 60:
+            timed_out.append('Terminated by inactivity')
+        if timed_out:
+            spark_ec2.kill_ssh_processes()
+            signal.setitimer(signal.ITIMER_REAL, 5)
+            raise ProcessTimeoutException(timed_out[0])
+        # There was output since the alarm was set
+        set_alarm()
+
+    copier = threading.Thread(target=copy_output)
+    copier.daemon = True
+    copier.start()
+    previous_handler = signal.signal(signal.SIGALRM, on_alarm)
+    set_alarm()
+    try:
+        yield
+    except BaseException:
+        if not timed_out:
+            raise
+    finally:
+        signal.setitimer(signal.ITIMER_REAL, 0)
+        signal.signal(signal.SIGALRM, previous_handler)
+        sys.stdout.flush()
+        sys.stderr.flush()
+        for fd, saved_fd in saved_fds.items():
+            os.dup2(saved_fd, fd)
+            os.close(saved_fd)
+        done.set()
+        copier.join()
+        for read_fd, output in outputs.items():
+            os.close(read_fd)
+            output.close()
+    if timed_out:
+        raise ProcessTimeoutException(timed_out[0])
+
+
+def run_ec2_script_in_process(args, timeout_total_minutes, timeout_inactivity_minutes):
+    """
+    Runs a spark_ec2 action like call_ec2_script does, failing with
+    CalledProcessError when the script would have exited with an error.
+    """
+    try:
+        with ec2_script_timeouts(timeout_total_minutes, timeout_inactivity_minutes):
+            opts, action, cluster_name = spark_ec2.parse_args(args)
+            spark_ec2.validate_opts(opts)
+            spark_ec2.run(get_connection(opts.region), opts, action, cluster_name)
+    except SystemExit as e:
+        if e.code:
+            if not isinstance(e.code, int):
+                log.error('%s', e.code)
+            raise subprocess.CalledProcessError(e.code if isinstance(e.code, int) else 1, args)
+    except (ProcessTimeoutException, KeyboardInterrupt):
+        raise
+    except Exception:
+        log.exception('EC2 script failed')
+        raise subprocess.CalledProcessError(1, args)
+    return 0
+
+
 def call_ec2_script(args, timeout_total_minutes, timeout_inactivity_minutes):
-    ec2_script_path = chdir_to_ec2_script_and_get_path()
-    return check_call_with_timeout(['/usr/bin/env', 'python', '-u',
-                                    ec2_script_path] + args,
-                                   timeout_total_minutes=timeout_total_minutes,
-                                   timeout_inactivity_minutes=timeout_inactivity_minutes)
+    # Share our SSH master connections with the script
+    control_dir_params = ['--ssh-control-dir', get_ssh_control_dir()] if ssh_multiplexing else []
+    try:
+        if ec2_script_in_process and threading.current_thread().name == 'MainThread':
+            return run_ec2_script_in_process(control_dir_params + args,
+                                             timeout_total_minutes=timeout_total_minutes,
+                                             timeout_inactivity_minutes=timeout_inactivity_minutes)
+        ec2_script_path = chdir_to_ec2_script_and_get_path()
+        return check_call_with_timeout(['/usr/bin/env', 'python', '-u',
+                                        ec2_script_path] + control_dir_params + args,
+                                       timeout_total_minutes=timeout_total_minutes,
+                                       timeout_inactivity_minutes=timeout_inactivity_minutes)
+    finally:
+        # Every action of the script may launch or terminate instances
+        invalidate_inventory()
 
 
 def cluster_exists(cluster_name, region):
@@ -160,12 +328,12 @@ def parse_tags(tag_list):
     return tags
 
 def save_cluster_args(master, key_file, remote_user, all_args):
-    ssh_call(user=remote_user, host=master, key_file=key_file,
-             args=["echo '{}' > /tmp/cluster_args.json".format(json.dumps(all_args))])
+    remote_call(ssh_args(user=remote_user, host=master, key_file=key_file, allocate_terminal=False,
+                         args=["echo '{}' > /tmp/cluster_args.json".format(json.dumps(all_args))]))
 
 def load_cluster_args(master, key_file, remote_user):
-    return json.loads(ssh_call(user=remote_user, host=master, key_file=key_file,
-                               args=["cat", "/tmp/cluster_args.json"], get_output=True))
+    return json.loads(remote_call(ssh_args(user=remote_user, host=master, key_file=key_file, allocate_terminal=False,
+                                           args=["cat", "/tmp/cluster_args.json"])))
 
 # Util to be used by external scripts
 def save_extra_data(data_str, cluster_name, region=default_region, key_file=default_key_file, remote_user=default_remote_user, master=None):
@@ -183,6 +351,60 @@ def load_extra_data(cluster_name, region=default_region, key_file=default_key_fi
 tag_help_text = 'Use multiple times, like: --tag tag1=value1 --tag tag2=value'
 
 
+def get_ec2_script_params(args):
+    """
+    Returns the spark_ec2 options for a cluster with the given launch
+    arguments, as saved by save_cluster_args.
+    """
+    params = ['--identity-file', args['key_file'],
+              '--key-pair', args['key_id'],
+              '--slaves', str(args['slaves']),
+              '--region', args['region'],
+              '--zone', args['zone'],
+              '--instance-type', args['instance_type'],
+              '--master-instance-type', args['master_instance_type'],
+              '--wait', args['wait_time'],
+              '--hadoop-major-version', args['hadoop_major_version'],
+              '--spark-ec2-git-repo', args['spark_ec2_git_repo'],
+              '--spark-ec2-git-branch', args['spark_ec2_git_branch'],
+              '--worker-instances', args['worker_instances'],
+              '--master-opts', '-Dspark.worker.timeout={0}'.format(args['worker_timeout']),
+              '--spark-git-repo', args['spark_repo'],
+              '-v', args['spark_version'],
+              '--user-data', args['user_data'],
+              '--min-healthy-slaves-fraction', str(args['minimum_percentage_healthy_slaves'])]
+
+    if not args['ondemand']:
+        params.extend(['--spot-price', args['spot_price']])
+        if args.get('allow_partial_spot_grants'):
+            params.extend(['--allow-partial-spot-grants',
+                           '--spot-partial-grace', str(args.get('spot_partial_grace_seconds', 120))])
+
+    if args['security_group']:
+        params.extend([
+            '--authorized-address', '127.0.0.1/32',
+            '--additional-security-group', args['security_group']
+        ])
+
+    # '--vpc-id', default_vpc,
+    # '--subnet-id', default_vpc_subnet,
+    if args['vpc'] and args['vpc_subnet']:
+        params.extend([
+            '--vpc-id', args['vpc'],
+            '--subnet-id', args['vpc_subnet'],
+        ])
+
+    if args['ami']:
+        params.extend(['--ami', args['ami']])
+    if args['master_ami']:
+        params.extend(['--master-ami', args['master_ami']])
+    if args.get('offline'):
+        params.append('--offline')
+    if args.get('no_baked_image'):
+        params.append('--no-baked-image')
+    return params
+
+
 @argh.arg('-t', '--tag', action='append', type=str,
           help=tag_help_text)
 @named('tag-instances')
@@ -193,15 +415,52 @@ def tag_cluster_instances(cluster_name, tag=[], env=default_env, region=default_
     tag_instances(cluster_name, tags, region=region)
 
 
+def get_placement(region, zone, instance_type, slaves, spot_price, vpc_subnet,
+                  placement_instance_types, placement_resource):
+    # A subnet lives in a single zone, so only the instance type can change
+    zones = [zone] if vpc_subnet else None
+    placements = plan_placement(region, instance_type, slaves, float(spot_price),
+                                candidate_types=placement_instance_types.split(','),
+                                zones=zones, resource=placement_resource)
+    if not placements:
+        raise CommandError('No spot placement found with a bid up to {0}'.format(spot_price))
+    log.info('Spot placement candidates:\n%s', format_placements(placements))
+    return placements[0]
+
+
+@arg('--placement-instance-types', help='Comma separated instance types considered by --plan-placement and plan-placement')
+@arg('--placement-resource', choices=['memory', 'cores'], help='Resource whose price is minimized by the placement planner')
+@named('plan-placement')
+def plan_placement_cmd(slaves, region=default_region, zone=default_zone,
+                       instance_type=default_instance_type, spot_price=default_spot_price,
+                       vpc_subnet=None,
+                       placement_instance_types=default_placement_instance_types,
+                       placement_resource='memory'):
+    placement = get_placement(region, zone, instance_type, slaves, spot_price, vpc_subnet,
+                              placement_instance_types, placement_resource)
+    return '--instance-type {0} --zone {1} --spot-price {2:.4f} {3}'.format(
+        placement.instance_type, ','.join(placement.zones), placement.bid, placement.slaves)
+
+
 @argh.arg('-t', '--tag', action='append', type=str,
           help=tag_help_text)
+@arg('--plan-placement', help='Choose the instance type, zones, spot price (up to --spot-price) and number of slaves from the spot price history')
+@arg('--placement-instance-types', help='Comma separated instance types considered by --plan-placement')
+@arg('--placement-resource', choices=['memory', 'cores'], help='Resource whose price is minimized by --plan-placement')
+@arg('--offline', help='Resolve the AMIs and the Spark version only from the local cache of spark_ec2')
+@arg('--no-baked-image', help='Use the stock Spark AMI even if an image made by bake-image matches the cluster')
+@arg('--allow-partial-spot-grants', help='Start once --minimum-percentage-healthy-slaves of the spot slaves are granted, waiting at most --spot-partial-grace-seconds for the others')
 def launch(cluster_name, slaves,
            key_file=default_key_file,
            env=default_env,
            tag=[],
            key_id=default_key_id, region=default_region,
            zone=default_zone, instance_type=default_instance_type,
-           ondemand=False, spot_price=default_spot_price,
+           ondemand=False, spot_price=default_spot_price, spot_partial_grace_seconds=120,
+           allow_partial_spot_grants=False,
+           plan_placement=False,
+           placement_instance_types=default_placement_instance_types,
+           placement_resource='memory',
            user_data=default_user_data,
            security_group = None,
            vpc = None,
@@ -219,7 +478,7 @@ def launch(cluster_name, slaves,
            spark_version=default_spark_version,
            spark_ec2_git_repo=default_spark_ec2_git_repo,
            spark_ec2_git_branch=default_spark_ec2_git_branch,
-           ami=default_ami, master_ami=default_master_ami):
+           ami=default_ami, master_ami=default_master_ami, offline=False, no_baked_image=False):
 
     all_args = locals()
 
@@ -230,55 +489,25 @@ def launch(cluster_name, slaves,
         else:
             raise CommandError('Cluster already exists, pick another name or resume the setup using --resume')
 
+    if plan_placement and not ondemand and not resume:
+        placement = get_placement(region, zone, instance_type, slaves, spot_price, vpc_subnet,
+                                  placement_instance_types, placement_resource)
+        instance_type = placement.instance_type
+        zone = ','.join(placement.zones)
+        spot_price = '{0:.4f}'.format(placement.bid)
+        slaves = str(placement.slaves)
+        log.info('Using %s slaves of %s in %s with spot price %s', slaves, instance_type, zone, spot_price)
+        all_args.update(instance_type=instance_type, zone=zone, spot_price=spot_price, slaves=slaves)
+
     for j in range(max_clusters_to_create):
         log.info('Creating new cluster {0}, try {1}'.format(cluster_name, j+1))
         success = False
         resume_param = ['--resume'] if resume else []
 
-        auth_params = []
-        if security_group:
-            auth_params.extend([
-                '--authorized-address', '127.0.0.1/32',
-                '--additional-security-group', security_group
-            ])
-
-        # '--vpc-id', default_vpc,
-        # '--subnet-id', default_vpc_subnet,
-        if vpc and vpc_subnet:
-            auth_params.extend([
-                '--vpc-id', vpc,
-                '--subnet-id', vpc_subnet,
-            ])
-
-        spot_params = ['--spot-price', spot_price] if not ondemand else []
-        ami_params = ['--ami', ami] if ami else []
-        master_ami_params = ['--master-ami', master_ami] if master_ami else []
-
         for i in range(retries_on_same_cluster):
             log.info('Running script, try %d of %d', i + 1, retries_on_same_cluster)
             try:
-                call_ec2_script(['--identity-file', key_file,
-                                 '--key-pair', key_id,
-                                 '--slaves', slaves,
-                                 '--region', region,
-                                 '--zone', zone,
-                                 '--instance-type', instance_type,
-                                 '--master-instance-type', master_instance_type,
-                                 '--wait', wait_time,
-                                 '--hadoop-major-version', hadoop_major_version,
-                                 '--spark-ec2-git-repo', spark_ec2_git_repo,
-                                 '--spark-ec2-git-branch', spark_ec2_git_branch,
-                                 '--worker-instances', worker_instances,
-                                 '--master-opts', '-Dspark.worker.timeout={0}'.format(worker_timeout),
-                                 '--spark-git-repo', spark_repo,
-                                 '-v', spark_version,
-                                 '--user-data', user_data,
-                                 'launch', cluster_name] +
-                                spot_params +
-                                resume_param +
-                                auth_params +
-                                ami_params +
-                                master_ami_params,
+                call_ec2_script(get_ec2_script_params(all_args) + ['launch', cluster_name] + resume_param,
                                 timeout_total_minutes=script_timeout_total_minutes,
                                 timeout_inactivity_minutes=script_timeout_inactivity_minutes)
                 success = True
@@ -309,17 +538,162 @@ def launch(cluster_name, slaves,
     raise CommandError('Failed to created cluster {} after failures'.format(cluster_name))
 
 
-def destroy(cluster_name, delete_groups=False, region=default_region):
-    delete_sg_param = ['--delete-groups'] if delete_groups else []
+def change_slaves(cluster_name, all_args, delta, key_file=default_key_file,
+                  drain_timeout_seconds=600, script_timeout_total_minutes=55,
+                  script_timeout_inactivity_minutes=10, region=default_region):
+    """
+    Adds delta slaves to a running cluster using its saved launch arguments,
+    or removes -delta slaves if delta is negative.
+    """
+    action = 'add-slaves' if delta > 0 else 'remove-slaves'
+    log.info('Running %s for %d slaves on cluster %s', action, abs(delta), cluster_name)
+    try:
+        call_ec2_script(get_ec2_script_params(dict(all_args, key_file=key_file, slaves=abs(delta))) +
+                        ['--drain-timeout', str(drain_timeout_seconds), action, cluster_name],
+                        timeout_total_minutes=script_timeout_total_minutes,
+                        timeout_inactivity_minutes=script_timeout_inactivity_minutes)
+    finally:
+        # The pool tags are kept only on the instances they were set on
+        tags = [t for t in all_args.get('tag', []) if not t.startswith('ignition_pool')]
+        tag_cluster_instances(cluster_name=cluster_name, tag=tags, env=all_args['env'], region=region)
+
+
+@arg('slaves', help='Number of slaves the cluster should have')
+@arg('--drain-timeout-seconds', help='How long removed slaves may keep running containers before being stopped')
+def resize(cluster_name, slaves, key_file=default_key_file, remote_user=default_remote_user,
+           drain_timeout_seconds=600, script_timeout_total_minutes=55,
+           script_timeout_inactivity_minutes=10, region=default_region):
+    """
+    Adds slaves to a running cluster, launched and set up with the arguments
+    the cluster was launched with, or drains and removes its most recently
+    launched slaves.
+    """
+    master = get_master(cluster_name, region=region)
+    all_args = load_cluster_args(master, key_file, remote_user)
+    masters, current_slaves = get_active_nodes(cluster_name, region=region)
+    delta = int(slaves) - len(current_slaves)
+    if delta == 0:
+        log.info('Cluster %s already has %d slaves', cluster_name, len(current_slaves))
+        return
+    try:
+        change_slaves(cluster_name, all_args, delta, key_file=key_file,
+                      drain_timeout_seconds=drain_timeout_seconds,
+                      script_timeout_total_minutes=script_timeout_total_minutes,
+                      script_timeout_inactivity_minutes=script_timeout_inactivity_minutes,
+                      region=region)
+    finally:
+        masters, current_slaves = get_active_nodes(cluster_name, region=region)
+        all_args['slaves'] = str(len(current_slaves))
+        save_cluster_args(master, key_file, remote_user, all_args)
+    log.info('Cluster %s now has %d slaves', cluster_name, len(current_slaves))
+
+
+def start_slave_replacement(cluster_name, key_file, master, remote_user, region):
+    """
+    Starts launching, in a background thread, replacements for the slaves
+    the cluster lost (e.g. reclaimed spot instances), with the launch
+    arguments saved on the master. Returns the thread, or None if no slave
+    is missing.
+    """
+    all_args = load_cluster_args(master, key_file, remote_user)
+    masters, slaves = get_active_nodes(cluster_name, region=region)
+    missing = int(all_args['slaves']) - len(slaves)
+    if missing <= 0:
+        return None
+    log.warn('Cluster %s lost %d of its %s slaves, launching replacements',
+             cluster_name, missing, all_args['slaves'])
+
+    def replace():
+        try:
+            change_slaves(cluster_name, all_args, missing, key_file=key_file, region=region)
+            log.info('Replacement slaves joined cluster %s', cluster_name)
+        except Exception:
+            log.exception('Failed to replace the lost slaves of cluster %s', cluster_name)
+
+    thread = threading.Thread(target=replace, name='replace-slaves-' + cluster_name)
+    thread.daemon = True
+    thread.start()
+    return thread
+
+
+def delete_cluster_groups(cluster_names, background, region):
+    """
+    Deletes the security groups of the clusters the way spark_ec2 destroy
+    does, waiting for the instances to finish terminating. In background, it
+    is left to detached delete-groups processes logging to files.
+    """
+    for cluster_name in cluster_names:
+        opts, _, _ = spark_ec2.parse_args(['--region', region, 'delete-groups', cluster_name])
+        if background:
+            spark_ec2.start_background_group_deletion(opts, cluster_name)
+            continue
+        conn = get_connection(region)
+        try:
+            spark_ec2.delete_cluster_groups(conn, opts, cluster_name,
+                                            spark_ec2.get_terminating_instances(conn, cluster_name))
+        except SystemExit:
+            raise CommandError('Failed to delete the security groups of {0}'.format(cluster_name))
+
+
+@arg('--delete-groups-in-background', help='With --delete-groups, return as soon as the instances are terminating')
+def destroy(cluster_name, delete_groups=False, delete_groups_in_background=False, region=default_region):
+    result, = destroy_clusters([cluster_name], region)
+    log.info('Terminated %d instances and cancelled %d spot requests of %s',
+             len(result.terminated_instance_ids), len(result.cancelled_spot_request_ids), cluster_name)
+    if delete_groups:
+        delete_cluster_groups([cluster_name], delete_groups_in_background, region)
+
 
-    ec2_script_path = chdir_to_ec2_script_and_get_path()
-    p = subprocess.Popen(['/usr/bin/env', 'python', '-u',
-                          ec2_script_path,
-                          'destroy', cluster_name,
-                          '--region', region] + delete_sg_param,
-                         stdin=subprocess.PIPE,
-                         stdout=sys.stdout, universal_newlines=True)
-    p.communicate('y')
+@named('destroy-many')
+@arg('--delete-groups-in-background', help='With --delete-groups, return as soon as the instances are terminating')
+def destroy_many(delete_groups=False, delete_groups_in_background=False, region=default_region, *cluster_names):
+    """
+    Destroys all the given clusters at once, printing what was terminated and
+    cancelled for each of them
+    """
+    if not cluster_names:
+        raise CommandError('Please give the clusters to destroy')
+    results = destroy_clusters(list(cluster_names), region)
+    if delete_groups:
+        delete_cluster_groups(cluster_names, delete_groups_in_background, region)
+    for result in results:
+        yield '{0}\tinstances: {1}\tspot requests: {2}'.format(
+            result.cluster_name, ','.join(result.terminated_instance_ids) or '-',
+            ','.join(result.cancelled_spot_request_ids) or '-')
+
+
+@named('bake-image')
+@arg('--image-name', help='Name of the image and of its temporary cluster (default: spark-<version>-hadoop<version>-<timestamp>)')
+@arg('--ami', help='AMI to install on (default: the stock Spark AMI of the instance type)')
+def bake_image(image_name=None, key_file=default_key_file, key_id=default_key_id,
+               instance_type=default_instance_type, region=default_region, zone=default_zone,
+               security_group=None, vpc=None, vpc_subnet=None, ami=default_ami,
+               hadoop_major_version='2', spark_repo=default_spark_repo,
+               spark_version=default_spark_version,
+               spark_ec2_git_repo=default_spark_ec2_git_repo,
+               spark_ec2_git_branch=default_spark_ec2_git_branch,
+               script_timeout_total_minutes=55, script_timeout_inactivity_minutes=10):
+    """
+    Bakes an image with the spark-ec2 modules of spark_version and
+    hadoop_major_version installed. Launches with the same versions and an
+    instance type of the same virtualization use it automatically, so the
+    cluster setup only configures the modules.
+    """
+    if not image_name:
+        image_name = 'spark-{0}-hadoop{1}-{2}'.format(spark_version, hadoop_major_version,
+                                                      datetime.utcnow().strftime('%Y%m%d%H%M%S'))
+    args = get_launch_defaults()
+    args.update(key_file=key_file, key_id=key_id, slaves=1, instance_type=instance_type,
+                region=region, zone=zone, security_group=security_group, vpc=vpc,
+                vpc_subnet=vpc_subnet, ami=ami, hadoop_major_version=hadoop_major_version,
+                spark_repo=spark_repo, spark_version=spark_version,
+                spark_ec2_git_repo=spark_ec2_git_repo, spark_ec2_git_branch=spark_ec2_git_branch,
+                ondemand=True)
+    log.info('Baking image %s', image_name)
+    call_ec2_script(get_ec2_script_params(args) + ['--delete-groups', 'bake-image', image_name],
+                    timeout_total_minutes=script_timeout_total_minutes,
+                    timeout_inactivity_minutes=script_timeout_inactivity_minutes)
+    return image_name
 
 
 def get_master(cluster_name, region=default_region):
@@ -336,71 +710,184 @@ def ssh_master(cluster_name, key_file=default_key_file, user=default_remote_user
 
 def rsync_call(user, host, key_file, args=[], src_local='', dest_local='', remote_path='', tries=3):
     rsync_args = ['rsync', '--timeout', '60', '-azvP']
-    rsync_args += ['-e', 'ssh -i {} -o StrictHostKeyChecking=no'.format(key_file)]
+    rsync_args += ['-e', ' '.join([ssh_binary, '-i', key_file, '-o', 'StrictHostKeyChecking=no'] + get_ssh_options())]
     rsync_args += args
     rsync_args += [src_local] if src_local else []
     rsync_args += ['{0}@{1}:{2}'.format(user, host, remote_path)]
     rsync_args += [dest_local] if dest_local else []
     return logged_call(rsync_args, tries=tries)
 
+def get_build_fingerprint(project_path, include_sources=True):
+    """
+    Hashes the sbt build definition (*.sbt files and project/ directories) and,
+    if include_sources, all src/ directories of the project and its submodules.
+    """
+    digest = hashlib.sha1()
+    source_dirs = ('src', 'project') if include_sources else ('project',)
+    for root, dirs, files in os.walk(project_path):
+        dirs[:] = sorted(d for d in dirs if d != 'target' and not d.startswith('.'))
+        relative_root = os.path.relpath(root, project_path)
+        in_sources = any(part in source_dirs for part in relative_root.split(os.sep))
+        for filename in sorted(files):
+            if in_sources or filename.endswith('.sbt'):
+                digest.update(os.path.join(relative_root, filename).encode('utf-8'))
+                digest.update(get_file_hash(os.path.join(root, filename)).encode('utf-8'))
+    return digest.hexdigest()
+
+
+def run_sbt_task_if_changed(task, fingerprint, fingerprint_name, get_output_path):
+    """
+    Runs the sbt task, unless its output was built from the same fingerprint.
+    The fingerprint of the last build is kept in target/<fingerprint_name>.
+    """
+    fingerprint_path = os.path.join(get_project_path(), 'target', fingerprint_name)
+    output_path = get_output_path()
+    last_build = {}
+    if os.path.exists(fingerprint_path):
+        with open(fingerprint_path) as f:
+            last_build = json.load(f)
+    if output_path and last_build.get('fingerprint') == fingerprint and \
+            last_build.get('output_path') == output_path and \
+            last_build.get('output_mtime') == os.path.getmtime(output_path):
+        log.info('Sources did not change since the last sbt {} build, skipping it (saved about {:.0f} seconds)'.format(
+            task, last_build.get('build_seconds', 0)))
+        return
+
+    begin_time = time.time()
+    logged_call(['/bin/bash', '-c', '(cd {} && ./sbt {})'.format(get_project_path(), task)])
+    output_path = get_output_path()
+    if output_path:
+        with open(fingerprint_path, 'w') as f:
+            json.dump({'fingerprint': fingerprint,
+                       'output_path': output_path,
+                       'output_mtime': os.path.getmtime(output_path),
+                       'build_seconds': time.time() - begin_time}, f)
+
+
 def build_assembly():
-    logged_call(['/bin/bash', '-c', '(cd {} && ./sbt assembly)'.format(get_project_path())])
+    run_sbt_task_if_changed('assembly', get_build_fingerprint(get_project_path()),
+                            '.assembly-fingerprint.json', get_assembly_path)
+
+
+def build_dependency_assembly():
+    # The dependencies only change with the build definition
+    run_sbt_task_if_changed('assembly-package-dependency',
+                            get_build_fingerprint(get_project_path(), include_sources=False),
+                            '.dependency-assembly-fingerprint.json', get_dependency_assembly_path)
+
 
 def get_assembly_path():
-    paths = glob.glob(get_project_path() + '/target/scala-*/*assembly*.jar')
+    paths = [path for path in glob.glob(get_project_path() + '/target/scala-*/*assembly*.jar')
+             if not path.endswith('-deps.jar')]
     if paths:
         return paths[0]
     else:
         return None
 
 
-@arg('job-mem', help='The amount of memory to use for this job (like: 80G)')
-@arg('--master', help="This parameter overrides the master of cluster-name")
-@arg('--disable-tmux', help='Do not use tmux. Warning: many features will not work without tmux. Use only if the tmux is missing on the master.')
-@arg('--detached', help='Run job in background, requires tmux')
-@arg('--destroy-cluster', help='Will destroy cluster after finishing the job')
-@named('run')
-def job_run(cluster_name, job_name, job_mem,
-            key_file=default_key_file, disable_tmux=False,
-            detached=False, notify_on_errors=False, yarn=False,
-            job_user=getpass.getuser(),
-            job_timeout_minutes=0,
-            remote_user=default_remote_user, utc_job_date=None, job_tag=None,
-            disable_wait_completion=False, collect_results_dir=default_collect_results_dir,
-            remote_control_dir = default_remote_control_dir,
-            remote_path=None, master=None,
-            disable_assembly_build=False,
-            run_tests=False,
-            kill_on_failure=False,
-            destroy_cluster=False, region=default_region):
+def get_dependency_assembly_path():
+    paths = glob.glob(get_project_path() + '/target/scala-*/*assembly*-deps.jar')
+    if paths:
+        return paths[0]
+    else:
+        return None
+
 
-    utc_job_date_example = '2014-05-04T13:13:10Z'
+def build_application_jar(assembly_path, dependency_assembly_path):
+    """
+    Writes a jar with the entries of the assembly that are not in the
+    dependency assembly, i.e. the classes and resources of the project itself.
+    Returns its path, which has the same file name as the assembly.
+    """
+    application_jar_path = os.path.join(get_project_path(), 'target', 'layers', os.path.basename(assembly_path))
+    if os.path.exists(application_jar_path) and \
+            os.path.getmtime(application_jar_path) >= max(os.path.getmtime(assembly_path),
+                                                          os.path.getmtime(dependency_assembly_path)):
+        return application_jar_path
+    if not os.path.exists(os.path.dirname(application_jar_path)):
+        os.makedirs(os.path.dirname(application_jar_path))
+    with zipfile.ZipFile(dependency_assembly_path) as dependencies:
+        dependency_crcs = dict((info.filename, info.CRC) for info in dependencies.infolist())
+    with zipfile.ZipFile(assembly_path) as assembly:
+        with zipfile.ZipFile(application_jar_path + '.tmp', 'w', zipfile.ZIP_DEFLATED) as application:
+            for info in assembly.infolist():
+                if info.filename == 'META-INF/MANIFEST.MF' or dependency_crcs.get(info.filename) != info.CRC:
+                    application.writestr(info, assembly.read(info))
+    os.rename(application_jar_path + '.tmp', application_jar_path)
+    log.info('Application layer of the assembly: {} ({:.1f} MB)'.format(
+        application_jar_path, os.path.getsize(application_jar_path) / 1024.0 / 1024.0))
+    return application_jar_path
+
+
+utc_job_date_example = '2014-05-04T13:13:10Z'
+
+
+def get_job_date_and_tag(utc_job_date=None, job_tag=None):
     if utc_job_date and len(utc_job_date) != len(utc_job_date_example):
         raise CommandError('UTC Job Date should be given as in the following example: {}'.format(utc_job_date_example))
-    disable_tmux = disable_tmux and not detached
-    wait_completion = not disable_wait_completion or destroy_cluster
-    master = master or get_master(cluster_name, region=region)
-
-    project_path = get_project_path()
-    project_name = os.path.basename(project_path)
-    module_name = os.path.basename(get_module_path())
-    # Use job user on remote path to avoid too many conflicts for different local users
-    remote_path = remote_path or '/home/%s/%s.%s' % (default_remote_user, job_user, project_name)
-    remote_hook_local = '{module_path}/remote_hook.sh'.format(module_path=get_module_path())
-    remote_hook = '{remote_path}/remote_hook.sh'.format(remote_path=remote_path)
-    notify_param = 'yes' if notify_on_errors else 'no'
-    yarn_param = 'yes' if yarn else 'no'
     job_date = utc_job_date or datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%SZ')
     job_tag = job_tag or job_date.replace(':', '_').replace('-', '_').replace('Z', 'UTC')
-    tmux_wait_command = ';(echo Press enter to keep the session open && /bin/bash -c "read -t 5" && sleep 7d)' if not detached else ''
-    tmux_arg = ". /etc/profile; . ~/.profile;tmux new-session {detached} -s spark.{job_name}.{job_tag} '{aws_vars} {remote_hook} {job_name} {job_date} {job_tag} {job_user} {remote_control_dir} {spark_mem} {yarn_param} {notify_param} {tmux_wait_command}' >& /tmp/commandoutput".format(
-        aws_vars=get_aws_keys_str(), job_name=job_name, job_date=job_date, job_tag=job_tag, job_user=job_user, remote_control_dir=remote_control_dir, remote_hook=remote_hook, spark_mem=job_mem, detached='-d' if detached else '', yarn_param=yarn_param, notify_param=notify_param, tmux_wait_command=tmux_wait_command)
-    non_tmux_arg = ". /etc/profile; . ~/.profile;{aws_vars} {remote_hook} {job_name} {job_date} {job_tag} {job_user} {remote_control_dir} {spark_mem} {yarn_param} {notify_param} >& /tmp/commandoutput".format(
-        aws_vars=get_aws_keys_str(), job_name=job_name, job_date=job_date, job_tag=job_tag, job_user=job_user, remote_control_dir=remote_control_dir, remote_hook=remote_hook, spark_mem=job_mem, yarn_param=yarn_param, notify_param=notify_param)
+    return job_date, job_tag
+
+
+def get_remote_path(job_user, remote_path=None):
+    project_name = os.path.basename(get_project_path())
+    # Use job user on remote path to avoid too many conflicts for different local users
+    return remote_path or '/home/%s/%s.%s' % (default_remote_user, job_user, project_name)
 
 
+def get_file_hash(path):
+    digest = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def upload_artifact(master, key_file, remote_user, local_path, remote_link,
+                    artifacts_dir=default_remote_artifacts_dir,
+                    artifacts_max_mb=default_remote_artifacts_max_mb):
+    """
+    Makes remote_link on the master a hard link to a copy of local_path kept
+    in a store addressed by content hash, uploading it only if the store does
+    not have it yet. The least recently used artifacts are evicted to keep the
+    store under artifacts_max_mb (the one just used is always kept).
+    Artifacts still linked from elsewhere, like the remote path of a batch
+    whose jobs haven't started, are never evicted: removing them would free
+    no space.
+    """
+    extension = os.path.splitext(local_path)[1]
+    stored = '{dir}/{digest}{extension}'.format(dir=artifacts_dir, digest=get_file_hash(local_path),
+                                                extension=extension)
+    found = ssh_call(user=remote_user, host=master, key_file=key_file, allocate_terminal=False, get_output=True,
+                     args=['mkdir -p {dir} && if [ -e {stored} ]; then echo found; fi'.format(dir=artifacts_dir, stored=stored)])
+    if found.strip() == 'found':
+        log.info('{} is already on the master as {}, skipping upload'.format(local_path, stored))
+    else:
+        rsync_call(user=remote_user,
+                   host=master,
+                   key_file=key_file,
+                   src_local=local_path,
+                   remote_path=stored + '.partial')
+    ssh_call(user=remote_user, host=master, key_file=key_file, allocate_terminal=False,
+             args=['''{{ [ ! -e {stored}.partial ] || mv -f {stored}.partial {stored}; }} &&
+                      touch {stored} && rm -f {link} && {{ ln {stored} {link} || cp {stored} {link}; }} &&
+                      find {dir} -maxdepth 1 -type f -links 1 -name '*{extension}' ! -path {stored} -printf '%T@ %s %p\\n' |
+                      sort -rn | awk -v max={max_bytes} '{{ total += $2; if (total > max) print $3 }}' |
+                      xargs -r rm -f'''.format(stored=stored, link=remote_link, dir=artifacts_dir,
+                                                 extension=extension, max_bytes=artifacts_max_mb * 1024 * 1024)])
+
+
+def upload_job_files(master, key_file, remote_user, remote_path, disable_assembly_build=False,
+                     layered_upload=False):
+    remote_hook_local = '{module_path}/remote_hook.sh'.format(module_path=get_module_path())
+    # Read by remote_hook.sh, which puts it in the classpath if present
+    remote_dependencies_jar = os.path.join(remote_path, 'dependencies.jar')
+
     if not disable_assembly_build:
         build_assembly()
+        if layered_upload:
+            build_dependency_assembly()
 
     assembly_path = get_assembly_path()
     if assembly_path is None:
@@ -409,11 +896,24 @@ def job_run(cluster_name, job_name, job_mem,
     ssh_call(user=remote_user, host=master, key_file=key_file,
              args=['mkdir', '-p', remote_path])
 
-    rsync_call(user=remote_user,
-               host=master,
-               key_file=key_file,
-               src_local=assembly_path,
-               remote_path=with_leading_slash(remote_path))
+    if layered_upload:
+        dependency_assembly_path = get_dependency_assembly_path()
+        if dependency_assembly_path is None:
+            raise Exception('Something is wrong: no dependency assembly found')
+        # The dependencies rarely change, so usually only the small
+        # application layer needs to be sent
+        upload_artifact(master=master, key_file=key_file, remote_user=remote_user,
+                        local_path=dependency_assembly_path,
+                        remote_link=remote_dependencies_jar)
+        upload_artifact(master=master, key_file=key_file, remote_user=remote_user,
+                        local_path=build_application_jar(assembly_path, dependency_assembly_path),
+                        remote_link=os.path.join(remote_path, os.path.basename(assembly_path)))
+    else:
+        ssh_call(user=remote_user, host=master, key_file=key_file, allocate_terminal=False,
+                 args=['rm', '-f', remote_dependencies_jar])
+        upload_artifact(master=master, key_file=key_file, remote_user=remote_user,
+                        local_path=assembly_path,
+                        remote_link=os.path.join(remote_path, os.path.basename(assembly_path)))
 
     rsync_call(user=remote_user,
                host=master,
@@ -421,12 +921,101 @@ def job_run(cluster_name, job_name, job_mem,
                src_local=remote_hook_local,
                remote_path=with_leading_slash(remote_path))
 
+
+def start_job(master, key_file, remote_user, remote_path, job_name, job_mem,
+              job_date, job_tag, job_user, remote_control_dir,
+              yarn=False, notify_on_errors=False, disable_tmux=False, detached=False):
+    remote_hook = '{remote_path}/remote_hook.sh'.format(remote_path=remote_path)
+    notify_param = 'yes' if notify_on_errors else 'no'
+    yarn_param = 'yes' if yarn else 'no'
+    tmux_wait_command = ';(echo Press enter to keep the session open && /bin/bash -c "read -t 5" && sleep 7d)' if not detached else ''
+    tmux_arg = ". /etc/profile; . ~/.profile;tmux new-session {detached} -s spark.{job_name}.{job_tag} '{aws_vars} {remote_hook} {job_name} {job_date} {job_tag} {job_user} {remote_control_dir} {spark_mem} {yarn_param} {notify_param} {tmux_wait_command}' >& /tmp/commandoutput".format(
+        aws_vars=get_aws_keys_str(), job_name=job_name, job_date=job_date, job_tag=job_tag, job_user=job_user, remote_control_dir=remote_control_dir, remote_hook=remote_hook, spark_mem=job_mem, detached='-d' if detached else '', yarn_param=yarn_param, notify_param=notify_param, tmux_wait_command=tmux_wait_command)
+    non_tmux_arg = ". /etc/profile; . ~/.profile;{aws_vars} {remote_hook} {job_name} {job_date} {job_tag} {job_user} {remote_control_dir} {spark_mem} {yarn_param} {notify_param} >& /tmp/commandoutput".format(
+        aws_vars=get_aws_keys_str(), job_name=job_name, job_date=job_date, job_tag=job_tag, job_user=job_user, remote_control_dir=remote_control_dir, remote_hook=remote_hook, spark_mem=job_mem, yarn_param=yarn_param, notify_param=notify_param)
+
     log.info('Will run job in remote host')
     if disable_tmux:
         ssh_call(user=remote_user, host=master, key_file=key_file, args=[non_tmux_arg], allocate_terminal=False)
     else:
         ssh_call(user=remote_user, host=master, key_file=key_file, args=[tmux_arg], allocate_terminal=True)
 
+
+@arg('job-mem', help='The amount of memory to use for this job (like: 80G)')
+@arg('--master', help="This parameter overrides the master of cluster-name")
+@arg('--disable-tmux', help='Do not use tmux. Warning: many features will not work without tmux. Use only if the tmux is missing on the master.')
+@arg('--detached', help='Run job in background, requires tmux')
+@arg('--destroy-cluster', help='Will destroy cluster after finishing the job')
+@arg('--layered-upload', help='Upload the dependencies and the application as separate jars, sending the dependencies only when they change')
+@arg('--from-pool', help='cluster-name is a pool: run on one of its idle clusters and give it back when done (see pool fill)')
+@arg('--self-heal', help='Replace the slaves lost while waiting for the job, using the arguments the cluster was launched with')
+@named('run')
+def job_run(cluster_name, job_name, job_mem,
+            key_file=default_key_file, disable_tmux=False,
+            detached=False, notify_on_errors=False, yarn=False,
+            job_user=getpass.getuser(),
+            job_timeout_minutes=0,
+            remote_user=default_remote_user, utc_job_date=None, job_tag=None,
+            disable_wait_completion=False, collect_results_dir=default_collect_results_dir,
+            remote_control_dir = default_remote_control_dir,
+            remote_path=None, master=None,
+            disable_assembly_build=False,
+            layered_upload=False,
+            run_tests=False,
+            kill_on_failure=False,
+            destroy_cluster=False, from_pool=False, self_heal=False, region=default_region):
+
+    if from_pool and not master:
+        cluster_name = acquire_pool_cluster(cluster_name, region=region)
+        try:
+            result = job_run(cluster_name, job_name, job_mem, key_file=key_file,
+                             disable_tmux=disable_tmux, detached=detached,
+                             notify_on_errors=notify_on_errors, yarn=yarn, job_user=job_user,
+                             job_timeout_minutes=job_timeout_minutes, remote_user=remote_user,
+                             utc_job_date=utc_job_date, job_tag=job_tag,
+                             disable_wait_completion=disable_wait_completion,
+                             collect_results_dir=collect_results_dir,
+                             remote_control_dir=remote_control_dir, remote_path=remote_path,
+                             disable_assembly_build=disable_assembly_build,
+                             layered_upload=layered_upload, run_tests=run_tests,
+                             kill_on_failure=kill_on_failure, destroy_cluster=destroy_cluster,
+                             self_heal=self_heal, region=region)
+        except NotHealthyCluster:
+            log.warn('Destroying unhealthy pooled cluster %s', cluster_name)
+            destroy(cluster_name, region=region)
+            raise
+        except JobFailure:
+            if not destroy_cluster:
+                release_pool_cluster(cluster_name, region=region)
+            raise
+        except Exception:
+            if not destroy_cluster and kill_on_failure:
+                release_pool_cluster(cluster_name, region=region)
+            elif not destroy_cluster:
+                log.warn('Leaving cluster %s busy, use pool release when its job is over', cluster_name)
+            raise
+        # A job still running keeps the cluster busy until pool release
+        if not destroy_cluster and not disable_wait_completion:
+            release_pool_cluster(cluster_name, region=region)
+        return result
+
+    job_date, job_tag = get_job_date_and_tag(utc_job_date, job_tag)
+    disable_tmux = disable_tmux and not detached
+    wait_completion = not disable_wait_completion or destroy_cluster
+    master = master or get_master(cluster_name, region=region)
+    remote_path = get_remote_path(job_user, remote_path)
+
+    upload_job_files(master=master, key_file=key_file, remote_user=remote_user,
+                     remote_path=remote_path, disable_assembly_build=disable_assembly_build,
+                     layered_upload=layered_upload)
+
+    start_job(master=master, key_file=key_file, remote_user=remote_user,
+              remote_path=remote_path, job_name=job_name, job_mem=job_mem,
+              job_date=job_date, job_tag=job_tag, job_user=job_user,
+              remote_control_dir=remote_control_dir, yarn=yarn,
+              notify_on_errors=notify_on_errors, disable_tmux=disable_tmux,
+              detached=detached)
+
     if wait_completion:
         failed = False
         failed_exception = None
@@ -436,7 +1025,7 @@ def job_run(cluster_name, job_name, job_mem,
                          region=region,
                          job_timeout_minutes=job_timeout_minutes,
                          remote_user=remote_user, remote_control_dir=remote_control_dir,
-                         collect_results_dir=collect_results_dir)
+                         collect_results_dir=collect_results_dir, self_heal=self_heal)
         except JobFailure as e:
             failed = True
             failed_exception = e
@@ -483,12 +1072,13 @@ def job_attach(cluster_name, key_file=default_key_file, job_name=None, job_tag=N
 class NotHealthyCluster(Exception): pass
 
 @named('health-check')
-def health_check(cluster_name, key_file=default_key_file, master=None, remote_user=default_remote_user, region=default_region):
+def health_check(cluster_name, key_file=default_key_file, master=None, remote_user=default_remote_user, region=default_region,
+                 inventory_ttl_seconds=None):
     master = master or get_master(cluster_name, region=region)
     all_args = load_cluster_args(master, key_file, remote_user)
     nslaves = int(all_args['slaves'])
     minimum_percentage_healthy_slaves = all_args['minimum_percentage_healthy_slaves']
-    masters, slaves = get_active_nodes(cluster_name, region=region)
+    masters, slaves = get_active_nodes(cluster_name, region=region, ttl_seconds=inventory_ttl_seconds)
     if nslaves == 0 or float(len(slaves)) / nslaves < minimum_percentage_healthy_slaves:
         raise NotHealthyCluster('Not enough healthy slaves: {0}/{1}'.format(len(slaves), nslaves))
 
@@ -530,13 +1120,85 @@ def collect_job_results(cluster_name, job_name, job_tag,
     return os.path.join(collect_results_dir, os.path.basename(job_control_dir))
 
 
+# Seconds after which a job that looks killed is checked again: the remote hook
+# creates the control dir a moment before writing RUNNING into it
+job_killed_confirm_seconds = 2
+
+
+def get_job_status_command(job_control_dir):
+    check = '''([ ! -e {path} ] && echo WAITINGCONTROL) ||
+              ([ -e {path}/RUNNING ] && ps -p $(cat {path}/RUNNING) >& /dev/null && echo RUNNING) ||
+              ([ -e {path}/SUCCESS ] && echo SUCCESS) ||
+              ([ -e {path}/FAILURE ] && echo FAILURE) ||
+              echo KILLED'''.format(path=job_control_dir)
+    return '''job_status=$({check})
+              if [ "$job_status" = KILLED ]; then
+                  sleep {confirm}
+                  job_status=$({check})
+              fi
+              echo $job_status'''.format(check=check, confirm=job_killed_confirm_seconds)
+
+
+def get_job_status_watcher_command(job_control_dir, heartbeat_seconds):
+    # Prints the job status whenever it changes (and every heartbeat_seconds,
+    # so the other side knows the channel is alive) until the job finishes.
+    # It sleeps on inotify events of the control dir when inotifywait is
+    # available, with a short timeout to also notice killed jobs.
+    return '''status() {{
+                  {status}
+              }}
+              last=
+              next_beat=0
+              while true; do
+                  current=$(status)
+                  if [ "$current" != "$last" ] || [ $SECONDS -ge $next_beat ]; then
+                      echo $current
+                      last=$current
+                      next_beat=$((SECONDS + {heartbeat}))
+                  fi
+                  case "$current" in
+                      SUCCESS|FAILURE|KILLED) exit 0;;
+                  esac
+                  if [ -d {path} ] && which inotifywait >& /dev/null; then
+                      inotifywait -qq -t 2 -e create -e delete -e close_write -e moved_to {path} >& /dev/null
+                  else
+                      sleep 0.5
+                  fi
+              done'''.format(status=get_job_status_command(job_control_dir),
+                             path=job_control_dir, heartbeat=int(heartbeat_seconds))
+
+
+def stream_job_status(user, host, key_file, job_control_dir, heartbeat_seconds):
+    """
+    Yields the job status each time it changes, and at least every
+    heartbeat_seconds, as pushed by a single long-lived watcher on the host.
+    Stops when the watcher exits or stays silent for two heartbeats.
+    """
+    with open(os.devnull) as devnull:
+        p = subprocess.Popen(ssh_args(user, host, key_file, allocate_terminal=False,
+                                      args=[get_job_status_watcher_command(job_control_dir, heartbeat_seconds)]),
+                             stdin=devnull, stdout=subprocess.PIPE, bufsize=0)
+    try:
+        while select.select([p.stdout], [], [], heartbeat_seconds * 2)[0]:
+            line = p.stdout.readline()
+            if not line:
+                break
+            yield line.strip()
+    finally:
+        if p.poll() is None:
+            p.kill()
+        p.wait()
+
+
+@arg('--self-heal', help='Replace the slaves lost while waiting for the job, using the arguments the cluster was launched with')
 @named('wait-for')
 def wait_for_job(cluster_name, job_name, job_tag, key_file=default_key_file,
                  master=None, remote_user=default_remote_user,
                  region=default_region,
                  remote_control_dir=default_remote_control_dir,
                  collect_results_dir=default_collect_results_dir,
-                 job_timeout_minutes=0, max_failures=5, seconds_to_sleep=60):
+                 job_timeout_minutes=0, max_failures=5, seconds_to_sleep=60,
+                 disable_streaming_status=False, self_heal=False, max_slave_replacements=3):
 
     master = master or get_master(cluster_name, region=region)
 
@@ -546,13 +1208,7 @@ def wait_for_job(cluster_name, job_name, job_tag, key_file=default_key_file,
 
     job_control_dir = get_job_control_dir(remote_control_dir, job_with_tag)
 
-    ssh_call_check_status = [
-                '''([ ! -e {path} ] && echo WAITINGCONTROL) ||
-                   ([ -e {path}/RUNNING ] && ps -p $(cat {path}/RUNNING) >& /dev/null && echo RUNNING) ||
-                   ([ -e {path}/SUCCESS ] && echo SUCCESS) ||
-                   ([ -e {path}/FAILURE ] && echo FAILURE) ||
-                   echo KILLED'''.format(path=job_control_dir)
-                ]
+    ssh_call_check_status = [get_job_status_command(job_control_dir)]
 
     def collect(show_tail):
         try:
@@ -584,11 +1240,32 @@ def wait_for_job(cluster_name, job_name, job_tag, key_file=default_key_file,
     failures = 0
     last_failure = None
     start_time = time.time()
+    last_health_check = 0
+    statuses = None
+    replacement = None
+    replacements = 0
     while True:
         try:
-            output = (ssh_call(user=remote_user, host=master, key_file=key_file,
-                               args=ssh_call_check_status, get_output=True) or '').strip()
-            if output == 'SUCCESS':
+            if disable_streaming_status:
+                output = (ssh_call(user=remote_user, host=master, key_file=key_file,
+                                   args=ssh_call_check_status, allocate_terminal=False,
+                                   get_output=True) or '').strip()
+            else:
+                statuses = statuses or stream_job_status(user=remote_user, host=master, key_file=key_file,
+                                                         job_control_dir=job_control_dir,
+                                                         heartbeat_seconds=seconds_to_sleep)
+                output = next(statuses, None)
+            if output is None:
+                log.warn('Lost the job status channel, will open a new one')
+                statuses = None
+                failures += 1
+                last_failure = 'Status channel closed'
+                time.sleep(5)
+            elif output == 'WAITINGCONTROL' and not disable_streaming_status and \
+                    time.time() - start_time < seconds_to_sleep:
+                # Give the remote hook some time to create the control directory
+                log.info('Waiting for control directory to be created...')
+            elif output == 'SUCCESS':
                 log.info('Job finished successfully!')
                 collect(show_tail=False)
                 break
@@ -607,8 +1284,10 @@ def wait_for_job(cluster_name, job_name, job_tag, key_file=default_key_file,
                     ['ps', 'auxef']
                 ]
                 log.info('Will run some commands for posterior investigation of the problem')
-                for command in commands:
-                    ssh_call(user=remote_user, host=master, key_file=key_file, args=command)
+                results = ssh_run_many(user=remote_user, host=master, key_file=key_file, commands=commands)
+                for command, result in zip(commands, results):
+                    log.info('Output of %s (exit code %s):\n%s%s', ' '.join(command),
+                             result.returncode, result.output, result.error)
                 failures += 1
                 last_failure = 'Control missing'
             elif output == 'KILLED':
@@ -621,7 +1300,24 @@ def wait_for_job(cluster_name, job_name, job_tag, key_file=default_key_file,
                 log.warn('Received unexpected response while checking job status: {}'.format(output))
                 failures += 1
                 last_failure = 'Unexpected response: {}'.format(output)
-            health_check(cluster_name=cluster_name, key_file=key_file, master=master, remote_user=remote_user, region=region)
+            # Status changes may arrive much more often than we want to check the cluster
+            if time.time() - last_health_check >= seconds_to_sleep or disable_streaming_status:
+                replacing = replacement is not None and replacement.is_alive()
+                if self_heal and not replacing and replacements < max_slave_replacements:
+                    replacement = start_slave_replacement(cluster_name=cluster_name, key_file=key_file,
+                                                          master=master, remote_user=remote_user,
+                                                          region=region)
+                    replacing = replacement is not None
+                    replacements += replacing
+                try:
+                    # Reuse the inventory of the previous check, querying EC2 every other check
+                    health_check(cluster_name=cluster_name, key_file=key_file, master=master, remote_user=remote_user, region=region,
+                                 inventory_ttl_seconds=seconds_to_sleep * 1.5)
+                except NotHealthyCluster as e:
+                    if not replacing:
+                        raise
+                    log.warn('{}, waiting for the replacement slaves'.format(e))
+                last_health_check = time.time()
         except subprocess.CalledProcessError as e:
             failures += 1
             log.exception('Got exception')
@@ -633,8 +1329,9 @@ def wait_for_job(cluster_name, job_name, job_tag, key_file=default_key_file,
         if job_timeout_minutes > 0 and (time.time() - start_time) / 60 >= job_timeout_minutes:
             collect(show_tail=True)
             raise JobFailure('Timed out')
-        log.debug('Sleeping for {} seconds before checking new status'.format(seconds_to_sleep))
-        time.sleep(seconds_to_sleep)
+        if disable_streaming_status:
+            log.debug('Sleeping for {} seconds before checking new status'.format(seconds_to_sleep))
+            time.sleep(seconds_to_sleep)
 
 
 @named('kill')
@@ -673,11 +1370,386 @@ def killall_jobs(cluster_name, key_file=default_key_file,
 
 
 
+class InvalidJobBatch(CommandError): pass
+
+
+def load_job_batch(batch_file):
+    """
+    Reads a batch of jobs from a JSON file holding a list of objects like:
+
+        {"job_name": "MyJob", "job_mem": "80G", "name": "my-job-2",
+         "job_tag": "some_tag", "depends_on": ["my-job-1"]}
+
+    Only job_name and job_mem are required. name defaults to job_name and is
+    what depends_on refers to. A job only starts after all the jobs it
+    depends on succeeded.
+    Returns an OrderedDict of name -> job.
+    """
+    with open(batch_file) as f:
+        specs = json.load(f)
+    jobs = OrderedDict()
+    for spec in specs:
+        if 'job_name' not in spec or 'job_mem' not in spec:
+            raise InvalidJobBatch('Every job needs a job_name and a job_mem: {}'.format(spec))
+        job = dict(spec)
+        job.setdefault('name', job['job_name'])
+        job.setdefault('depends_on', [])
+        if job['name'] in jobs:
+            raise InvalidJobBatch('Duplicated job name: {}'.format(job['name']))
+        jobs[job['name']] = job
+    for job in jobs.values():
+        unknown = [d for d in job['depends_on'] if d not in jobs]
+        if unknown:
+            raise InvalidJobBatch('Job {} depends on unknown jobs: {}'.format(job['name'], ', '.join(unknown)))
+
+    def check_cycles(name, path):
+        if name in path:
+            raise InvalidJobBatch('Dependency cycle: {}'.format(' -> '.join(path + [name])))
+        for dependency in jobs[name]['depends_on']:
+            check_cycles(dependency, path + [name])
+
+    for name in jobs:
+        check_cycles(name, [])
+    return jobs
+
+
+def get_jobs_status(master, key_file, remote_user, remote_control_dir, jobs_with_tag):
+    """
+    Checks the status of many jobs with a single remote call.
+    Returns a dict of job_with_tag -> status, as in wait_for_job.
+    """
+    command = '\n'.join('echo "{job_with_tag} $({status})"'.format(
+                            job_with_tag=job_with_tag,
+                            status=get_job_status_command(get_job_control_dir(remote_control_dir, job_with_tag)))
+                         for job_with_tag in jobs_with_tag)
+    output = ssh_call(user=remote_user, host=master, key_file=key_file,
+                      args=[command], allocate_terminal=False, get_output=True)
+    return dict(line.split() for line in output.splitlines() if len(line.split()) == 2)
+
+
+def print_job_batch_summary(jobs):
+    rows = [('NAME', 'JOB', 'TAG', 'STATUS', 'RUNTIME')]
+    for job in jobs.values():
+        if job.get('start_time') and job.get('end_time'):
+            runtime = str(timedelta(seconds=int(job['end_time'] - job['start_time'])))
+        else:
+            runtime = '-'
+        rows.append((job['name'], job['job_name'], job['job_tag'], job['status'], runtime))
+    widths = [max(len(row[i]) for row in rows) for i in range(len(rows[0]))]
+    for row in rows:
+        print('  '.join(value.ljust(width) for value, width in zip(row, widths)).rstrip())
+
+
+@arg('batch-file', help='JSON file with the list of jobs to run (see load_job_batch)')
+@arg('--max-concurrent-jobs', help='Maximum number of jobs of the batch running at the same time')
+@arg('--destroy-cluster', help='Will destroy cluster after finishing all the jobs')
+@arg('--layered-upload', help='Upload the dependencies and the application as separate jars, sending the dependencies only when they change')
+@named('run-batch')
+def job_run_batch(cluster_name, batch_file,
+                  key_file=default_key_file,
+                  max_concurrent_jobs=4,
+                  notify_on_errors=False, yarn=False,
+                  job_user=getpass.getuser(),
+                  job_timeout_minutes=0,
+                  remote_user=default_remote_user, utc_job_date=None,
+                  collect_results_dir=default_collect_results_dir,
+                  remote_control_dir=default_remote_control_dir,
+                  remote_path=None, master=None,
+                  disable_assembly_build=False,
+                  layered_upload=False,
+                  kill_on_failure=False,
+                  destroy_cluster=False, region=default_region,
+                  max_failures=5, seconds_to_sleep=10,
+                  seconds_to_wait_control=120, seconds_between_health_checks=60):
+
+    jobs = load_job_batch(batch_file)
+    max_concurrent_jobs = max(1, int(max_concurrent_jobs))
+    job_date, batch_tag = get_job_date_and_tag(utc_job_date)
+    for job in jobs.values():
+        job['job_date'] = job_date
+        # Jobs sharing a job name need different tags to get different control dirs
+        job.setdefault('job_tag', batch_tag if job['name'] == job['job_name'] else
+                       '{}_{}'.format(batch_tag, job['name']))
+        job['job_with_tag'] = get_job_with_tag(job['job_name'], job['job_tag'])
+        job['status'] = 'PENDING'
+
+    master = master or get_master(cluster_name, region=region)
+    remote_path = get_remote_path(job_user, remote_path)
+
+    upload_job_files(master=master, key_file=key_file, remote_user=remote_user,
+                     remote_path=remote_path, disable_assembly_build=disable_assembly_build,
+                     layered_upload=layered_upload)
+
+    def finish(job, status):
+        job['status'] = status
+        job['end_time'] = time.time()
+        log.info('Job {} finished with status {}'.format(job['name'], status))
+        if status != 'SUCCESS' and kill_on_failure:
+            try:
+                kill_job(cluster_name=cluster_name, job_name=job['job_name'],
+                         job_tag=job['job_tag'], key_file=key_file,
+                         master=master, remote_user=remote_user,
+                         region=region, remote_control_dir=remote_control_dir)
+            except Exception as e:
+                log.exception("Failed to kill failed job (probably it's already dead)")
+        try:
+            collect_job_results(cluster_name=cluster_name, job_name=job['job_name'],
+                                job_tag=job['job_tag'], key_file=key_file,
+                                region=region, master=master, remote_user=remote_user,
+                                remote_control_dir=remote_control_dir,
+                                collect_results_dir=collect_results_dir)
+        except Exception as e:
+            log.exception('Failed to collect results of job {}'.format(job['name']))
+
+    failures = 0
+    last_health_check = 0
+    try:
+        while True:
+            running = [job for job in jobs.values() if job['status'] == 'RUNNING']
+            for job in jobs.values():
+                if job['status'] != 'PENDING':
+                    continue
+                dependencies = [jobs[d]['status'] for d in job['depends_on']]
+                if any(status not in ('PENDING', 'RUNNING', 'SUCCESS') for status in dependencies):
+                    job['status'] = 'SKIPPED'
+                elif all(status == 'SUCCESS' for status in dependencies) and len(running) < max_concurrent_jobs:
+                    start_job(master=master, key_file=key_file, remote_user=remote_user,
+                              remote_path=remote_path, job_name=job['job_name'], job_mem=job['job_mem'],
+                              job_date=job['job_date'], job_tag=job['job_tag'], job_user=job_user,
+                              remote_control_dir=remote_control_dir, yarn=yarn,
+                              notify_on_errors=notify_on_errors, detached=True)
+                    job['status'] = 'RUNNING'
+                    job['start_time'] = time.time()
+                    running.append(job)
+
+            if not running:
+                if any(job['status'] == 'PENDING' for job in jobs.values()):
+                    continue # some jobs were just skipped, check the pending ones again
+                break
+
+            time.sleep(seconds_to_sleep)
+            try:
+                statuses = get_jobs_status(master=master, key_file=key_file, remote_user=remote_user,
+                                           remote_control_dir=remote_control_dir,
+                                           jobs_with_tag=[job['job_with_tag'] for job in running])
+                failures = 0
+            except subprocess.CalledProcessError as e:
+                failures += 1
+                log.exception('Got exception while checking the status of the jobs')
+                if failures > max_failures:
+                    raise JobFailure('Too many failures while checking the status of the jobs')
+                continue
+
+            for job in running:
+                status = statuses.get(job['job_with_tag'])
+                elapsed = time.time() - job['start_time']
+                if status in ('SUCCESS', 'FAILURE', 'KILLED'):
+                    finish(job, status)
+                elif status == 'WAITINGCONTROL' and elapsed > seconds_to_wait_control:
+                    log.error('Control directory of job {} is still missing'.format(job['name']))
+                    finish(job, 'NOCONTROL')
+                elif job_timeout_minutes > 0 and elapsed / 60 >= job_timeout_minutes:
+                    finish(job, 'TIMEDOUT')
+            # The jobs are polled much more often than we want to check the cluster
+            if time.time() - last_health_check >= seconds_between_health_checks:
+                health_check(cluster_name=cluster_name, key_file=key_file, master=master, remote_user=remote_user, region=region,
+                             inventory_ttl_seconds=seconds_between_health_checks * 1.5)
+                last_health_check = time.time()
+    except:
+        # Giving up on the batch must not leave its jobs running unnoticed
+        for job in jobs.values():
+            if job['status'] != 'RUNNING':
+                continue
+            if kill_on_failure:
+                finish(job, 'ABORTED')
+            else:
+                log.error('Job {} is still running on the cluster as {}'.format(job['name'], job['job_with_tag']))
+        raise
+    finally:
+        print_job_batch_summary(jobs)
+        if destroy_cluster:
+            log.info('Destroying cluster as requested')
+            destroy(cluster_name, region=region)
+
+    unsuccessful = [job['name'] for job in jobs.values() if job['status'] != 'SUCCESS']
+    if unsuccessful:
+        raise JobFailure('Jobs not successful: {}'.format(', '.join(unsuccessful)))
+    return [(job['job_name'], job['job_tag']) for job in jobs.values()]
+
+
+
+
+# Launch arguments that change what a cluster is, used to match pooled clusters
+pool_launch_arg_names = [
+    'slaves', 'env', 'key_id', 'region', 'zone', 'instance_type', 'ondemand', 'spot_price',
+    'plan_placement', 'placement_instance_types', 'placement_resource', 'user_data',
+    'security_group', 'vpc', 'vpc_subnet', 'master_instance_type', 'hadoop_major_version',
+    'worker_instances', 'minimum_percentage_healthy_slaves', 'worker_timeout', 'spark_repo',
+    'spark_version', 'spark_ec2_git_repo', 'spark_ec2_git_branch', 'ami', 'master_ami',
+]
+
+# Seconds to wait after claiming a pooled cluster before checking that no one else claimed it
+pool_claim_settle_seconds = 5
+pool_time_format = '%Y-%m-%dT%H:%M:%SZ'
+
+
+def get_launch_defaults():
+    spec = inspect.getargspec(launch)
+    return dict(zip(spec.args[-len(spec.defaults):], spec.defaults))
+
+
+def get_pool_args_hash(launch_kwargs):
+    launch_args = get_launch_defaults()
+    launch_args.update(launch_kwargs)
+    pool_args = dict((k, str(launch_args[k])) for k in pool_launch_arg_names)
+    return hashlib.sha1(json.dumps(pool_args, sort_keys=True)).hexdigest()[:16]
+
+
+def get_pool_clusters(pool_name, region, state=None):
+    tags = {'ignition_pool': pool_name}
+    if state:
+        tags['ignition_pool_state'] = state
+    return get_tagged_clusters(region, tags)
+
+
+def set_pool_state(cluster_name, state, region, owner=''):
+    tag_instances(cluster_name, {'ignition_pool_state': state,
+                                 'ignition_pool_owner': owner,
+                                 'ignition_pool_since': datetime.utcnow().strftime(pool_time_format)},
+                  region=region)
+
+
+def claim_pool_cluster(pool_name, cluster_name, state, region):
+    """
+    Moves an idle cluster of the pool to the given state. EC2 tags have no
+    compare-and-set, so the claim is tagged with a unique owner and checked
+    again after a while: if another process claimed the same cluster, the
+    last tag wins and only its owner gets the cluster.
+    """
+    owner = '{0}-{1}'.format(getpass.getuser(), uuid.uuid4().hex[:8])
+    set_pool_state(cluster_name, state, region, owner=owner)
+    time.sleep(pool_claim_settle_seconds)
+    tags = get_pool_clusters(pool_name, region).get(cluster_name, {})
+    return tags.get('ignition_pool_state') == state and tags.get('ignition_pool_owner') == owner
+
+
+def acquire_pool_cluster(pool_name, region=default_region):
+    idle = get_pool_clusters(pool_name, region, state='idle')
+    # Prefer the most recently released clusters so the others can expire
+    for cluster_name in sorted(idle, key=lambda c: idle[c]['ignition_pool_since'], reverse=True):
+        if claim_pool_cluster(pool_name, cluster_name, 'busy', region):
+            log.info('Acquired cluster %s from pool %s', cluster_name, pool_name)
+            return cluster_name
+    raise CommandError('No idle cluster in pool {0}, use pool fill to add some'.format(pool_name))
+
+
+@named('release')
+def release_pool_cluster(cluster_name, region=default_region):
+    set_pool_state(cluster_name, 'idle', region)
+    log.info('Released cluster %s', cluster_name)
+
+
+@arg('-t', '--tag', action='append', type=str, help=tag_help_text)
+@arg('--size', help='Number of idle clusters the pool should have')
+@arg('--max-parallel-launches', help='Maximum number of clusters launched at the same time')
+@named('fill')
+def pool_fill(pool_name, slaves, size=1,
+              key_file=default_key_file, env=default_env, tag=[],
+              key_id=default_key_id, region=default_region,
+              zone=default_zone, instance_type=default_instance_type,
+              ondemand=False, spot_price=default_spot_price, plan_placement=False,
+              master_instance_type=default_master_instance_type,
+              worker_instances=default_worker_instances,
+              spark_version=default_spark_version,
+              security_group=None, vpc=None, vpc_subnet=None,
+              remote_user=default_remote_user,
+              max_parallel_launches=4):
+    """
+    Launches clusters until the pool has size idle clusters matching these
+    launch arguments. Idle clusters launched with other arguments are
+    destroyed.
+    """
+    launch_kwargs = dict(slaves=slaves, key_file=key_file, env=env, tag=tag, key_id=key_id,
+                         region=region, zone=zone, instance_type=instance_type,
+                         ondemand=ondemand, spot_price=spot_price, plan_placement=plan_placement,
+                         master_instance_type=master_instance_type,
+                         worker_instances=worker_instances, spark_version=spark_version,
+                         security_group=security_group, vpc=vpc, vpc_subnet=vpc_subnet,
+                         remote_user=remote_user)
+    args_hash = get_pool_args_hash(launch_kwargs)
+
+    idle = get_pool_clusters(pool_name, region, state='idle')
+    stale = [c for c, tags in idle.items() if tags.get('ignition_pool_args') != args_hash]
+    for cluster_name in stale:
+        if claim_pool_cluster(pool_name, cluster_name, 'reaping', region):
+            log.info('Destroying cluster %s launched with other arguments', cluster_name)
+            destroy(cluster_name, region=region)
+
+    missing = int(size) - (len(idle) - len(stale))
+    if missing <= 0:
+        log.info('Pool %s already has %d idle clusters', pool_name, len(idle) - len(stale))
+        return
+
+    prefix = '{0}-{1}-{2}'.format(pool_name, datetime.utcnow().strftime('%Y%m%d%H%M%S'),
+                                  uuid.uuid4().hex[:4])
+    pool_tags = ['ignition_pool=' + pool_name, 'ignition_pool_args=' + args_hash,
+                 'ignition_pool_state=launching']
+
+    def launch_one(cluster_name):
+        kwargs = dict(launch_kwargs, tag=list(tag) + pool_tags)
+        try:
+            launch(cluster_name, **kwargs)
+        except Exception:
+            log.exception('Failed to launch pooled cluster %s', cluster_name)
+            return False
+        release_pool_cluster(cluster_name, region=region)
+        return True
+
+    log.info('Launching %d clusters for pool %s', missing, pool_name)
+    launched = parallel_map(launch_one, ['{0}-{1}'.format(prefix, i) for i in range(missing)],
+                            int(max_parallel_launches))
+    if not all(launched):
+        raise CommandError('Launched only {0} of {1} clusters'.format(sum(launched), missing))
+
+
+@named('status')
+def pool_status(pool_name, region=default_region):
+    clusters = get_pool_clusters(pool_name, region)
+    for cluster_name in sorted(clusters):
+        tags = clusters[cluster_name]
+        print('{0:<40} {1:<10} {2:<21} {3:<18} {4}'.format(
+            cluster_name, tags.get('ignition_pool_state', ''), tags.get('ignition_pool_since', ''),
+            tags.get('ignition_pool_args', ''), tags.get('ignition_pool_owner', '')).rstrip())
+
+
+@arg('--idle-ttl-minutes', help='Destroy the clusters idle for longer than this')
+@arg('--busy-ttl-minutes', help='Release the clusters busy for longer than this, left behind by runs that died')
+@named('reap')
+def pool_reap(pool_name, idle_ttl_minutes=60, busy_ttl_minutes=24 * 60, region=default_region):
+    now = datetime.utcnow()
+    busy = get_pool_clusters(pool_name, region, state='busy')
+    for cluster_name, tags in busy.items():
+        since = datetime.strptime(tags['ignition_pool_since'], pool_time_format)
+        if now - since >= timedelta(minutes=float(busy_ttl_minutes)):
+            log.warn('Releasing cluster %s, busy since %s by %s', cluster_name, since,
+                     tags.get('ignition_pool_owner', ''))
+            release_pool_cluster(cluster_name, region=region)
+    idle = get_pool_clusters(pool_name, region, state='idle')
+    for cluster_name, tags in idle.items():
+        since = datetime.strptime(tags['ignition_pool_since'], pool_time_format)
+        if now - since < timedelta(minutes=float(idle_ttl_minutes)):
+            continue
+        if claim_pool_cluster(pool_name, cluster_name, 'reaping', region):
+            log.info('Destroying cluster %s, idle since %s', cluster_name, since)
+            destroy(cluster_name, region=region)
+
+
 
 parser = ArghParser()
-parser.add_commands([launch, destroy, get_master, ssh_master, tag_cluster_instances, health_check])
-parser.add_commands([job_run, job_attach, wait_for_job,
+parser.add_commands([launch, plan_placement_cmd, resize, destroy, destroy_many, bake_image, get_master, ssh_master, tag_cluster_instances, health_check])
+parser.add_commands([job_run, job_run_batch, job_attach, wait_for_job,
                      kill_job, killall_jobs, collect_job_results], namespace="jobs")
+parser.add_commands([pool_fill, pool_status, pool_reap, release_pool_cluster], namespace="pool")
 
 if __name__ == '__main__':
     parser.dispatch()
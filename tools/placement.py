@@ -0,0 +1,210 @@
+#!/usr/bin/env python
+"""
+Picks the zones, instance type and spot bid of a cluster from the recent
+spot price history.
+"""
+import logging
+import math
+from argh import CommandError
+from collections import namedtuple
+from datetime import datetime, timedelta
+from utils import get_connection, load_cached, save_cached
+
+# vCPUs and memory (GiB) of the instance types that spark_ec2 knows about.
+# For easy maintainability, please keep this manually-inputted dictionary sorted by key.
+INSTANCE_RESOURCES = {
+    "c1.medium":   (2, 1.7),
+    "c1.xlarge":   (8, 7.0),
+    "c3.2xlarge":  (8, 15.0),
+    "c3.4xlarge":  (16, 30.0),
+    "c3.8xlarge":  (32, 60.0),
+    "c3.large":    (2, 3.75),
+    "c3.xlarge":   (4, 7.5),
+    "cc2.8xlarge": (32, 60.5),
+    "cr1.8xlarge": (32, 244.0),
+    "d2.2xlarge":  (8, 61.0),
+    "d2.4xlarge":  (16, 122.0),
+    "d2.8xlarge":  (36, 244.0),
+    "d2.xlarge":   (4, 30.5),
+    "hi1.4xlarge": (16, 60.5),
+    "hs1.8xlarge": (16, 117.0),
+    "i2.2xlarge":  (8, 61.0),
+    "i2.4xlarge":  (16, 122.0),
+    "i2.8xlarge":  (32, 244.0),
+    "i2.xlarge":   (4, 30.5),
+    "m1.large":    (2, 7.5),
+    "m1.medium":   (1, 3.75),
+    "m1.small":    (1, 1.7),
+    "m1.xlarge":   (4, 15.0),
+    "m2.2xlarge":  (4, 34.2),
+    "m2.4xlarge":  (8, 68.4),
+    "m2.xlarge":   (2, 17.1),
+    "m3.2xlarge":  (8, 30.0),
+    "m3.large":    (2, 7.5),
+    "m3.medium":   (1, 3.75),
+    "m3.xlarge":   (4, 15.0),
+    "r3.2xlarge":  (8, 61.0),
+    "r3.4xlarge":  (16, 122.0),
+    "r3.8xlarge":  (32, 244.0),
+    "r3.large":    (2, 15.25),
+    "r3.xlarge":   (4, 30.5),
+}
+
+# Seconds during which a spot price history query is reused
+spot_price_cache_ttl_seconds = 15 * 60
+
+Placement = namedtuple('Placement', ['instance_type', 'zones', 'bid', 'slaves',
+                                     'expected_price', 'grant_probability', 'score'])
+
+
+def get_spot_price_history(region, instance_types, hours):
+    """
+    Returns the Linux spot prices of the last hours for the instance types as
+    a list of [zone, instance_type, timestamp, price], using the disk cache
+    when it is fresh enough.
+    """
+    key = [region, sorted(instance_types), hours]
+    prices = load_cached('spot-prices', key, spot_price_cache_ttl_seconds)
+    if prices is not None:
+        return prices
+    conn = get_connection(region)
+    end_time = datetime.utcnow()
+    start_time = end_time - timedelta(hours=hours)
+    prices = []
+    next_token = None
+    while True:
+        page = conn.get_spot_price_history(start_time=start_time.isoformat(),
+                                           end_time=end_time.isoformat(),
+                                           product_description='Linux/UNIX',
+                                           filters={'instance-type': sorted(instance_types)},
+                                           next_token=next_token)
+        prices.extend([p.availability_zone, p.instance_type, p.timestamp, p.price] for p in page)
+        next_token = getattr(page, 'next_token', None)
+        if not next_token:
+            break
+    save_cached('spot-prices', key, prices)
+    return prices
+
+
+def parse_timestamp(timestamp):
+    return datetime.strptime(timestamp[:19], '%Y-%m-%dT%H:%M:%S')
+
+
+def get_price_durations(history, now):
+    """
+    Returns the (price, seconds) pairs of a price history: each price holds
+    from its timestamp until the next one.
+    """
+    history = sorted((parse_timestamp(timestamp), price) for timestamp, price in history)
+    ends = [timestamp for timestamp, _ in history[1:]] + [now]
+    return [(price, max(0, (end - start).total_seconds()))
+            for (start, price), end in zip(history, ends)]
+
+
+def get_grant_probability(durations, bid):
+    # Fraction of the time in which a request with this bid would be granted
+    total = sum(seconds for _, seconds in durations)
+    if total == 0:
+        return 1.0 if all(price <= bid for price, _ in durations) else 0.0
+    return sum(seconds for price, seconds in durations if price <= bid) / total
+
+
+def get_bid(durations, target_probability, max_bid):
+    """
+    Returns the lowest historical price that would have been granted at
+    least target_probability of the time, or None if even max_bid is not
+    enough.
+    """
+    for price in sorted(set(price for price, _ in durations)):
+        if price > max_bid:
+            break
+        if get_grant_probability(durations, price) >= target_probability:
+            return price
+    return None
+
+
+def get_resource(instance_type, resource):
+    cores, memory = INSTANCE_RESOURCES[instance_type]
+    return memory if resource == 'memory' else cores
+
+
+def plan_placement(region, instance_type, slaves, max_bid, candidate_types=None, zones=None,
+                   resource='memory', hours=24, target_probability=0.9, bid_margin=0.2,
+                   zone_tolerance=0.1):
+    """
+    Ranks every candidate instance type and zone by the expected price per
+    unit of resource ('memory' or 'cores'), penalized by the chance of the
+    bid not being granted. The number of slaves is scaled so the cluster has
+    the same total resource as slaves of instance_type.
+
+    The bid is the lowest recent price that was granted at least
+    target_probability of the time plus bid_margin, capped at max_bid. Spot
+    instances are charged at the market price, so the margin costs little.
+
+    Returns the list of Placement, best first. The zones of a placement are
+    all the zones of its instance type scoring within zone_tolerance of its
+    best zone, so the spot requests can be spread across them.
+    """
+    supported = ', '.join(sorted(INSTANCE_RESOURCES))
+    if instance_type not in INSTANCE_RESOURCES:
+        raise CommandError('Unknown instance type {0}, the supported ones are: {1}'.format(
+            instance_type, supported))
+    unknown = [t for t in candidate_types or [] if t not in INSTANCE_RESOURCES]
+    if unknown:
+        logging.warning('Skipping unknown candidate instance types: %s', ', '.join(unknown))
+    candidate_types = [t for t in (candidate_types or sorted(INSTANCE_RESOURCES))
+                       if t in INSTANCE_RESOURCES]
+    if not candidate_types:
+        raise CommandError('No known candidate instance types, the supported ones are: {0}'.format(
+            supported))
+    wanted = float(get_resource(instance_type, resource) * int(slaves))
+    now = datetime.utcnow()
+
+    histories = {}
+    for zone, price_type, timestamp, price in get_spot_price_history(region, candidate_types, hours):
+        if zones is None or zone in zones:
+            histories.setdefault((price_type, zone), []).append((timestamp, price))
+
+    by_type = {}
+    for (price_type, zone), history in histories.items():
+        durations = get_price_durations(history, now)
+        bid = get_bid(durations, target_probability, max_bid)
+        if bid is None:
+            continue
+        bid = min(max_bid, bid * (1 + bid_margin))
+        granted = [(price, seconds) for price, seconds in durations if price <= bid]
+        granted_seconds = sum(seconds for _, seconds in granted)
+        # Average price paid while the bid is granted
+        if granted_seconds:
+            expected_price = sum(price * seconds for price, seconds in granted) / granted_seconds
+        else:
+            expected_price = max(price for price, _ in granted)
+        grant_probability = get_grant_probability(durations, bid)
+        score = expected_price / get_resource(price_type, resource) / grant_probability
+        by_type.setdefault(price_type, []).append((score, zone, bid, expected_price, grant_probability))
+
+    placements = []
+    for price_type, options in by_type.items():
+        options.sort()
+        best_score = options[0][0]
+        chosen = [o for o in options if o[0] <= best_score * (1 + zone_tolerance)]
+        placements.append(Placement(
+            instance_type=price_type,
+            zones=[zone for _, zone, _, _, _ in chosen],
+            bid=max(bid for _, _, bid, _, _ in chosen),
+            slaves=int(math.ceil(wanted / get_resource(price_type, resource))),
+            expected_price=options[0][3],
+            grant_probability=min(p for _, _, _, _, p in chosen),
+            score=best_score))
+    placements.sort(key=lambda p: p.score)
+    return placements
+
+
+def format_placements(placements, limit=10):
+    lines = ['{0:<12} {1:>6} {2:>8} {3:>10} {4:>7}  {5}'.format(
+        'type', 'slaves', 'bid', 'expected', 'grant', 'zones')]
+    for p in placements[:limit]:
+        lines.append('{0:<12} {1:>6} {2:>8.4f} {3:>10.4f} {4:>6.0%}  {5}'.format(
+            p.instance_type, p.slaves, p.bid, p.expected_price, p.grant_probability,
+            ','.join(p.zones)))
+    return '\n'.join(lines)
@@ -0,0 +1,31 @@
+#!/bin/bash
+
+# Runs on the instance an image is baked from, piped through ssh by
+# spark_ec2.py once spark-ec2 is cloned and ec2-variables.sh deployed.
+# Installs the modules with their init.sh, the slow part of spark-ec2/setup.sh,
+# and removes what is specific to this instance. On clusters launched from the
+# image, each init.sh finds its module installed and returns right away.
+#
+# BAKE_HOME replaces /root to try the script against a stand-in directory.
+
+BAKE_HOME="${BAKE_HOME:-/root}"
+SPARK_EC2_DIR="$BAKE_HOME/spark-ec2"
+
+cd "$SPARK_EC2_DIR" || exit 1
+[ -f "$BAKE_HOME/.bash_profile" ] && source "$BAKE_HOME/.bash_profile"
+source ec2-variables.sh
+
+for module in $MODULES; do
+    if [[ -e $module/init.sh ]]; then
+        echo "Installing $module"
+        source $module/init.sh
+    fi
+    # Guard against init.sh changing the cwd
+    cd "$SPARK_EC2_DIR"
+done
+
+# The cluster clones spark-ec2 again and generates its own SSH key
+cd "$BAKE_HOME"
+rm -rf "$SPARK_EC2_DIR" "$BAKE_HOME/.ssh/id_rsa" "$BAKE_HOME/.ssh/id_rsa.pub" \
+    "$BAKE_HOME/.ssh/known_hosts" "$BAKE_HOME/.bash_history"
+echo "Installed: $(echo $MODULES)"
@@ -0,0 +1,100 @@
+#!/bin/bash
+
+# Runs on the master, piped through ssh by spark_ec2.py:
+#   resize-slaves.sh join <host>...             set up new slaves like the existing ones and start them
+#   resize-slaves.sh drain <timeout> <host>...  wait for the slaves to finish their containers and stop them
+
+ACTION="${1:?Please give the action (join/drain)}"
+shift
+
+SSH_OPTS="-o StrictHostKeyChecking=no -o UserKnownHostsFile=/dev/null -o ConnectTimeout=10"
+MODULE_DIRS="/root/spark-ec2 /root/spark /root/ephemeral-hdfs /root/persistent-hdfs /root/mapreduce /root/tachyon /root/scala /root/hadoop-native"
+SLAVE_FILES="/root/spark-ec2/slaves /root/spark/conf/slaves /root/ephemeral-hdfs/conf/slaves /root/ephemeral-hdfs/etc/hadoop/slaves /root/persistent-hdfs/conf/slaves /root/mapreduce/conf/slaves /root/tachyon/conf/workers"
+HADOOP_SBIN=/root/ephemeral-hdfs/sbin
+YARN=/root/ephemeral-hdfs/bin/yarn
+
+[ -f /root/spark-ec2/ec2-variables.sh ] && source /root/spark-ec2/ec2-variables.sh
+
+join_slave() {
+    host="$1"
+    dirs=$(for d in $MODULE_DIRS; do [ -d "$d" ] && echo "$d"; done)
+    rsync -az -e "ssh $SSH_OPTS" --exclude logs $dirs "${host}:/root/" || return 1
+    ssh $SSH_OPTS "$host" "
+        [ -x /root/spark-ec2/setup-slave.sh ] && /root/spark-ec2/setup-slave.sh
+        [ -x ${HADOOP_SBIN}/hadoop-daemon.sh ] && ${HADOOP_SBIN}/hadoop-daemon.sh start datanode
+        [ -x ${HADOOP_SBIN}/yarn-daemon.sh ] && ${HADOOP_SBIN}/yarn-daemon.sh start nodemanager
+        true" || return 1
+    # Standalone workers, only if the standalone master is running
+    if pgrep -f deploy.master.Master > /dev/null; then
+        for i in $(seq 1 ${SPARK_WORKER_INSTANCES:-1}); do
+            ssh $SSH_OPTS "$host" /root/spark/sbin/start-slave.sh $i "spark://${ACTIVE_MASTER:-$(hostname)}:7077"
+        done
+    fi
+}
+
+running_containers() {
+    # Node ids look like <hostname>:<port>, the last column is the number of running containers
+    [ -x "$YARN" ] || { echo 0; return; }
+    $YARN node -list 2> /dev/null | awk -v node="$1" 'index($1, node ":") == 1 { n += $NF } END { print n + 0 }'
+}
+
+drain_slave() {
+    host="$1"
+    deadline="$2"
+    node=$(ssh $SSH_OPTS "$host" hostname)
+    while [ $(date +%s) -lt $deadline ] && [ "$(running_containers "$node")" -gt 0 ]; do
+        sleep 10
+    done
+    ssh $SSH_OPTS "$host" "
+        [ -x ${HADOOP_SBIN}/yarn-daemon.sh ] && ${HADOOP_SBIN}/yarn-daemon.sh stop nodemanager
+        [ -x ${HADOOP_SBIN}/hadoop-daemon.sh ] && ${HADOOP_SBIN}/hadoop-daemon.sh stop datanode
+        pkill -f deploy.worker.Worker
+        true"
+}
+
+# Runs the function for all hosts at once, failing if any of them failed
+for_all_hosts() {
+    func="$1"
+    shift
+    pids=""
+    for host in $HOSTS; do
+        $func "$host" "$@" &
+        pids="$pids $!"
+    done
+    status=0
+    for pid in $pids; do
+        wait $pid || status=1
+    done
+    return $status
+}
+
+case "$ACTION" in
+    join)
+        HOSTS="$@"
+        for f in $SLAVE_FILES; do
+            [ -f "$f" ] || continue
+            for host in $HOSTS; do
+                grep -qxF "$host" "$f" || echo "$host" >> "$f"
+            done
+        done
+        for_all_hosts join_slave
+        ;;
+    drain)
+        TIMEOUT="${1:?Please give the drain timeout in seconds}"
+        shift
+        HOSTS="$@"
+        # Keep the slaves out of any restart of the cluster
+        for f in $SLAVE_FILES; do
+            [ -f "$f" ] || continue
+            for host in $HOSTS; do
+                grep -vxF "$host" "$f" > "$f.tmp"
+                mv "$f.tmp" "$f"
+            done
+        done
+        for_all_hosts drain_slave $(( $(date +%s) + TIMEOUT ))
+        ;;
+    *)
+        echo "Unknown action: $ACTION"
+        exit 1
+        ;;
+esac
@@ -22,12 +22,14 @@
 from __future__ import with_statement
 
 import hashlib
+import json
 import logging
+import math
 import os
 import os.path
 import pipes
 import random
-import shutil
+import re
 import string
 from stat import S_IRUSR
 import subprocess
@@ -35,10 +37,13 @@ import sys
 import tarfile
 import tempfile
 import textwrap
+import threading
 import time
 import urllib2
 import warnings
 from datetime import datetime
+from io import BytesIO
+from multiprocessing.pool import ThreadPool
 from optparse import OptionParser
 from sys import stderr
 
@@ -78,17 +83,19 @@ class UsageError(Exception):
     pass
 
 
-# Configure and parse our command-line arguments
-def parse_args():
+# Configure and parse our command-line arguments, from sys.argv unless argv is
+# given (as when cluster.py uses this script as a library)
+def parse_args(argv=None):
     parser = OptionParser(
         prog="spark-ec2",
         version="%prog {v}".format(v=SPARK_EC2_VERSION),
         usage="%prog [options] <action> <cluster_name>\n\n"
-        + "<action> can be: launch, destroy, login, stop, start, get-master, reboot-slaves")
+        + "<action> can be: launch, destroy, login, stop, start, get-master, reboot-slaves, " +
+        "add-slaves, remove-slaves, delete-groups, bake-image")
 
     parser.add_option(
         "-s", "--slaves", type="int", default=1,
-        help="Number of slaves to launch (default: %default)")
+        help="Number of slaves to launch, add or remove (default: %default)")
     parser.add_option(
         "-w", "--wait", type="int",
         help="DEPRECATED (no longer necessary) - Seconds to wait for nodes to start")
@@ -110,8 +117,8 @@ def parse_args():
         help="EC2 region zone to launch instances in")
     parser.add_option(
         "-z", "--zone", default="",
-        help="Availability zone to launch instances in, or 'all' to spread " +
-             "slaves across multiple (an additional $0.01/Gb for bandwidth" +
+        help="Availability zone to launch instances in, a comma separated list of zones or " +
+             "'all' to spread slaves across multiple (an additional $0.01/Gb for bandwidth" +
              "between zones applies) (default: a single zone chosen at random)")
     parser.add_option(
         "-a", "--ami",
@@ -142,8 +149,8 @@ def parse_args():
              "the given local address (for use with login)")
     parser.add_option(
         "--resume", action="store_true", default=False,
-        help="Resume installation on a previously launched cluster " +
-             "(for debugging)")
+        help="Resume installation on a previously launched cluster, " +
+             "skipping the setup phases that already completed on it")
     parser.add_option(
         "--ebs-vol-size", metavar="SIZE", type="int", default=0,
         help="Size (in GB) of each EBS volume.")
@@ -181,7 +188,14 @@ def parse_args():
         help="The SSH user you want to connect as (default: %default)")
     parser.add_option(
         "--delete-groups", action="store_true", default=False,
-        help="When destroying a cluster, delete the security groups that were created")
+        help="When destroying a cluster or baking an image, delete the security groups that were created")
+    parser.add_option(
+        "--delete-groups-in-background", action="store_true", default=False,
+        help="When destroying a cluster with --delete-groups, return once the instances are " +
+             "terminating and delete the groups from a background process")
+    parser.add_option(
+        "--group-delete-timeout", type="int", default=600,
+        help="Seconds to keep trying to delete the security groups (default: %default)")
     parser.add_option(
         "--use-existing-master", action="store_true", default=False,
         help="Launch fresh slaves, but use an existing stopped master if possible")
@@ -216,8 +230,50 @@ def parse_args():
     parser.add_option(
         "--spot-timeout", type="int", default=45,
         help="Maximum amount of time (in minutes) to wait for spot requests to be fulfilled")
+    parser.add_option(
+        "--poll-interval", type="int", default=5,
+        help="Seconds between polls while waiting for the cluster state, growing " +
+             "with each poll up to --max-poll-interval (default: %default)")
+    parser.add_option(
+        "--max-poll-interval", type="int", default=15,
+        help="Maximum number of seconds between polls while waiting for the " +
+             "cluster state (default: %default)")
+    parser.add_option(
+        "--drain-timeout", type="int", default=600,
+        help="Seconds that remove-slaves waits for the running containers of the slaves " +
+             "before stopping them anyway (default: %default)")
+    parser.add_option(
+        "--resolution-cache-ttl", type="int", default=86400,
+        help="Seconds during which resolved AMIs and validated Spark versions are reused " +
+             "(default: %default)")
+    parser.add_option(
+        "--no-baked-image", action="store_true", default=False,
+        help="Use the stock Spark AMI even if an image made by bake-image matches the cluster")
+    parser.add_option(
+        "--offline", action="store_true", default=False,
+        help="Resolve AMIs and Spark versions only from the local cache, whatever their age")
+    parser.add_option(
+        "--spot-partial-grace", type="int", default=120,
+        help="With --allow-partial-spot-grants, once --min-healthy-slaves-fraction of the spot " +
+             "slaves are granted, seconds to wait for the others before going on without them " +
+             "(default: %default)")
+    parser.add_option(
+        "--allow-partial-spot-grants", action="store_true", default=False,
+        help="Start the cluster once --min-healthy-slaves-fraction of the spot slaves are " +
+             "granted, instead of requesting them as an all or nothing launch group")
+    parser.add_option(
+        "--min-healthy-slaves-fraction", type="float", default=1.0,
+        help="Minimum fraction of slaves that must be granted and set up successfully; " +
+             "the slaves that fail are left out of the cluster (default: %default)")
+    parser.add_option(
+        "--ssh-control-dir", default=None,
+        help="Directory for the control sockets of persistent SSH connections, " +
+             "shared by all the SSH calls (default: open a new connection per call)")
+    parser.add_option(
+        "--ssh-concurrency", type="int", default=64,
+        help="Maximum number of hosts to contact over SSH at the same time (default: %default)")
 
-    (opts, args) = parser.parse_args()
+    (opts, args) = parser.parse_args(argv)
     if len(args) != 2:
         parser.print_help()
         sys.exit(1)
@@ -257,17 +313,84 @@ def check_if_http_resource_exists(resource):
         if response.getcode() == 200:
             return True
         else:
-            raise RuntimeError("Resource {resource} not found. Error: {code}".format(resource, response.getcode()))
+            raise RuntimeError("Resource {resource} not found. Error: {code}".format(
+                resource=resource, code=response.getcode()))
     except urllib2.HTTPError, e:
         print >> stderr, "Unable to check if HTTP resource {url} exists. Error: {code}".format(
             url=resource,
             code=e.code)
         return False
 
-def get_validate_spark_version(version, repo):
+# Where the results of slow lookups are kept between runs: resolved AMIs, rendered
+# deploy archives, and the EC2 queries of the ignition tools, which share these helpers
+CACHE_DIR = os.getenv("IGNITION_CACHE_DIR", os.path.expanduser("~/.cache/ignition"))
+
+
+def get_cache_path(name, key):
+    digest = hashlib.sha1(json.dumps(key, sort_keys=True)).hexdigest()[:16]
+    return os.path.join(CACHE_DIR, "{0}-{1}.json".format(name, digest))
+
+
+# Write data to path, which concurrent runs may be reading: the data goes to a
+# temporary file that is renamed over path, so they never read half a file
+def write_cache_file(path, data):
+    cache_dir = os.path.dirname(path)
+    if not os.path.exists(cache_dir):
+        os.makedirs(cache_dir)
+    fd, tmp_path = tempfile.mkstemp(dir=cache_dir, prefix="." + os.path.basename(path))
+    with os.fdopen(fd, "wb") as f:
+        f.write(data)
+    os.rename(tmp_path, path)
+
+
+# Return the value saved by save_cached under the same name and key, or None if
+# there is none or it is older than ttl_seconds (a negative ttl_seconds never expires)
+def load_cached(name, key, ttl_seconds):
+    try:
+        with open(get_cache_path(name, key)) as f:
+            entry = json.load(f)
+    except (IOError, ValueError):
+        return None
+    if entry.get("key") != key:
+        return None
+    if ttl_seconds >= 0 and time.time() - entry["timestamp"] > ttl_seconds:
+        return None
+    return entry["value"]
+
+
+def save_cached(name, key, value):
+    write_cache_file(get_cache_path(name, key),
+                     json.dumps({"key": key, "timestamp": time.time(), "value": value}))
+
+
+# Return the cached value of key, or None if it is missing or older than
+# --resolution-cache-ttl (the age doesn't matter with --offline)
+def get_cached_resolution(key, opts):
+    return load_cached("resolution", key, -1 if opts.offline else opts.resolution_cache_ttl)
+
+
+def save_resolution_cache(values):
+    for key, value in values.items():
+        save_cached("resolution", key, value)
+
+
+def check_if_cached_http_resource_exists(resource, opts):
+    key = "url:" + resource
+    if get_cached_resolution(key, opts):
+        return True
+    if opts.offline:
+        print >> stderr, "Offline, assuming that {url} exists".format(url=resource)
+        return True
+    exists = check_if_http_resource_exists(resource)
+    if exists:
+        save_resolution_cache({key: True})
+    return exists
+
+
+def get_validate_spark_version(version, repo, opts):
     if version.startswith("http"):
         #check if custom package URL exists
-        if check_if_http_resource_exists:
+        if check_if_cached_http_resource_exists(version, opts):
             return version
         else:
             print >> stderr, "Unable to validate pre-built spark version {version}".format(version=version)
@@ -280,7 +403,7 @@ def get_validate_spark_version(version, repo):
         return version
     else:
         github_commit_url = "{repo}/commit/{commit_hash}".format(repo=repo, commit_hash=version)
-        if not check_if_http_resource_exists(github_commit_url):
+        if not check_if_cached_http_resource_exists(github_commit_url, opts):
             print >> stderr, "Couldn't validate Spark commit: {repo} / {commit}".format(
                 repo=repo, commit=version)
             sys.exit(1)
@@ -288,13 +411,6 @@ def get_validate_spark_version(version, repo):
             return version
 
 
-# Check whether a given EC2 instance object is in a state we consider active,
-# i.e. not terminating or terminated. We count both stopping and stopped as
-# active since we can restart stopped clusters.
-def is_active(instance):
-    return (instance.state in ['pending', 'running', 'stopping', 'stopped'])
-
-
 # Source: http://aws.amazon.com/amazon-linux-ami/instance-type-matrix/
 # Last Updated: 2014-06-20
 # For easy maintainability, please keep this manually-inputted dictionary sorted by key.
@@ -345,7 +461,7 @@ EC2_INSTANCE_TYPES = {
 
 
 # Attempt to resolve an appropriate AMI given the architecture and region of the request.
-def get_spark_ami(instance_type, region, spark_ec2_git_repo, spark_ec2_git_branch):
+def get_spark_ami(instance_type, region, spark_ec2_git_repo, spark_ec2_git_branch, opts):
     if instance_type in EC2_INSTANCE_TYPES:
         instance_type = EC2_INSTANCE_TYPES[instance_type]
     else:
@@ -359,16 +475,77 @@ def get_spark_ami(instance_type, region, spark_ec2_git_repo, spark_ec2_git_branc
         b=spark_ec2_git_branch)
 
     ami_path = "%s/%s/%s" % (ami_prefix, region, instance_type)
-    try:
-        ami = urllib2.urlopen(ami_path).read().strip()
-        print "Spark AMI for %s: %s" % (instance_type, ami)
-    except:
+    ami = get_cached_resolution("ami:" + ami_path, opts)
+    if ami is None and not opts.offline:
+        ami = prefetch_spark_amis(ami_prefix).get(ami_path)
+    if ami is None:
         print >> stderr, "Could not resolve AMI at: " + ami_path
         sys.exit(1)
 
+    print "Spark AMI for %s: %s" % (instance_type, ami)
     return ami
 
 
+# Values of the virtualization-type filter of EC2 for EC2_INSTANCE_TYPES
+VIRTUALIZATION_TYPES = {"pvm": "paravirtual", "hvm": "hvm"}
+
+
+# Tags of the images made by bake-image, telling what was installed on them
+def get_baked_image_tags(opts):
+    return {
+        "spark_version": opts.spark_version,
+        "spark_git_repo": opts.spark_git_repo,
+        "hadoop_major_version": opts.hadoop_major_version,
+        "spark_ec2_modules": ",".join(get_modules(opts)),
+        "spark_ec2_git": "%s/tree/%s" % (opts.spark_ec2_git_repo, opts.spark_ec2_git_branch)
+    }
+
+
+# Return the newest image of ours baked for the same versions and modules as
+# the cluster and the virtualization type of instance_type, or None
+def find_baked_image(conn, opts, instance_type):
+    filters = dict(("tag:" + k, v) for (k, v) in get_baked_image_tags(opts).items())
+    filters["virtualization-type"] = VIRTUALIZATION_TYPES[EC2_INSTANCE_TYPES.get(instance_type, "pvm")]
+    filters["state"] = "available"
+    images = conn.get_all_images(owners=["self"], filters=filters)
+    if not images:
+        return None
+    return max(images, key=lambda image: image.creationDate).id
+
+
+# Return the AMI for instances of instance_type: a baked image if there is one,
+# so setup.sh finds the modules installed, or else the stock Spark AMI
+def get_cluster_ami(conn, opts, instance_type):
+    if not opts.no_baked_image:
+        ami = find_baked_image(conn, opts, instance_type)
+        if ami is not None:
+            print "Baked image for %s: %s" % (instance_type, ami)
+            return ami
+    return get_spark_ami(instance_type, opts.region, opts.spark_ec2_git_repo,
+                         opts.spark_ec2_git_branch, opts)
+
+
+# Fetch the AMIs of all the regions and virtualization types at once and
+# cache them, so the next launches don't need to go to GitHub.
+# Returns a dict from AMI path to AMI.
+def prefetch_spark_amis(ami_prefix):
+    paths = ["%s/%s/%s" % (ami_prefix, region.name, virtualization)
+             for region in ec2.regions()
+             for virtualization in sorted(set(EC2_INSTANCE_TYPES.values()))]
+
+    def fetch(path):
+        try:
+            return urllib2.urlopen(path, timeout=30).read().strip()
+        except Exception:
+            return None
+
+    amis = dict((path, ami) for path, ami in zip(paths, parallel_map(fetch, paths, len(paths)))
+                if ami)
+    if amis:
+        save_resolution_cache(dict(("ami:" + path, ami) for path, ami in amis.items()))
+    return amis
+
+
 # Launch a cluster of the given name, by setting up its security groups,
 # and then starting new instances in them.
 # Returns a tuple of EC2 reservation objects for the master and slaves
@@ -382,10 +559,7 @@ def launch_cluster(conn, opts, cluster_name):
         print >> stderr, "ERROR: Must provide a key pair name (-k) to use on instances."
         sys.exit(1)
 
-    user_data_content = None
-    if opts.user_data:
-        with open(opts.user_data) as user_data_file:
-            user_data_content = user_data_file.read()
+    user_data_content = read_user_data(opts)
 
     print "Setting up security groups..."
     if opts.security_group_prefix is None:
@@ -457,17 +631,12 @@ def launch_cluster(conn, opts, cluster_name):
 
     # Figure out Spark AMI
     if opts.ami is None:
-        opts.ami = get_spark_ami(opts.instance_type, opts.region, opts.spark_ec2_git_repo, opts.spark_ec2_git_branch)
+        opts.ami = get_cluster_ami(conn, opts, opts.instance_type)
 
     if opts.master_ami is None:
-        opts.master_ami = get_spark_ami(opts.master_instance_type, opts.region, opts.spark_ec2_git_repo, opts.spark_ec2_git_branch) 
-
-    # we use group ids to work around https://github.com/boto/boto/issues/350
-    additional_group_ids = []
-    if opts.additional_security_group:
-        additional_group_ids = [sg.id
-                                for sg in conn.get_all_security_groups()
-                                if opts.additional_security_group in (sg.name, sg.id)]
+        opts.master_ami = get_cluster_ami(conn, opts, opts.master_instance_type or opts.instance_type)
+
+    additional_group_ids = get_additional_group_ids(conn, opts)
     print "Launching instances..."
 
     try:
@@ -482,109 +651,10 @@ def launch_cluster(conn, opts, cluster_name):
         print >> stderr, "Could not find AMI " + opts.master_ami
         sys.exit(1)
 
-    # Create block device mapping so that we can add EBS volumes if asked to.
-    # The first drive is attached as /dev/sds, 2nd as /dev/sdt, ... /dev/sdz
-    block_map = BlockDeviceMapping()
-    if opts.ebs_vol_size > 0:
-        for i in range(opts.ebs_vol_num):
-            device = EBSBlockDeviceType()
-            device.size = opts.ebs_vol_size
-            device.volume_type = opts.ebs_vol_type
-            device.delete_on_termination = True
-            block_map["/dev/sd" + chr(ord('s') + i)] = device
+    block_map = get_block_device_map(opts)
 
-    for i in range(get_num_disks(opts.instance_type)):
-        dev = BlockDeviceType()
-        dev.ephemeral_name = 'ephemeral%d' % i
-        name = '/dev/xvd' + string.letters[i + 1]
-        block_map[name] = dev
-
-    # Launch slaves
-    if opts.spot_price is not None:
-        # Launch spot instances with the requested price
-        print ("Requesting %d slaves as spot instances with price $%.3f" %
-               (opts.slaves, opts.spot_price))
-        zones = get_zones(conn, opts)
-        num_zones = len(zones)
-        i = 0
-        my_req_ids = []
-        for zone in zones:
-            num_slaves_this_zone = get_partition(opts.slaves, num_zones, i)
-            slave_reqs = conn.request_spot_instances(
-                price=opts.spot_price,
-                image_id=opts.ami,
-                launch_group="launch-group-%s" % cluster_name,
-                placement=zone,
-                count=num_slaves_this_zone,
-                key_name=opts.key_pair,
-                security_group_ids=[slave_group.id] + additional_group_ids,
-                instance_type=opts.instance_type,
-                block_device_map=block_map,
-                subnet_id=opts.subnet_id,
-                placement_group=opts.placement_group,
-                user_data=user_data_content)
-            my_req_ids += [req.id for req in slave_reqs]
-            i += 1
-
-        start_time = datetime.now()
-        print "Waiting for spot instances to be granted... Request IDs: %s " % my_req_ids
-        try:
-            while True:
-                time.sleep(10)
-                reqs = conn.get_all_spot_instance_requests(my_req_ids)
-                active_instance_ids = filter(lambda req: req.state == "active", reqs)
-                invalid_states = ["capacity-not-available", "capacity-oversubscribed", "price-too-low"]
-                invalid = filter(lambda req: req.status.code in invalid_states, reqs)
-                if len(invalid) > 0:
-                    raise Exception("Invalid state for spot request: %s - status: %s" %
-                        (invalid[0].id, invalid[0].status.message))
-                if len(active_instance_ids) == opts.slaves:
-                    print "All %d slaves granted" % opts.slaves
-                    reservations = conn.get_all_reservations(active_instance_ids)
-                    slave_nodes = []
-                    for r in reservations:
-                        slave_nodes += r.instances
-                    break
-                else:
-                    print "%d of %d slaves granted, waiting longer" % (
-                        len(active_instance_ids), opts.slaves)
-
-                if (datetime.now() - start_time).seconds > opts.spot_timeout * 60:
-                    raise Exception("Timed out while waiting for spot instances")
-        except:
-            print "Error: %s" % sys.exc_info()[1]
-            print "Canceling spot instance requests"
-            conn.cancel_spot_instance_requests(my_req_ids)
-            # Log a warning if any of these requests actually launched instances:
-            (master_nodes, slave_nodes) = get_existing_cluster(
-                conn, opts, cluster_name, die_on_error=False)
-            running = len(master_nodes) + len(slave_nodes)
-            if running:
-                print >> stderr, ("WARNING: %d instances are still running" % running)
-            sys.exit(0)
-    else:
-        # Launch non-spot instances
-        zones = get_zones(conn, opts)
-        num_zones = len(zones)
-        i = 0
-        slave_nodes = []
-        for zone in zones:
-            num_slaves_this_zone = get_partition(opts.slaves, num_zones, i)
-            if num_slaves_this_zone > 0:
-                slave_res = image.run(key_name=opts.key_pair,
-                                      security_group_ids=[slave_group.id] + additional_group_ids,
-                                      instance_type=opts.instance_type,
-                                      placement=zone,
-                                      min_count=num_slaves_this_zone,
-                                      max_count=num_slaves_this_zone,
-                                      block_device_map=block_map,
-                                      subnet_id=opts.subnet_id,
-                                      placement_group=opts.placement_group,
-                                      user_data=user_data_content)
-                slave_nodes += slave_res.instances
-                print "Launched %d slaves in %s, regid = %s" % (num_slaves_this_zone,
-                                                                zone, slave_res.id)
-            i += 1
+    slave_nodes = launch_slaves(conn, opts, cluster_name, image, slave_group, additional_group_ids,
+                                block_map, user_data_content, opts.slaves)
 
     # Launch or resume masters
     if existing_masters:
@@ -599,6 +669,8 @@ def launch_cluster(conn, opts, cluster_name):
             master_type = opts.instance_type
         if opts.zone == 'all':
             opts.zone = random.choice(conn.get_all_zones()).name
+        elif ',' in opts.zone:
+            opts.zone = opts.zone.split(',')[0]
         master_res = master_image.run(key_name=opts.key_pair,
                                security_group_ids=[master_group.id] + additional_group_ids,
                                instance_type=master_type,
@@ -611,7 +683,7 @@ def launch_cluster(conn, opts, cluster_name):
                                user_data=user_data_content)
 
         master_nodes = master_res.instances
-        print "Launched master in %s, regid = %s" % (zone, master_res.id)
+        print "Launched master in %s, regid = %s" % (opts.zone, master_res.id)
 
     # This wait time corresponds to SPARK-4983
     print "Waiting for AWS to propagate instance metadata..."
@@ -621,30 +693,260 @@ def launch_cluster(conn, opts, cluster_name):
         master.add_tag(
             key='Name',
             value='{cn}-master-{iid}'.format(cn=cluster_name, iid=master.id))
+    name_slaves(slave_nodes, cluster_name)
+
+    # Return all the instances
+    return (master_nodes, slave_nodes)
+
+
+def read_user_data(opts):
+    if opts.user_data:
+        with open(opts.user_data) as user_data_file:
+            return user_data_file.read()
+    return None
+
+
+# We use group ids to work around https://github.com/boto/boto/issues/350
+def get_additional_group_ids(conn, opts):
+    if not opts.additional_security_group:
+        return []
+    return [sg.id
+            for sg in conn.get_all_security_groups()
+            if opts.additional_security_group in (sg.name, sg.id)]
+
+
+# Create block device mapping so that we can add EBS volumes if asked to.
+# The first drive is attached as /dev/sds, 2nd as /dev/sdt, ... /dev/sdz
+def get_block_device_map(opts):
+    block_map = BlockDeviceMapping()
+    if opts.ebs_vol_size > 0:
+        for i in range(opts.ebs_vol_num):
+            device = EBSBlockDeviceType()
+            device.size = opts.ebs_vol_size
+            device.volume_type = opts.ebs_vol_type
+            device.delete_on_termination = True
+            block_map["/dev/sd" + chr(ord('s') + i)] = device
+
+    for i in range(get_num_disks(opts.instance_type)):
+        dev = BlockDeviceType()
+        dev.ephemeral_name = 'ephemeral%d' % i
+        name = '/dev/xvd' + string.letters[i + 1]
+        block_map[name] = dev
+    return block_map
+
+
+# Launch num_slaves slaves in the zones of opts, as spot instances if
+# --spot-price is given
+def launch_slaves(conn, opts, cluster_name, image, slave_group, additional_group_ids,
+                  block_map, user_data_content, num_slaves):
+    if opts.spot_price is not None:
+        # Launch spot instances with the requested price
+        print ("Requesting %d slaves as spot instances with price $%.3f" %
+               (num_slaves, opts.spot_price))
+        launch_spec = dict(
+            image_id=opts.ami,
+            key_name=opts.key_pair,
+            security_group_ids=[slave_group.id] + additional_group_ids,
+            instance_type=opts.instance_type,
+            block_device_map=block_map,
+            subnet_id=opts.subnet_id,
+            placement_group=opts.placement_group,
+            user_data=user_data_content)
+        # A launch group is all or nothing, which rules out partial grants
+        if not opts.allow_partial_spot_grants:
+            launch_spec['launch_group'] = "launch-group-%s" % cluster_name
+        return acquire_spot_slaves(conn, opts, cluster_name, get_zones(conn, opts), launch_spec,
+                                   num_slaves)
+
+    # Launch non-spot instances
+    zones = get_zones(conn, opts)
+    num_zones = len(zones)
+    i = 0
+    slave_nodes = []
+    for zone in zones:
+        num_slaves_this_zone = get_partition(num_slaves, num_zones, i)
+        if num_slaves_this_zone > 0:
+            slave_res = image.run(key_name=opts.key_pair,
+                                  security_group_ids=[slave_group.id] + additional_group_ids,
+                                  instance_type=opts.instance_type,
+                                  placement=zone,
+                                  min_count=num_slaves_this_zone,
+                                  max_count=num_slaves_this_zone,
+                                  block_device_map=block_map,
+                                  subnet_id=opts.subnet_id,
+                                  placement_group=opts.placement_group,
+                                  user_data=user_data_content)
+            slave_nodes += slave_res.instances
+            print "Launched %d slaves in %s, regid = %s" % (num_slaves_this_zone,
+                                                            zone, slave_res.id)
+        i += 1
+    return slave_nodes
+
+
+def name_slaves(slave_nodes, cluster_name):
     for slave in slave_nodes:
         slave.add_tag(
             key='Name',
             value='{cn}-slave-{iid}'.format(cn=cluster_name, iid=slave.id))
 
-    # Return all the instances
-    return (master_nodes, slave_nodes)
+
+# Yield the reservations matching the given filters, fetching them from EC2
+# one page at a time
+def iter_reservations(conn, filters, page_size=1000):
+    next_token = None
+    while True:
+        page = conn.get_all_reservations(filters=filters, max_results=page_size,
+                                         next_token=next_token)
+        for res in page:
+            yield res
+        next_token = getattr(page, 'next_token', None)
+        if not next_token:
+            break
+
+
+# Spot request status codes meaning that the request won't be fulfilled soon
+SPOT_FAILED_STATUS_CODES = ["capacity-not-available", "capacity-oversubscribed", "price-too-low"]
+
+
+def acquire_spot_slaves(conn, opts, cluster_name, zones, launch_spec, num_slaves):
+    """
+    Request num_slaves spot instances spread across the given zones and wait
+    for them to be granted. Returns the list of granted instances.
+
+    Requests that a zone fails to fulfill (price too low, no capacity) are
+    cancelled and their capacity is requested again in the zones that haven't
+    failed in that round. With --allow-partial-spot-grants, once
+    --min-healthy-slaves-fraction of the slaves are granted, the rest get at
+    most --spot-partial-grace more seconds before being cancelled, so the
+    cluster can start with what was granted.
+    """
+    zone_of_request = {}
+    requested_at = {}
+    granted = {}  # request id -> instance id
+    grant_latencies = {}  # zone -> list of seconds
+
+    def request(zone, count):
+        reqs = conn.request_spot_instances(price=opts.spot_price, placement=zone,
+                                           count=count, **launch_spec)
+        for req in reqs:
+            zone_of_request[req.id] = zone
+            requested_at[req.id] = datetime.now()
+
+    for i, zone in enumerate(zones):
+        num_slaves_this_zone = get_partition(num_slaves, len(zones), i)
+        if num_slaves_this_zone > 0:
+            request(zone, num_slaves_this_zone)
+
+    if opts.allow_partial_spot_grants:
+        min_granted = int(math.ceil(num_slaves * opts.min_healthy_slaves_fraction))
+    else:
+        min_granted = num_slaves
+    start_time = datetime.now()
+    partial_grant_time = None
+    print "Waiting for spot instances to be granted... Request IDs: %s " % zone_of_request.keys()
+    try:
+        while True:
+            time.sleep(10)
+            pending_ids = [r for r in zone_of_request if r not in granted]
+            reqs = conn.get_all_spot_instance_requests(pending_ids) if pending_ids else []
+            now = datetime.now()
+            failed = []
+            for req in reqs:
+                if req.state == "active":
+                    granted[req.id] = req.instance_id
+                    grant_latencies.setdefault(zone_of_request[req.id], []).append(
+                        (now - requested_at[req.id]).seconds)
+                elif req.status.code in SPOT_FAILED_STATUS_CODES or \
+                        req.state in ["cancelled", "failed", "closed"]:
+                    failed.append(req)
+
+            if failed:
+                conn.cancel_spot_instance_requests([req.id for req in failed])
+                # Only this round's failures are avoided, capacity errors are often transient
+                failed_zones = set()
+                for req in failed:
+                    print "Spot request %s failed in %s: %s" % (
+                        req.id, zone_of_request[req.id], req.status.message)
+                    failed_zones.add(zone_of_request.pop(req.id))
+                healthy_zones = [z for z in zones if z not in failed_zones]
+                if healthy_zones:
+                    print "Requesting %d slaves again in %s" % (len(failed), ', '.join(healthy_zones))
+                    for i, zone in enumerate(healthy_zones):
+                        count = get_partition(len(failed), len(healthy_zones), i)
+                        if count > 0:
+                            request(zone, count)
+                if len(zone_of_request) < min_granted:
+                    raise Exception("Invalid state for spot request: %s - status: %s" %
+                                    (failed[0].id, failed[0].status.message))
+
+            if len(granted) >= num_slaves:
+                print "All %d slaves granted" % num_slaves
+                break
+            elif len(granted) >= min_granted:
+                partial_grant_time = partial_grant_time or now
+                if (now - partial_grant_time).seconds >= opts.spot_partial_grace:
+                    print "Going on with %d of %d slaves granted" % (len(granted), num_slaves)
+                    pending_ids = [r for r in zone_of_request if r not in granted]
+                    conn.cancel_spot_instance_requests(pending_ids)
+                    # Keep the instances granted right before the cancellation
+                    for req in conn.get_all_spot_instance_requests(pending_ids):
+                        if req.instance_id:
+                            granted[req.id] = req.instance_id
+                    break
+            print "%d of %d slaves granted, waiting longer" % (len(granted), num_slaves)
+
+            if (now - start_time).seconds > opts.spot_timeout * 60:
+                raise Exception("Timed out while waiting for spot instances")
+    except:
+        print "Error: %s" % sys.exc_info()[1]
+        print "Canceling spot instance requests"
+        conn.cancel_spot_instance_requests(zone_of_request.keys())
+        # Log a warning if any of these requests actually launched instances:
+        (master_nodes, slave_nodes) = get_existing_cluster(
+            conn, opts, cluster_name, die_on_error=False)
+        running = len(master_nodes) + len(slave_nodes)
+        if running:
+            print >> stderr, ("WARNING: %d instances are still running" % running)
+        sys.exit(0)
+
+    print "Spot grant latency per zone (seconds):"
+    for zone in sorted(grant_latencies):
+        latencies = grant_latencies[zone]
+        print "  {z}: {n} granted, average {a}, max {m}".format(
+            z=zone, n=len(latencies), a=sum(latencies) / len(latencies), m=max(latencies))
+
+    slave_nodes = []
+    for res in conn.get_all_reservations(instance_ids=granted.values()):
+        slave_nodes += res.instances
+    return slave_nodes
+
+
+# Instance states we consider active, i.e. not terminating or terminated. We
+# count both stopping and stopped as active since we can restart stopped clusters.
+ACTIVE_STATES = ['pending', 'running', 'stopping', 'stopped']
+
+
+# Get the instances in the security groups of a cluster that are in one of the
+# given states. EC2 does the filtering, instead of us scanning the region.
+def get_cluster_instances(conn, cluster_name, states=ACTIVE_STATES):
+    reservations = iter_reservations(conn, filters={
+        'instance.group-name': [cluster_name + "-master", cluster_name + "-slaves"],
+        'instance-state-name': states})
+    return [i for res in reservations for i in res.instances]
 
 
 # Get the EC2 instances in an existing cluster if available.
 # Returns a tuple of lists of EC2 instance objects for the masters and slaves
 def get_existing_cluster(conn, opts, cluster_name, die_on_error=True):
     print "Searching for existing cluster " + cluster_name + "..."
-    reservations = conn.get_all_reservations()
     master_nodes = []
     slave_nodes = []
-    for res in reservations:
-        active = [i for i in res.instances if is_active(i)]
-        for inst in active:
-            group_names = [g.name for g in inst.groups]
-            if (cluster_name + "-master") in group_names:
-                master_nodes.append(inst)
-            elif (cluster_name + "-slaves") in group_names:
-                slave_nodes.append(inst)
+    for inst in get_cluster_instances(conn, cluster_name):
+        group_names = [g.name for g in inst.groups]
+        if (cluster_name + "-master") in group_names:
+            master_nodes.append(inst)
+        elif (cluster_name + "-slaves") in group_names:
+            slave_nodes.append(inst)
     if any((master_nodes, slave_nodes)):
         print "Found %d master(s), %d slaves" % (len(master_nodes), len(slave_nodes))
     if master_nodes != [] or not die_on_error:
@@ -657,13 +959,289 @@ def get_existing_cluster(conn, opts, cluster_name, die_on_error=True):
         sys.exit(1)
 
 
+# Script run on the master to join new slaves to the cluster or drain the
+# slaves being removed (see resize-slaves.sh)
+RESIZE_SLAVES_SCRIPT = os.path.join(SPARK_EC2_DIR, "resize-slaves.sh")
+
+
+# Launch opts.slaves more slaves for a running cluster, with the same
+# block devices, user data and security groups as launch_cluster
+def add_slaves(conn, opts, cluster_name):
+    (master_nodes, slave_nodes) = get_existing_cluster(conn, opts, cluster_name)
+    prefix = opts.security_group_prefix or cluster_name
+    slave_group = get_or_make_group(conn, prefix + "-slaves", opts.vpc_id)
+    if opts.ami is None:
+        opts.ami = get_cluster_ami(conn, opts, opts.instance_type)
+    try:
+        image = conn.get_all_images(image_ids=[opts.ami])[0]
+    except:
+        print >> stderr, "Could not find AMI " + opts.ami
+        sys.exit(1)
+    try:
+        new_slaves = launch_slaves(conn, opts, cluster_name, image, slave_group,
+                                   get_additional_group_ids(conn, opts),
+                                   get_block_device_map(opts), read_user_data(opts), opts.slaves)
+    except SystemExit:
+        # The spot requests were cancelled
+        new_slaves = []
+    if not new_slaves:
+        print >> stderr, "ERROR: Could not launch new slaves"
+        sys.exit(1)
+    # This wait time corresponds to SPARK-4983
+    time.sleep(5)
+    name_slaves(new_slaves, cluster_name)
+    return (master_nodes, new_slaves)
+
+
+# Give the cluster's SSH key to the new slaves, copy the setup of the master
+# to them and start their daemons. New slaves that can't be reached are
+# terminated. Returns the slaves that joined.
+def join_slaves(conn, master_nodes, new_slaves, opts):
+    master = master_nodes[0].public_dns_name
+    dot_ssh_tar = ssh_read(master, opts, ['tar', 'c', '.ssh'])
+    print "Transferring cluster's SSH key to new slaves..."
+    failed_hosts = ssh_write_all([slave.public_dns_name for slave in new_slaves],
+                                 opts, ['tar', 'x'], dot_ssh_tar)
+    healthy = exclude_failed_slaves(conn, new_slaves, failed_hosts, opts)
+    print "Joining %d new slaves to the cluster..." % len(healthy)
+    with open(RESIZE_SLAVES_SCRIPT) as script:
+        ssh_write(master, opts, ['bash', '-s', 'join'] + [s.public_dns_name for s in healthy],
+                  script.read())
+    return healthy
+
+
+# Drain and terminate opts.slaves slaves of a running cluster, the most
+# recently launched first
+def remove_slaves(conn, opts, cluster_name):
+    (master_nodes, slave_nodes) = get_existing_cluster(conn, opts, cluster_name)
+    slave_nodes = sorted(slave_nodes, key=lambda s: s.launch_time, reverse=True)
+    removed = slave_nodes[:opts.slaves]
+    if not removed:
+        print "No slaves to remove"
+        return []
+    master = master_nodes[0].public_dns_name
+    print "Draining %d slaves..." % len(removed)
+    with open(RESIZE_SLAVES_SCRIPT) as script:
+        ssh_write(master, opts,
+                  ['bash', '-s', 'drain', str(opts.drain_timeout)] +
+                  [s.public_dns_name for s in removed],
+                  script.read())
+    print "Terminating drained slaves..."
+    for slave in removed:
+        print "> %s" % slave.public_dns_name
+        slave.terminate()
+    return removed
+
+
+# The instances of the cluster that are not terminated yet, including those
+# being terminated, which still hold on to the security groups
+def get_terminating_instances(conn, cluster_name):
+    return get_cluster_instances(conn, cluster_name, ACTIVE_STATES + ['shutting-down'])
+
+
+# Delete the security groups of a cluster once its instances are terminated.
+# The rules referencing other groups are revoked concurrently, then deleting
+# each group is retried while EC2 still reports it in use, polling with the
+# same backoff as wait_for_cluster_state. boto connections are not thread safe,
+# so the worker threads use connections of their own.
+def delete_cluster_groups(conn, opts, cluster_name, instances):
+    print "Deleting security groups..."
+    group_names = [cluster_name + "-master", cluster_name + "-slaves"]
+    if instances:
+        wait_for_cluster_state(
+            conn=conn,
+            opts=opts,
+            cluster_instances=instances,
+            cluster_state='terminated'
+        )
+    groups = [g for g in conn.get_all_security_groups(filters={'group-name': group_names})]
+
+    # Delete the rules between groups before deleting the groups to remove
+    # dependencies between them
+    revokes = [(group, rule, grant)
+               for group in groups
+               for rule in group.rules
+               for grant in rule.grants
+               if grant.group_id or grant.name]
+
+    local = threading.local()
+
+    def worker_conn():
+        if not hasattr(local, "conn"):
+            local.conn = ec2.connect_to_region(opts.region)
+        return local.conn
+
+    def revoke(item):
+        (group, rule, grant) = item
+        # Name the groups the way SecurityGroup.revoke does
+        if group.vpc_id:
+            group_args = dict(group_id=group.id, src_security_group_group_id=grant.group_id)
+        else:
+            group_args = dict(group_name=group.name, src_security_group_name=grant.name,
+                              src_security_group_owner_id=grant.owner_id)
+        try:
+            return worker_conn().revoke_security_group(ip_protocol=rule.ip_protocol,
+                                                       from_port=rule.from_port,
+                                                       to_port=rule.to_port,
+                                                       **group_args)
+        except boto.exception.EC2ResponseError as e:
+            print >> stderr, "Failed to revoke a rule of {g}: {e}".format(g=group.name, e=e.error_code)
+            return False
+
+    parallel_map(revoke, revokes, opts.ssh_concurrency)
+
+    def delete(group):
+        try:
+            worker_conn().delete_security_group(group_id=group.id)
+            print "Deleted security group " + group.name
+            return True
+        except boto.exception.EC2ResponseError as e:
+            if e.error_code == 'InvalidGroup.NotFound':
+                return True
+            if e.error_code != 'DependencyViolation':
+                print >> stderr, "Failed to delete security group {g}: {e}".format(
+                    g=group.name, e=e.error_code)
+            return False
+
+    start_time = time.time()
+    num_attempts = 0
+    while groups:
+        time.sleep(get_poll_delay(num_attempts, opts))
+        deleted = parallel_map(delete, groups, len(groups))
+        groups = [g for g, ok in zip(groups, deleted) if not ok]
+        num_attempts += 1
+        if groups and time.time() - start_time > opts.group_delete_timeout:
+            print >> stderr, "Failed to delete security groups {g} after {t} seconds.".format(
+                g=', '.join(g.name for g in groups), t=opts.group_delete_timeout)
+            print >> stderr, "Try re-running the delete-groups action in a few minutes."
+            sys.exit(1)
+
+
+# Run the delete-groups action in a detached process, logging to a file, so
+# destroy returns as soon as the instances are terminating
+def start_background_group_deletion(opts, cluster_name):
+    log_dir = os.path.join(os.path.expanduser("~"), ".spark-ec2", "logs")
+    if not os.path.exists(log_dir):
+        os.makedirs(log_dir)
+    log_file = os.path.join(log_dir, "delete-groups-%s.log" % cluster_name)
+    with open(log_file, "a") as log:
+        subprocess.Popen(
+            [sys.executable, os.path.join(SPARK_EC2_DIR, "spark_ec2.py"), "delete-groups", cluster_name,
+             "--region", opts.region,
+             "--group-delete-timeout", str(opts.group_delete_timeout)],
+            stdin=open(os.devnull), stdout=log, stderr=subprocess.STDOUT,
+            close_fds=True, preexec_fn=os.setsid)
+    print "Deleting security groups in the background, see " + log_file
+
+
+BAKE_IMAGE_SCRIPT = os.path.join(SPARK_EC2_DIR, "bake-image.sh")
+
+
+# Bake an image with the modules installed, for launches with the same
+# versions and modules to find with find_baked_image. An instance of the
+# stock Spark AMI is launched as the master of a cluster named image_name,
+# so destroy cleans it up if this fails midway, and terminated at the end.
+def bake_image(conn, opts, image_name):
+    if opts.identity_file is None or opts.key_pair is None:
+        print >> stderr, "ERROR: Must provide an identity file (-i) and a key pair (-k)."
+        sys.exit(1)
+
+    # Never leave credentials in the image
+    opts.copy_aws_credentials = False
+    base_ami = opts.ami or get_spark_ami(opts.instance_type, opts.region, opts.spark_ec2_git_repo,
+                                         opts.spark_ec2_git_branch, opts)
+
+    group = get_or_make_group(conn, image_name + "-master", opts.vpc_id)
+    if group.rules == []:  # Group was just now created
+        group.authorize('tcp', 22, 22, opts.authorized_address)
+    (existing_masters, existing_slaves) = get_existing_cluster(conn, opts, image_name,
+                                                               die_on_error=False)
+    if existing_masters or existing_slaves:
+        print >> stderr, "ERROR: There are already instances running in group %s" % group.name
+        sys.exit(1)
+
+    print "Launching an instance of %s to bake %s..." % (base_ami, image_name)
+    try:
+        base_image = conn.get_all_images(image_ids=[base_ami])[0]
+    except:
+        print >> stderr, "Could not find AMI " + base_ami
+        sys.exit(1)
+    res = base_image.run(key_name=opts.key_pair,
+                         security_group_ids=[group.id] + get_additional_group_ids(conn, opts),
+                         instance_type=opts.instance_type,
+                         placement=random.choice(get_zones(conn, opts)),
+                         subnet_id=opts.subnet_id,
+                         user_data=read_user_data(opts))
+    instance = res.instances[0]
+    try:
+        # This wait time corresponds to SPARK-4983
+        time.sleep(5)
+        instance.add_tag(key='Name', value='{n}-bake-{iid}'.format(n=image_name, iid=instance.id))
+        wait_for_cluster_state(
+            conn=conn,
+            opts=opts,
+            cluster_instances=[instance],
+            cluster_state='ssh-ready'
+        )
+        host = instance.public_dns_name
+
+        print "Cloning spark-ec2 scripts from {r}/tree/{b}...".format(
+            r=opts.spark_ec2_git_repo, b=opts.spark_ec2_git_branch)
+        ssh(host, opts, "rm -rf spark-ec2 && git clone {r} -b {b} spark-ec2".format(
+            r=opts.spark_ec2_git_repo, b=opts.spark_ec2_git_branch))
+        deploy_files(
+            conn=conn,
+            root_dir=SPARK_EC2_DIR + "/" + "deploy.generic",
+            opts=opts,
+            master_nodes=[instance],
+            slave_nodes=[],
+            modules=get_modules(opts)
+        )
+        print "Installing modules..."
+        with open(BAKE_IMAGE_SCRIPT) as script:
+            ssh_write(host, opts, ['bash', '-s'], script.read())
+
+        print "Creating image %s..." % image_name
+        image_id = conn.create_image(instance.id, image_name,
+                                     description="Spark %s, Hadoop %s: %s" % (
+                                         opts.spark_version, opts.hadoop_major_version,
+                                         " ".join(get_modules(opts))))
+        conn.create_tags([image_id], get_baked_image_tags(opts))
+        num_attempts = 0
+        while True:
+            time.sleep(get_poll_delay(num_attempts, opts))
+            state = conn.get_all_images(image_ids=[image_id])[0].state
+            if state == "available":
+                break
+            if state == "failed":
+                print >> stderr, "ERROR: Creating image %s failed" % image_id
+                sys.exit(1)
+            num_attempts += 1
+        print "Baked image %s" % image_id
+    finally:
+        print "Terminating %s..." % instance.id
+        instance.terminate()
+        if opts.delete_groups:
+            delete_cluster_groups(conn, opts, image_name, [instance])
+
+
 # Deploy configuration files and run setup scripts on a newly launched
 # or started EC2 cluster.
 
 
 def setup_cluster(conn, master_nodes, slave_nodes, opts, deploy_ssh_key):
     master = master_nodes[0].public_dns_name
-    if deploy_ssh_key:
+    checkpoint_file = get_checkpoint_file(master_nodes)
+    checkpoints = load_checkpoints(master, opts, checkpoint_file) if opts.resume else {}
+    # Keep out the slaves that failed in a previous try, which may still be shutting down
+    slave_nodes = [s for s in slave_nodes if s.id not in checkpoints.get("excluded", [])]
+    if checkpoints and sorted(checkpoints.get("slaves", [])) != sorted(s.id for s in slave_nodes):
+        print "Slaves changed since the previous try, setting up from the start"
+        checkpoints = {"excluded": checkpoints.get("excluded", [])}
+    checkpoints["slaves"] = [s.id for s in slave_nodes]
+    if deploy_ssh_key and "ssh-key" in checkpoints:
+        print "Cluster's SSH key already set up, skipping"
+    elif deploy_ssh_key:
         print "Generating cluster's SSH key on master..."
         key_setup = """
           [ -f ~/.ssh/id_rsa ] ||
@@ -673,10 +1251,87 @@ def setup_cluster(conn, master_nodes, slave_nodes, opts, deploy_ssh_key):
         ssh(master, opts, key_setup)
         dot_ssh_tar = ssh_read(master, opts, ['tar', 'c', '.ssh'])
         print "Transferring cluster's SSH key to slaves..."
-        for slave in slave_nodes:
-            print slave.public_dns_name
-            ssh_write(slave.public_dns_name, opts, ['tar', 'x'], dot_ssh_tar)
+        failed_hosts = ssh_write_all([slave.public_dns_name for slave in slave_nodes],
+                                     opts, ['tar', 'x'], dot_ssh_tar)
+        healthy = exclude_failed_slaves(conn, slave_nodes, failed_hosts, opts)
+        checkpoints["excluded"] = checkpoints.get("excluded", []) + [
+            s.id for s in slave_nodes if s not in healthy]
+        checkpoints["slaves"] = [s.id for s in healthy]
+        slave_nodes = healthy
+        save_checkpoint(master, opts, checkpoint_file, checkpoints, "ssh-key")
 
+    modules = get_modules(opts)
+
+    # NOTE: We should clone the repository before running deploy_files to
+    # prevent ec2-variables.sh from being overwritten
+    if "clone" in checkpoints:
+        print "spark-ec2 scripts already cloned on master, skipping"
+    else:
+        print "Cloning spark-ec2 scripts from {r}/tree/{b} on master...".format(
+            r=opts.spark_ec2_git_repo, b=opts.spark_ec2_git_branch)
+        ssh(
+            host=master,
+            opts=opts,
+            command="rm -rf spark-ec2"
+            + " && "
+            + "git clone {r} -b {b} spark-ec2".format(r=opts.spark_ec2_git_repo,
+                                                      b=opts.spark_ec2_git_branch)
+        )
+        save_checkpoint(master, opts, checkpoint_file, checkpoints, "clone")
+
+    if "deploy" in checkpoints:
+        print "Files already deployed to master, skipping"
+    else:
+        print "Deploying files to master..."
+        deploy_files(
+            conn=conn,
+            root_dir=SPARK_EC2_DIR + "/" + "deploy.generic",
+            opts=opts,
+            master_nodes=master_nodes,
+            slave_nodes=slave_nodes,
+            modules=modules
+        )
+        save_checkpoint(master, opts, checkpoint_file, checkpoints, "deploy")
+
+    if "setup" in checkpoints:
+        print "Setup already done on master, skipping"
+    else:
+        print "Running setup on master..."
+        setup_spark_cluster(master, opts)
+        save_checkpoint(master, opts, checkpoint_file, checkpoints, "setup")
+    print "Done!"
+
+
+# The phases of setup_cluster that completed are recorded on the master, next
+# to the /tmp/cluster_args.json saved by cluster.py, so that --resume only
+# redoes the phase that failed. The file is named after the master instance and
+# holds the ids of the slaves set up and of those excluded because they failed:
+# the excluded slaves stay out, and any other change of slaves starts over.
+CHECKPOINT_DIR = "/tmp/spark-ec2-checkpoints"
+
+
+def get_checkpoint_file(master_nodes):
+    return "%s/%s.json" % (CHECKPOINT_DIR, master_nodes[0].id)
+
+
+def load_checkpoints(master, opts, checkpoint_file):
+    output = ssh_read(master, opts, "cat %s 2> /dev/null || true" % checkpoint_file)
+    try:
+        return json.loads(output) if output.strip() else {}
+    except ValueError:
+        return {}
+
+
+def save_checkpoint(master, opts, checkpoint_file, checkpoints, phase):
+    checkpoints[phase] = True
+    ssh_write(master, opts,
+              "mkdir -p {d} && cat > {f}.tmp && mv {f}.tmp {f}".format(d=CHECKPOINT_DIR,
+                                                                      f=checkpoint_file),
+              json.dumps(checkpoints))
+
+
+# Modules set up by spark-ec2/setup.sh
+def get_modules(opts):
     modules = ['spark', 'ephemeral-hdfs', 'persistent-hdfs',
                'mapreduce', 'spark-standalone', 'tachyon']
 
@@ -685,33 +1340,31 @@ def setup_cluster(conn, master_nodes, slave_nodes, opts, deploy_ssh_key):
 
     if opts.ganglia:
         modules.append('ganglia')
-
-    # NOTE: We should clone the repository before running deploy_files to
-    # prevent ec2-variables.sh from being overwritten
-    print "Cloning spark-ec2 scripts from {r}/tree/{b} on master...".format(
-        r=opts.spark_ec2_git_repo, b=opts.spark_ec2_git_branch)
-    ssh(
-        host=master,
-        opts=opts,
-        command="rm -rf spark-ec2"
-        + " && "
-        + "git clone {r} -b {b} spark-ec2".format(r=opts.spark_ec2_git_repo,
-                                                  b=opts.spark_ec2_git_branch)
-    )
-
-    print "Deploying files to master..."
-    deploy_files(
-        conn=conn,
-        root_dir=SPARK_EC2_DIR + "/" + "deploy.generic",
-        opts=opts,
-        master_nodes=master_nodes,
-        slave_nodes=slave_nodes,
-        modules=modules
-    )
-
-    print "Running setup on master..."
-    setup_spark_cluster(master, opts)
-    print "Done!"
+    return modules
+
+
+# Leave out of the cluster the slaves in failed_hosts, as long as the fraction of
+# healthy slaves stays above --min-healthy-slaves-fraction. The failed slaves
+# are terminated, so they neither keep billing nor count as cluster members.
+def exclude_failed_slaves(conn, slave_nodes, failed_hosts, opts):
+    if not failed_hosts:
+        return slave_nodes
+    healthy = [s for s in slave_nodes if s.public_dns_name not in failed_hosts]
+    print >> stderr, "Failed to set up {f} of {t} slaves:".format(
+        f=len(failed_hosts), t=len(slave_nodes))
+    for host in failed_hosts:
+        print >> stderr, "> " + host
+    if float(len(healthy)) / len(slave_nodes) < opts.min_healthy_slaves_fraction:
+        raise RuntimeError("Only {h} of {t} slaves are healthy, below the minimum fraction of {m}".format(
+            h=len(healthy), t=len(slave_nodes), m=opts.min_healthy_slaves_fraction))
+    failed = [s for s in slave_nodes if s.public_dns_name in failed_hosts]
+    spot_request_ids = [s.spot_instance_request_id for s in failed if s.spot_instance_request_id]
+    if spot_request_ids:
+        conn.cancel_spot_instance_requests(spot_request_ids)
+    conn.terminate_instances(instance_ids=[s.id for s in failed])
+    print >> stderr, "Terminated {ids}, continuing without them".format(
+        ids=" ".join(s.id for s in failed))
+    return healthy
 
 
 def setup_spark_cluster(master, opts):
@@ -727,7 +1380,7 @@ def is_ssh_available(host, opts, print_ssh_output=True):
     """
     Check if SSH is available on a host.
     """
-    s = subprocess.Popen(
+    s = start_ssh_process(
         ssh_command(opts) + ['-t', '-t', '-o', 'ConnectTimeout=3',
                              '%s@%s' % (opts.user, host), stringify_command('true')],
         stdout=subprocess.PIPE,
@@ -751,15 +1404,71 @@ def is_ssh_available(host, opts, print_ssh_output=True):
     return s.returncode == 0
 
 
-def is_cluster_ssh_available(cluster_instances, opts):
+def is_cluster_ssh_available(cluster_instances, opts, ready_hosts=None):
     """
     Check if SSH is available on all the instances in a cluster.
+
+    Hosts are probed concurrently, up to opts.ssh_concurrency at a time.
+    ready_hosts, if given, is a dict of host -> datetime at which it was first
+    seen ready. Hosts already in it are not probed again and newly ready hosts
+    are added to it, so repeated calls only re-probe the stragglers.
     """
-    for i in cluster_instances:
-        if not is_ssh_available(host=i.ip_address, opts=opts):
-            return False
-    else:
-        return True
+    if ready_hosts is None:
+        ready_hosts = {}
+    pending = [i.ip_address for i in cluster_instances if i.ip_address not in ready_hosts]
+    if pending:
+        available = parallel_map(lambda host: is_ssh_available(host=host, opts=opts),
+                                 pending, opts.ssh_concurrency)
+        now = datetime.now()
+        for host, host_available in zip(pending, available):
+            if host_available:
+                ready_hosts[host] = now
+    return all(i.ip_address in ready_hosts for i in cluster_instances)
+
+
+def print_readiness_report(ready_times, start_time, num_buckets=10):
+    """
+    Print a histogram of how long the hosts took to become ready, followed by
+    the readiness latency of each host, slowest first.
+
+    ready_times: a dict of host -> datetime at which it was first seen ready
+    """
+    latencies = sorted(((t - start_time).seconds, host) for host, t in ready_times.items())
+    if not latencies:
+        return
+    bucket_width = max(1, (latencies[-1][0] + num_buckets) // num_buckets)
+    counts = [0] * num_buckets
+    for latency, host in latencies:
+        counts[min(latency // bucket_width, num_buckets - 1)] += 1
+    print "Time to ready (seconds):"
+    for bucket, count in enumerate(counts):
+        if count:
+            print "  {lo:>5}-{hi:<5} {bar} {c}".format(
+                lo=bucket * bucket_width, hi=(bucket + 1) * bucket_width,
+                bar="#" * int(round(40.0 * count / len(latencies))) or "#", c=count)
+    print "Readiness latency per host (seconds):"
+    for latency, host in reversed(latencies):
+        print "  {h}: {l}".format(h=host, l=latency)
+
+
+# Refresh the given instances in place with a single describe call, instead of
+# calling update() on each of them.
+def refresh_instances(conn, instances):
+    by_id = dict((i.id, i) for i in instances)
+    for res in conn.get_all_reservations(instance_ids=by_id.keys()):
+        for updated in res.instances:
+            if updated.id in by_id:
+                by_id[updated.id]._update(updated)
+
+
+# Seconds to sleep before the next poll of wait_for_cluster_state: grows with the
+# number of attempts but never beyond --max-poll-interval, with some jitter so
+# concurrent launches don't hit the EC2 API in lockstep.
+def get_poll_delay(num_attempts, opts):
+    if num_attempts == 0:
+        return 0
+    delay = min(opts.poll_interval * num_attempts, opts.max_poll_interval)
+    return delay * random.uniform(0.8, 1.2)
 
 
 def wait_for_cluster_state(conn, opts, cluster_instances, cluster_state):
@@ -771,6 +1480,9 @@ def wait_for_cluster_state(conn, opts, cluster_instances, cluster_state):
            value can be 'ssh-ready' or a valid value from boto.ec2.instance.InstanceState such as
            'running', 'terminated', etc.
            (would be nice to replace this with a proper enum: http://stackoverflow.com/a/1695250)
+
+    Instances are tracked individually: for 'ssh-ready', SSH is probed on each
+    instance as soon as EC2 reports it running with passing status checks.
     """
     sys.stdout.write(
         "Waiting for cluster to enter '{s}' state.".format(s=cluster_state)
@@ -779,23 +1491,29 @@ def wait_for_cluster_state(conn, opts, cluster_instances, cluster_state):
 
     start_time = datetime.now()
     num_attempts = 0
+    ready_times = {}
 
     while True:
-        time.sleep(5 * num_attempts)  # seconds
-
-        for i in cluster_instances:
-            i.update()
+        time.sleep(get_poll_delay(num_attempts, opts))
 
-        statuses = conn.get_all_instance_status(instance_ids=[i.id for i in cluster_instances])
+        refresh_instances(conn, cluster_instances)
 
         if cluster_state == 'ssh-ready':
-            if all(i.state == 'running' for i in cluster_instances) and \
-               all(s.system_status.status == 'ok' for s in statuses) and \
-               all(s.instance_status.status == 'ok' for s in statuses) and \
-               is_cluster_ssh_available(cluster_instances, opts):
+            statuses = conn.get_all_instance_status(instance_ids=[i.id for i in cluster_instances])
+            status_ok = set(s.id for s in statuses
+                            if s.system_status.status == 'ok' and
+                            s.instance_status.status == 'ok')
+            booted = [i for i in cluster_instances
+                      if i.state == 'running' and i.id in status_ok]
+            if is_cluster_ssh_available(booted, opts, ready_times) and \
+               len(booted) == len(cluster_instances):
                 break
         else:
-            if all(i.state == cluster_state for i in cluster_instances):
+            now = datetime.now()
+            for i in cluster_instances:
+                if i.state == cluster_state and i.id not in ready_times:
+                    ready_times[i.id] = now
+            if len(ready_times) == len(cluster_instances):
                 break
 
         num_attempts += 1
@@ -810,6 +1528,7 @@ def wait_for_cluster_state(conn, opts, cluster_instances, cluster_state):
         s=cluster_state,
         t=(end_time - start_time).seconds
     )
+    print_readiness_report(ready_times, start_time)
 
 
 # Get number of local disks available for a given EC2 instance type.
@@ -890,10 +1609,10 @@ def deploy_files(conn, root_dir, opts, master_nodes, slave_nodes, modules):
 
     if opts.spark_version.startswith("http"):
         # Custom pre-built spark package
-        spark_v = get_validate_spark_version(opts.spark_version, opts.spark_git_repo)
+        spark_v = get_validate_spark_version(opts.spark_version, opts.spark_git_repo, opts)
     elif "." in opts.spark_version:
         # Pre-built Spark deploy
-        spark_v = get_validate_spark_version(opts.spark_version, opts.spark_git_repo)
+        spark_v = get_validate_spark_version(opts.spark_version, opts.spark_git_repo, opts)
     else:
         # Spark-only custom deploy
         spark_v = "%s|%s" % (opts.spark_git_repo, opts.spark_version)
@@ -921,36 +1640,109 @@ def deploy_files(conn, root_dir, opts, master_nodes, slave_nodes, modules):
         template_vars["aws_access_key_id"] = ""
         template_vars["aws_secret_access_key"] = ""
 
-    # Create a temp directory in which we will place all the files to be
-    # deployed after we substitue template parameters in them
-    tmp_dir = tempfile.mkdtemp()
+    # Extract over / on the master, as the files in root_dir are laid out
+    tar_command = ['tar', 'x', '--no-same-owner', '--no-same-permissions', '-C', '/']
+    ssh_write(active_master, opts, tar_command, get_deploy_tar(root_dir, template_vars))
+
+
+# Matches the {{name}} placeholders in the files of deploy.generic
+TEMPLATE_VAR_RE = re.compile(r"\{\{(\w+)\}\}")
+
+# Rendered deploy.generic archives of previous runs (e.g. before --resume or start),
+# of which the most recently used DEPLOY_CACHE_MAX_FILES are kept
+DEPLOY_CACHE_DIR = os.path.join(CACHE_DIR, "deploy")
+DEPLOY_CACHE_MAX_FILES = 20
+
+
+def list_templates(root_dir):
+    templates = []
     for path, dirs, files in os.walk(root_dir):
         if path.find(".svn") == -1:
-            dest_dir = os.path.join('/', path[len(root_dir):])
-            local_dir = tmp_dir + dest_dir
-            if not os.path.exists(local_dir):
-                os.makedirs(local_dir)
             for filename in files:
                 if filename[0] not in '#.~' and filename[-1] != '~':
-                    dest_file = os.path.join(dest_dir, filename)
-                    local_file = tmp_dir + dest_file
-                    with open(os.path.join(path, filename)) as src:
-                        with open(local_file, "w") as dest:
-                            text = src.read()
-                            for key in template_vars:
-                                text = text.replace("{{" + key + "}}", template_vars[key])
-                            dest.write(text)
-                            dest.close()
-    # rsync the whole directory over to the master machine
-    command = [
-        'rsync', '-rv',
-        '-e', stringify_command(ssh_command(opts)),
-        "%s/" % tmp_dir,
-        "%s@%s:/" % (opts.user, active_master)
-    ]
-    subprocess.check_call(command)
-    # Remove the temp directory we created above
-    shutil.rmtree(tmp_dir)
+                    templates.append(os.path.join(path, filename))
+    return sorted(templates)
+
+
+# Split a template into literal text (even items) and variable names (odd
+# items), so that rendering it is a single pass over the parts
+def compile_template(text):
+    return TEMPLATE_VAR_RE.split(text)
+
+
+# Render the parts of a template into bytes. Values may be unicode, as boto
+# returns them (e.g. public_dns_name), and are encoded as UTF-8 so that they can
+# be joined with templates holding non-ASCII bytes.
+def render_template(parts, template_vars):
+    rendered = []
+    for i, part in enumerate(parts):
+        if i % 2 == 0:
+            rendered.append(part)
+        else:
+            # Unknown placeholders are left untouched
+            value = template_vars.get(part, "{{" + part + "}}")
+            rendered.append(value.encode("utf-8") if isinstance(value, unicode) else value)
+    return "".join(rendered)
+
+
+# Render all the templates under root_dir into an in-memory tar archive,
+# with paths relative to root_dir
+def render_deploy_tar(root_dir, template_vars):
+    archive = BytesIO()
+    tar = tarfile.open(fileobj=archive, mode="w")
+    for template in list_templates(root_dir):
+        with open(template, "rb") as src:
+            data = render_template(compile_template(src.read()), template_vars)
+        info = tarfile.TarInfo(os.path.relpath(template, root_dir))
+        info.size = len(data)
+        info.mode = os.stat(template).st_mode & 0777
+        info.mtime = int(time.time())
+        tar.addfile(info, BytesIO(data))
+    tar.close()
+    return archive.getvalue()
+
+
+# Return the archive of root_dir rendered with template_vars, reusing the one
+# rendered by a previous run from the same templates and variables.
+# Archives holding AWS credentials are never written to disk.
+def get_deploy_tar(root_dir, template_vars):
+    key = hashlib.sha1(json.dumps(sorted(template_vars.items())))
+    for template in list_templates(root_dir):
+        st = os.stat(template)
+        key.update("%s %d %d %d\n" % (os.path.relpath(template, root_dir), st.st_size,
+                                      st.st_mtime, st.st_mode))
+    cache_file = os.path.join(DEPLOY_CACHE_DIR, key.hexdigest() + ".tar")
+    try:
+        with open(cache_file, "rb") as f:
+            data = f.read()
+        # Mark it as recently used
+        os.utime(cache_file, None)
+        return data
+    except (IOError, OSError):
+        pass
+
+    data = render_deploy_tar(root_dir, template_vars)
+    if not template_vars.get("aws_secret_access_key"):
+        write_cache_file(cache_file, data)
+        evict_cache_files(DEPLOY_CACHE_DIR, ".tar", DEPLOY_CACHE_MAX_FILES)
+    return data
+
+
+# Remove the least recently used files ending with suffix in cache_dir,
+# keeping max_files of them
+def evict_cache_files(cache_dir, suffix, max_files):
+    files = []
+    for name in os.listdir(cache_dir):
+        if name.endswith(suffix):
+            try:
+                files.append((os.path.getmtime(os.path.join(cache_dir, name)), name))
+            except OSError:
+                pass  # removed by a concurrent run
+    for _, name in sorted(files, reverse=True)[max_files:]:
+        try:
+            os.remove(os.path.join(cache_dir, name))
+        except OSError:
+            pass
 
 
 def stringify_command(parts):
@@ -965,6 +1757,14 @@ def ssh_args(opts):
     parts += ['-o', 'UserKnownHostsFile=/dev/null']
     if opts.identity_file is not None:
         parts += ['-i', opts.identity_file]
+    # Drop connections to hosts that stop answering, which would otherwise hang
+    # the calls, and the parallel_map workers making them, forever
+    parts += ['-o', 'ServerAliveInterval=30', '-o', 'ServerAliveCountMax=4']
+    if opts.ssh_control_dir:
+        # Reuse one master connection per user@host:port, %C being a short hash of them
+        parts += ['-o', 'ControlMaster=auto',
+                  '-o', 'ControlPath=%s/%%C' % opts.ssh_control_dir,
+                  '-o', 'ControlPersist=600']
     return parts
 
 
@@ -972,15 +1772,60 @@ def ssh_command(opts):
     return ['ssh'] + ssh_args(opts)
 
 
+# The ssh processes started below, so that a caller running this script
+# in-process can kill them when it gives up on it
+SSH_PROCESSES = set()
+SSH_PROCESSES_LOCK = threading.Lock()
+SSH_PROCESSES_KILLED = threading.Event()
+
+
+# Start an ssh process, tracked until it exits. Once kill_ssh_processes was
+# called, the process is killed right away, so that parallel_map workers left
+# running by an interrupted call stop making remote calls.
+def start_ssh_process(*popenargs, **kwargs):
+    process = subprocess.Popen(*popenargs, **kwargs)
+    with SSH_PROCESSES_LOCK:
+        # returncode is set once the owner waited for it, polling here would race with it
+        SSH_PROCESSES.difference_update([p for p in SSH_PROCESSES if p.returncode is not None])
+        SSH_PROCESSES.add(process)
+        if SSH_PROCESSES_KILLED.is_set():
+            kill_process(process)
+    return process
+
+
+def kill_process(process):
+    try:
+        process.kill()
+    except OSError:
+        pass  # Already gone
+
+
+# Kill the ssh processes that are still running, and any started later on,
+# until resume_ssh_processes is called
+def kill_ssh_processes():
+    with SSH_PROCESSES_LOCK:
+        SSH_PROCESSES_KILLED.set()
+        for process in SSH_PROCESSES:
+            if process.returncode is None:
+                kill_process(process)
+
+
+def resume_ssh_processes():
+    SSH_PROCESSES_KILLED.clear()
+
+
 # Run a command on a host through ssh, retrying up to five times
 # and then throwing an exception if ssh continues to fail.
 def ssh(host, opts, command):
     tries = 0
     while True:
         try:
-            return subprocess.check_call(
-                ssh_command(opts) + ['-t', '-t', '%s@%s' % (opts.user, host),
-                                     stringify_command(command)])
+            args = ssh_command(opts) + ['-t', '-t', '%s@%s' % (opts.user, host),
+                                        stringify_command(command)]
+            returncode = start_ssh_process(args).wait()
+            if returncode:
+                raise subprocess.CalledProcessError(returncode, args)
+            return returncode
         except subprocess.CalledProcessError as e:
             if tries > 5:
                 # If this was an ssh failure, provide the user with hints.
@@ -1001,7 +1846,7 @@ def ssh(host, opts, command):
 def _check_output(*popenargs, **kwargs):
     if 'stdout' in kwargs:
         raise ValueError('stdout argument not allowed, it will be overridden.')
-    process = subprocess.Popen(stdout=subprocess.PIPE, *popenargs, **kwargs)
+    process = start_ssh_process(stdout=subprocess.PIPE, *popenargs, **kwargs)
     output, unused_err = process.communicate()
     retcode = process.poll()
     if retcode:
@@ -1017,19 +1862,23 @@ def ssh_read(host, opts, command):
         ssh_command(opts) + ['%s@%s' % (opts.user, host), stringify_command(command)])
 
 
+def ssh_write_once(host, opts, command, arguments):
+    proc = start_ssh_process(
+        ssh_command(opts) + ['%s@%s' % (opts.user, host), stringify_command(command)],
+        stdin=subprocess.PIPE)
+    proc.stdin.write(arguments)
+    proc.stdin.close()
+    return proc.wait()
+
+
 def ssh_write(host, opts, command, arguments):
     tries = 0
     while True:
-        proc = subprocess.Popen(
-            ssh_command(opts) + ['%s@%s' % (opts.user, host), stringify_command(command)],
-            stdin=subprocess.PIPE)
-        proc.stdin.write(arguments)
-        proc.stdin.close()
-        status = proc.wait()
+        status = ssh_write_once(host, opts, command, arguments)
         if status == 0:
             break
         elif tries > 5:
-            raise RuntimeError("ssh_write failed with error %s" % proc.returncode)
+            raise RuntimeError("ssh_write failed with error %s" % status)
         else:
             print >> stderr, \
                 "Error {0} while executing remote command, retrying after 30 seconds".format(status)
@@ -1037,12 +1886,51 @@ def ssh_write(host, opts, command, arguments):
             tries = tries + 1
 
 
-# Gets a list of zones to launch instances in
+# Write the same input to a command on many hosts at once, up to
+# opts.ssh_concurrency at a time. Hosts that fail are retried in later rounds,
+# so a failing host never holds back the others.
+# Returns the list of hosts that still failed after all the rounds.
+def ssh_write_all(hosts, opts, command, arguments, rounds=7, retry_delay=10):
+    pending = list(hosts)
+    for attempt in range(rounds):
+        if attempt > 0:
+            print >> stderr, "Retrying remote command on {n} host(s) after {d} seconds: {h}".format(
+                n=len(pending), d=retry_delay, h=' '.join(pending))
+            time.sleep(retry_delay)
+        statuses = parallel_map(lambda host: ssh_write_once(host, opts, command, arguments),
+                                pending, opts.ssh_concurrency)
+        pending = [host for host, status in zip(pending, statuses) if status != 0]
+        if not pending:
+            break
+    return pending
+
+
+# Longer than any parallel_map call, which has to wait with a timeout
+PARALLEL_MAP_WAIT_SECONDS = 7 * 24 * 3600
+
+
+# Apply func to every item using a pool of at most max_workers threads,
+# returning the results in the same order as the items.
+# Unlike map, waiting with a timeout lets signal handlers run in the calling
+# thread, so a SIGALRM timeout or a Ctrl-C doesn't wait for a hung worker.
+# The pool is then terminated without joining the workers, which are left
+# to finish in the background.
+def parallel_map(func, items, max_workers):
+    if not items:
+        return []
+    pool = ThreadPool(max(1, min(max_workers, len(items))))
+    try:
+        return pool.map_async(func, items).get(PARALLEL_MAP_WAIT_SECONDS)
+    finally:
+        pool.terminate()
+
+
+# Gets a list of zones to launch instances in, all of them when none was given
 def get_zones(conn, opts):
-    if opts.zone == 'all':
+    if opts.zone in ('all', ''):
         zones = [z.name for z in conn.get_all_zones()]
     else:
-        zones = [opts.zone]
+        zones = opts.zone.split(',')
     return zones
 
 
@@ -1054,11 +1942,9 @@ def get_partition(total, num_partitions, current_partitions):
     return num_slaves_this_zone
 
 
-def real_main():
-    (opts, action, cluster_name) = parse_args()
-
-    # Input parameter validation
-    get_validate_spark_version(opts.spark_version, opts.spark_git_repo)
+# Check the options shared by all actions, exiting on invalid ones
+def validate_opts(opts):
+    get_validate_spark_version(opts.spark_version, opts.spark_git_repo, opts)
 
     if opts.wait is not None:
         # NOTE: DeprecationWarnings are silent in 2.7+ by default.
@@ -1107,12 +1993,33 @@ def real_main():
                          "Furthermore, we currently only support forks named spark-ec2."
         sys.exit(1)
 
-    try:
-        conn = ec2.connect_to_region(opts.region)
-    except Exception as e:
-        print >> stderr, (e)
-        sys.exit(1)
 
+# Wait for the instances of a cluster to be reachable and set them up
+def setup(conn, opts, master_nodes, slave_nodes, deploy_ssh_key=True):
+    wait_for_cluster_state(
+        conn=conn,
+        opts=opts,
+        cluster_instances=(master_nodes + slave_nodes),
+        cluster_state='ssh-ready'
+    )
+    setup_cluster(conn, master_nodes, slave_nodes, opts, deploy_ssh_key)
+
+
+# Launch the instances of a new cluster and set them up
+def launch(conn, opts, cluster_name):
+    (master_nodes, slave_nodes) = launch_cluster(conn, opts, cluster_name)
+    setup(conn, opts, master_nodes, slave_nodes)
+
+
+# Set up the existing instances of a cluster whose launch failed midway
+def resume(conn, opts, cluster_name):
+    (master_nodes, slave_nodes) = get_existing_cluster(conn, opts, cluster_name)
+    setup(conn, opts, master_nodes, slave_nodes)
+
+
+# Run an action with an open connection. Failures exit through sys.exit, as
+# from the command line, so library callers should catch SystemExit.
+def run(conn, opts, action, cluster_name):
     # Select an AZ at random if it was not specified.
     if opts.zone == "":
         opts.zone = random.choice(conn.get_all_zones()).name
@@ -1122,16 +2029,9 @@ def real_main():
             print >> sys.stderr, "ERROR: You have to start at least 1 slave"
             sys.exit(1)
         if opts.resume:
-            (master_nodes, slave_nodes) = get_existing_cluster(conn, opts, cluster_name)
+            resume(conn, opts, cluster_name)
         else:
-            (master_nodes, slave_nodes) = launch_cluster(conn, opts, cluster_name)
-        wait_for_cluster_state(
-            conn=conn,
-            opts=opts,
-            cluster_instances=(master_nodes + slave_nodes),
-            cluster_state='ssh-ready'
-        )
-        setup_cluster(conn, master_nodes, slave_nodes, opts, True)
+            launch(conn, opts, cluster_name)
 
     elif action == "destroy":
         print "Are you sure you want to destroy the cluster %s?" % cluster_name
@@ -1152,52 +2052,16 @@ def real_main():
                 inst.terminate()
 
             # Delete security groups as well
-            if opts.delete_groups:
-                print "Deleting security groups (this will take some time)..."
-                group_names = [cluster_name + "-master", cluster_name + "-slaves"]
-                wait_for_cluster_state(
-                    conn=conn,
-                    opts=opts,
-                    cluster_instances=(master_nodes + slave_nodes),
-                    cluster_state='terminated'
-                )
-                attempt = 1
-                while attempt <= 3:
-                    print "Attempt %d" % attempt
-                    groups = [g for g in conn.get_all_security_groups() if g.name in group_names]
-                    success = True
-                    # Delete individual rules in all groups before deleting groups to
-                    # remove dependencies between them
-                    for group in groups:
-                        print "Deleting rules in security group " + group.name
-                        for rule in group.rules:
-                            for grant in rule.grants:
-                                success &= group.revoke(ip_protocol=rule.ip_protocol,
-                                                        from_port=rule.from_port,
-                                                        to_port=rule.to_port,
-                                                        src_group=grant)
-
-                    # Sleep for AWS eventual-consistency to catch up, and for instances
-                    # to terminate
-                    time.sleep(30)  # Yes, it does have to be this long :-(
-                    for group in groups:
-                        try:
-                            conn.delete_security_group(group.name)
-                            print "Deleted security group " + group.name
-                        except boto.exception.EC2ResponseError:
-                            success = False
-                            print "Failed to delete security group " + group.name
-
-                    # Unfortunately, group.revoke() returns True even if a rule was not
-                    # deleted, so this needs to be rerun if something fails
-                    if success:
-                        break
-
-                    attempt += 1
-
-                if not success:
-                    print "Failed to delete all security groups after 3 tries."
-                    print "Try re-running in a few minutes."
+            if opts.delete_groups and opts.delete_groups_in_background:
+                start_background_group_deletion(opts, cluster_name)
+            elif opts.delete_groups:
+                delete_cluster_groups(conn, opts, cluster_name, master_nodes + slave_nodes)
+
+    elif action == "bake-image":
+        bake_image(conn, opts, cluster_name)
+
+    elif action == "delete-groups":
+        delete_cluster_groups(conn, opts, cluster_name, get_terminating_instances(conn, cluster_name))
 
     elif action == "login":
         (master_nodes, slave_nodes) = get_existing_cluster(conn, opts, cluster_name)
@@ -1223,6 +2087,22 @@ def real_main():
                     print "Rebooting " + inst.id
                     inst.reboot()
 
+    elif action == "add-slaves":
+        if opts.slaves <= 0:
+            print >> sys.stderr, "ERROR: You have to add at least 1 slave"
+            sys.exit(1)
+        (master_nodes, new_slaves) = add_slaves(conn, opts, cluster_name)
+        wait_for_cluster_state(
+            conn=conn,
+            opts=opts,
+            cluster_instances=new_slaves,
+            cluster_state='ssh-ready'
+        )
+        join_slaves(conn, master_nodes, new_slaves, opts)
+
+    elif action == "remove-slaves":
+        remove_slaves(conn, opts, cluster_name)
+
     elif action == "get-master":
         (master_nodes, slave_nodes) = get_existing_cluster(conn, opts, cluster_name)
         print master_nodes[0].public_dns_name
@@ -1260,19 +2140,26 @@ def real_main():
         for inst in master_nodes:
             if inst.state not in ["shutting-down", "terminated"]:
                 inst.start()
-        wait_for_cluster_state(
-            conn=conn,
-            opts=opts,
-            cluster_instances=(master_nodes + slave_nodes),
-            cluster_state='ssh-ready'
-        )
-        setup_cluster(conn, master_nodes, slave_nodes, opts, False)
+        setup(conn, opts, master_nodes, slave_nodes, deploy_ssh_key=False)
 
     else:
         print >> stderr, "Invalid action: %s" % action
         sys.exit(1)
 
 
+def real_main():
+    (opts, action, cluster_name) = parse_args()
+    validate_opts(opts)
+
+    try:
+        conn = ec2.connect_to_region(opts.region)
+    except Exception as e:
+        print >> stderr, (e)
+        sys.exit(1)
+
+    run(conn, opts, action, cluster_name)
+
+
 def main():
     try:
         real_main()
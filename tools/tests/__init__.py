@@ -0,0 +1,8 @@
+# Run from tools/ with: python -m unittest discover -s tests -t .
+import os
+import sys
+
+tools_dir = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+for path in (tools_dir, os.path.join(tools_dir, 'spark-ec2')):
+    if path not in sys.path:
+        sys.path.insert(0, path)
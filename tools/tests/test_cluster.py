@@ -0,0 +1,400 @@
+import os
+import shutil
+import stat
+import sys
+import tempfile
+import threading
+import time
+import unittest
+from distutils.spawn import find_executable
+
+import cluster
+import spark_ec2
+import utils
+
+# Skips the options, refuses hosts named bad-* like an unreachable host would,
+# and runs the remote command locally
+FAKE_SSH = """#!/bin/bash
+while [[ $1 == -* ]]; do
+    case $1 in
+        -o|-i) shift 2;;
+        *) shift;;
+    esac
+done
+dest=$1
+shift
+case $dest in
+    *@bad-*) echo "ssh: connect to host ${dest#*@} port 22: Connection refused" >&2; exit 255;;
+esac
+exec sh -c "$*"
+"""
+
+# Expands the control path with the real ssh, without connecting, and acts as
+# the master connection the first time it is used
+MULTIPLEXING_SSH = """#!/bin/bash
+control_path=$(ssh -G "$@" 2>/dev/null | awk '$1 == "controlpath" {print $2}')
+if [[ -e $control_path ]]; then
+    echo "reused $control_path"
+else
+    touch "$control_path"
+    echo "master $control_path"
+fi
+"""
+
+
+def write_script(path, content):
+    with open(path, 'w') as f:
+        f.write(content)
+    os.chmod(path, stat.S_IRWXU)
+    return path
+
+
+class RemoteCommandsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.original = cluster.ssh_binary, utils.ssh_multiplexing
+        cluster.ssh_binary = write_script(os.path.join(self.tmp_dir, 'ssh'), FAKE_SSH)
+        utils.ssh_multiplexing = False
+
+    def tearDown(self):
+        cluster.ssh_binary, utils.ssh_multiplexing = self.original
+        shutil.rmtree(self.tmp_dir)
+
+    def test_results_keep_the_order_of_the_commands(self):
+        # The first command finishes last
+        commands = [['sleep 0.3; echo first'], ['sleep 0.1; echo second'], ['echo third']]
+        results = cluster.ssh_run_many('root', 'master', 'key.pem', commands, max_concurrency=3)
+        self.assertEqual([r.output for r in results], ['first\n', 'second\n', 'third\n'])
+        self.assertEqual([r.returncode for r in results], [0, 0, 0])
+
+    def test_failures_are_reported_per_host(self):
+        hosts = ['slave-1', 'bad-2', 'slave-3']
+        commands = [cluster.ssh_args('root', host, 'key.pem', args=['echo', 'ok'], allocate_terminal=False)
+                    for host in hosts]
+        results = utils.run_commands(commands, max_concurrency=2)
+        self.assertEqual([r.returncode for r in results], [0, 255, 0])
+        self.assertEqual(results[0].output, 'ok\n')
+        self.assertIn('bad-2', results[1].error)
+        self.assertRaises(cluster.subprocess.CalledProcessError, results[1].check_returncode)
+
+    def test_timed_out_command_does_not_hold_the_others(self):
+        commands = [['exec sleep 5'], ['echo done']]
+        results = cluster.ssh_run_many('root', 'master', 'key.pem', commands, timeout_seconds=0.5)
+        self.assertTrue(results[0].timed_out)
+        self.assertLess(results[0].elapsed, 3)
+        self.assertEqual(results[1].output, 'done\n')
+
+
+@unittest.skipUnless(find_executable('ssh'), 'needs ssh to expand the control path')
+class SshMultiplexingTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.original = cluster.ssh_binary, utils.ssh_multiplexing
+        cluster.ssh_binary = write_script(os.path.join(self.tmp_dir, 'ssh'), MULTIPLEXING_SSH)
+        utils.ssh_multiplexing = True
+
+    def tearDown(self):
+        cluster.ssh_binary, utils.ssh_multiplexing = self.original
+        utils.close_ssh_connections()
+        shutil.rmtree(self.tmp_dir)
+
+    def call(self, host):
+        return cluster.ssh_call('root', host, 'key.pem', args=['true'],
+                                allocate_terminal=False, get_output=True).split()
+
+    def test_commands_to_a_host_reuse_its_master_connection(self):
+        host = 'ec2-54-210-123-45.compute-1.amazonaws.com'
+        first = self.call(host)
+        second = self.call(host)
+        other = self.call('ip-10-0-1-2.ec2.internal')
+        self.assertEqual(first[0], 'master')
+        self.assertEqual(second, ['reused', first[1]])
+        self.assertEqual(other[0], 'master')
+        self.assertNotEqual(other[1], first[1])
+        self.assertEqual(os.path.dirname(first[1]), utils.get_ssh_control_dir())
+        # ssh binds a temporary name 17 bytes longer, within the 104 bytes of OS X
+        self.assertLess(len(first[1]) + 17, 104)
+
+
+class PoolReapTest(unittest.TestCase):
+
+    def setUp(self):
+        hours_ago = lambda hours: (cluster.datetime.utcnow() - cluster.timedelta(hours=hours)).strftime(
+            cluster.pool_time_format)
+        self.clusters = {
+            'pool-stuck': {'ignition_pool_state': 'busy', 'ignition_pool_since': hours_ago(30)},
+            'pool-running': {'ignition_pool_state': 'busy', 'ignition_pool_since': hours_ago(2)},
+            'pool-expired': {'ignition_pool_state': 'idle', 'ignition_pool_since': hours_ago(2)},
+        }
+        self.released = []
+        self.destroyed = []
+        self.original = (cluster.get_pool_clusters, cluster.release_pool_cluster,
+                         cluster.claim_pool_cluster, cluster.destroy)
+        cluster.get_pool_clusters = lambda pool_name, region, state=None: dict(
+            (c, tags) for c, tags in self.clusters.items() if tags['ignition_pool_state'] == state)
+        cluster.release_pool_cluster = lambda cluster_name, region: self.released.append(cluster_name)
+        cluster.claim_pool_cluster = lambda pool_name, cluster_name, state, region: True
+        cluster.destroy = lambda cluster_name, region: self.destroyed.append(cluster_name)
+
+    def tearDown(self):
+        (cluster.get_pool_clusters, cluster.release_pool_cluster,
+         cluster.claim_pool_cluster, cluster.destroy) = self.original
+
+    def test_releases_clusters_busy_for_too_long(self):
+        cluster.pool_reap('pool', region='test-region')
+        self.assertEqual(self.released, ['pool-stuck'])
+        self.assertEqual(self.destroyed, ['pool-expired'])
+
+
+class Ec2ScriptTimeoutsTest(unittest.TestCase):
+
+    def test_stuck_worker_fails_the_call_within_the_limit(self):
+        # Stands for an ssh call that never returns, released late enough
+        # to fail the test instead of hanging it
+        hung = threading.Event()
+        release = threading.Timer(15, hung.set)
+        release.start()
+
+        def work(i):
+            if i == 0:
+                hung.wait()
+            return i
+
+        begin = time.time()
+        try:
+            with self.assertRaises(utils.ProcessTimeoutException):
+                with cluster.ec2_script_timeouts(timeout_total_minutes=0.02, timeout_inactivity_minutes=0):
+                    spark_ec2.parallel_map(work, range(4), 4)
+        finally:
+            release.cancel()
+            hung.set()
+        self.assertLess(time.time() - begin, 5)
+
+
+    def test_ssh_processes_do_not_survive_the_timeout(self):
+        tmp_dir = tempfile.mkdtemp()
+        pid_file = os.path.join(tmp_dir, 'pids')
+        write_script(os.path.join(tmp_dir, 'ssh'), '#!/bin/bash\necho $$ >> {0}\nexec sleep 30\n'.format(pid_file))
+        path = os.environ['PATH']
+        os.environ['PATH'] = tmp_dir + os.pathsep + path
+        opts = SshOptions()
+        try:
+            with self.assertRaises(utils.ProcessTimeoutException):
+                with cluster.ec2_script_timeouts(timeout_total_minutes=0.02, timeout_inactivity_minutes=0):
+                    spark_ec2.parallel_map(lambda host: spark_ec2.ssh_read(host, opts, ['true']),
+                                           ['slave-1', 'slave-2', 'slave-3'], 3)
+            with open(pid_file) as f:
+                pids = [int(pid) for pid in f.read().split()]
+            self.assertEqual(len(pids), 3)
+            # The workers reap their processes once they are killed
+            deadline = time.time() + 5
+            while time.time() < deadline and any(is_alive(pid) for pid in pids):
+                time.sleep(0.1)
+            self.assertFalse(any(is_alive(pid) for pid in pids))
+        finally:
+            os.environ['PATH'] = path
+            shutil.rmtree(tmp_dir)
+
+
+class SshOptions(object):
+    identity_file = None
+    ssh_control_dir = None
+    user = 'root'
+
+
+def is_alive(pid):
+    try:
+        os.kill(pid, 0)
+        return True
+    except OSError:
+        return False
+
+
+class JobStatusTest(unittest.TestCase):
+
+    def setUp(self):
+        self.control_dir = os.path.join(tempfile.mkdtemp(), 'job.tag')
+
+    def tearDown(self):
+        shutil.rmtree(os.path.dirname(self.control_dir))
+
+    def status(self):
+        return cluster.check_output(['bash', '-c', cluster.get_job_status_command(self.control_dir)]).strip()
+
+    def test_job_starting_is_not_killed(self):
+        # The hook creates the control dir before writing RUNNING
+        os.mkdir(self.control_dir)
+        sleeper = cluster.subprocess.Popen(['sleep', '10'])
+        def start():
+            with open(os.path.join(self.control_dir, 'RUNNING'), 'w') as f:
+                f.write(str(sleeper.pid))
+        threading.Timer(0.5, start).start()
+        try:
+            self.assertEqual(self.status(), 'RUNNING')
+        finally:
+            sleeper.kill()
+            sleeper.wait()
+
+    def test_job_without_running_process_is_killed(self):
+        self.assertEqual(self.status(), 'WAITINGCONTROL')
+        os.mkdir(self.control_dir)
+        self.assertEqual(self.status(), 'KILLED')
+        with open(os.path.join(self.control_dir, 'SUCCESS'), 'w'):
+            pass
+        self.assertEqual(self.status(), 'SUCCESS')
+
+
+class Group(object):
+
+    def __init__(self, name):
+        self.name = name
+
+
+class Instance(object):
+
+    def __init__(self, id, group_name):
+        self.id = id
+        self.groups = [Group(group_name)]
+
+
+class Reservation(object):
+
+    def __init__(self, instances):
+        self.instances = instances
+
+
+class ThreadCheckingConnection(object):
+    """
+    Fails the test if it is used by more than one thread, like a boto
+    connection shared between threads would race.
+    """
+
+    def __init__(self, tagged):
+        self.thread = threading.current_thread()
+        self.tagged = tagged
+
+    def check_thread(self):
+        assert self.thread is threading.current_thread(), 'connection shared between threads'
+
+    def get_all_reservations(self, filters, max_results, next_token):
+        self.check_thread()
+        cluster_name = filters['instance.group-name'][0][:-len('-master')]
+        return [Reservation([Instance('i-' + cluster_name, cluster_name + '-master')])]
+
+    def create_tags(self, ids, tags):
+        self.check_thread()
+        self.tagged.extend(ids)
+
+
+class BackgroundThreadsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tagged = []
+        self.original = utils.boto.ec2.connect_to_region
+        utils.boto.ec2.connect_to_region = lambda region: ThreadCheckingConnection(self.tagged)
+        utils.invalidate_inventory()
+
+    def tearDown(self):
+        utils.boto.ec2.connect_to_region = self.original
+        utils.invalidate_inventory()
+
+    def test_pool_threads_do_not_share_the_main_thread_connection(self):
+        # As pool fill releases the clusters it launched, while the main thread
+        # and the self-heal threads use EC2 too
+        utils.get_connection('thread-region')
+        cluster_names = ['pool-{0}'.format(i) for i in range(4)]
+        spark_ec2.parallel_map(lambda c: cluster.release_pool_cluster(c, region='thread-region'),
+                               cluster_names, 4)
+        cluster.set_pool_state('pool-main', 'busy', 'thread-region')
+        self.assertEqual(sorted(set(self.tagged)), ['i-' + c for c in sorted(cluster_names + ['pool-main'])])
+
+
+class DestroyTest(unittest.TestCase):
+
+    def setUp(self):
+        self.calls = []
+        self.original = (cluster.destroy_clusters, cluster.get_connection, spark_ec2.delete_cluster_groups,
+                         spark_ec2.start_background_group_deletion, spark_ec2.get_terminating_instances)
+        self.environ = dict(os.environ)
+        os.environ.setdefault('AWS_ACCESS_KEY_ID', 'key')
+        os.environ.setdefault('AWS_SECRET_ACCESS_KEY', 'secret')
+        cluster.destroy_clusters = lambda cluster_names, region: [
+            utils.DestroyResult(c, ['i-' + c], []) for c in cluster_names]
+        cluster.get_connection = lambda region: 'conn'
+        spark_ec2.get_terminating_instances = lambda conn, cluster_name: ['i-' + cluster_name]
+        spark_ec2.delete_cluster_groups = lambda conn, opts, cluster_name, instances: self.calls.append(
+            ('foreground', cluster_name, opts.region, instances))
+        spark_ec2.start_background_group_deletion = lambda opts, cluster_name: self.calls.append(
+            ('background', cluster_name, opts.region))
+
+    def tearDown(self):
+        (cluster.destroy_clusters, cluster.get_connection, spark_ec2.delete_cluster_groups,
+         spark_ec2.start_background_group_deletion, spark_ec2.get_terminating_instances) = self.original
+        os.environ.clear()
+        os.environ.update(self.environ)
+
+    def test_destroy_and_destroy_many_delete_groups_through_spark_ec2(self):
+        cluster.destroy('one', delete_groups=True, region='eu-west-1')
+        list(cluster.destroy_many(True, True, 'eu-west-1', 'two', 'three'))
+        self.assertEqual(self.calls, [('foreground', 'one', 'eu-west-1', ['i-one']),
+                                      ('background', 'two', 'eu-west-1'),
+                                      ('background', 'three', 'eu-west-1')])
+
+    def test_group_deletion_timeout_is_a_command_error(self):
+        def give_up(conn, opts, cluster_name, instances):
+            sys.exit(1)
+        spark_ec2.delete_cluster_groups = give_up
+        self.assertRaises(cluster.CommandError, cluster.destroy, 'one', delete_groups=True)
+
+
+class JobRunBatchTest(unittest.TestCase):
+
+    patched = ['get_master', 'upload_job_files', 'start_job', 'get_jobs_status', 'health_check',
+               'kill_job', 'collect_job_results', 'print_job_batch_summary']
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.batch_file = os.path.join(self.tmp_dir, 'batch.json')
+        with open(self.batch_file, 'w') as f:
+            f.write('[{"job_name": "First", "job_mem": "1G"}, {"job_name": "Second", "job_mem": "1G"}]')
+        self.original = dict((name, getattr(cluster, name)) for name in self.patched)
+        self.polls = 0
+        self.health_checks = 0
+        self.killed = []
+
+        def get_jobs_status(master, key_file, remote_user, remote_control_dir, jobs_with_tag):
+            self.polls += 1
+            status = 'SUCCESS' if self.polls >= 5 else 'RUNNING'
+            return dict((job_with_tag, status) for job_with_tag in jobs_with_tag)
+
+        def health_check(**kwargs):
+            self.health_checks += 1
+
+        cluster.get_master = lambda cluster_name, region: 'master'
+        cluster.upload_job_files = lambda **kwargs: None
+        cluster.start_job = lambda **kwargs: None
+        cluster.get_jobs_status = get_jobs_status
+        cluster.health_check = health_check
+        cluster.kill_job = lambda **kwargs: self.killed.append(kwargs['job_name'])
+        cluster.collect_job_results = lambda **kwargs: None
+        cluster.print_job_batch_summary = lambda jobs: None
+
+    def tearDown(self):
+        for name, value in self.original.items():
+            setattr(cluster, name, value)
+        shutil.rmtree(self.tmp_dir)
+
+    def test_health_check_is_throttled(self):
+        cluster.job_run_batch('cluster', self.batch_file, seconds_to_sleep=0)
+        self.assertEqual(self.polls, 5)
+        self.assertEqual(self.health_checks, 1)
+
+    def test_unhealthy_cluster_kills_the_running_jobs(self):
+        def health_check(**kwargs):
+            raise cluster.NotHealthyCluster('Not enough healthy slaves: 0/2')
+        cluster.health_check = health_check
+        self.assertRaises(cluster.NotHealthyCluster, cluster.job_run_batch, 'cluster', self.batch_file,
+                          seconds_to_sleep=0, kill_on_failure=True)
+        self.assertEqual(sorted(self.killed), ['First', 'Second'])
@@ -0,0 +1,33 @@
+import unittest
+
+import placement
+
+
+class PlanPlacementTest(unittest.TestCase):
+
+    def setUp(self):
+        self.queried = []
+        self.original = placement.get_spot_price_history
+
+        def get_spot_price_history(region, instance_types, hours):
+            self.queried.extend(instance_types)
+            return [['us-east-1a', t, '2016-01-01T00:00:00.000Z', 0.1] for t in instance_types]
+        placement.get_spot_price_history = get_spot_price_history
+
+    def tearDown(self):
+        placement.get_spot_price_history = self.original
+
+    def test_unknown_instance_type_is_a_command_error(self):
+        with self.assertRaises(placement.CommandError) as raised:
+            placement.plan_placement('us-east-1', 'x9.huge', 10, 1.0)
+        self.assertIn('r3.xlarge', str(raised.exception))
+
+    def test_unknown_candidates_are_skipped(self):
+        placements = placement.plan_placement('us-east-1', 'r3.xlarge', 10, 1.0,
+                                              candidate_types=['r3.xlarge', 'x9.huge', 'r3.2xlarge'])
+        self.assertEqual(sorted(self.queried), ['r3.2xlarge', 'r3.xlarge'])
+        self.assertEqual(sorted(p.instance_type for p in placements), ['r3.2xlarge', 'r3.xlarge'])
+
+    def test_no_known_candidates_is_a_command_error(self):
+        self.assertRaises(placement.CommandError, placement.plan_placement,
+                          'us-east-1', 'r3.xlarge', 10, 1.0, candidate_types=['x9.huge'])
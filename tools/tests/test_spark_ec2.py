@@ -0,0 +1,470 @@
+# -*- coding: utf-8 -*-
+import json
+import os
+import shutil
+import tarfile
+import tempfile
+import threading
+import unittest
+from collections import namedtuple
+from io import BytesIO
+
+import spark_ec2
+
+
+class FakeInstance(object):
+
+    def __init__(self, id, spot_instance_request_id=None):
+        self.id = id
+        self.public_dns_name = id + '.compute.amazonaws.com'
+        self.spot_instance_request_id = spot_instance_request_id
+
+
+class FakeConnection(object):
+
+    def __init__(self):
+        self.cancelled = []
+        self.terminated = []
+
+    def cancel_spot_instance_requests(self, request_ids):
+        self.cancelled.extend(request_ids)
+
+    def terminate_instances(self, instance_ids):
+        self.terminated.extend(instance_ids)
+
+
+class FakeOptions(object):
+    min_healthy_slaves_fraction = 0.5
+
+
+class ExcludeFailedSlavesTest(unittest.TestCase):
+
+    def test_terminates_failed_slaves_and_cancels_their_spot_requests(self):
+        conn = FakeConnection()
+        slaves = [FakeInstance('i-1', 'sir-1'), FakeInstance('i-2', 'sir-2'), FakeInstance('i-3')]
+        failed_hosts = [slaves[1].public_dns_name, slaves[2].public_dns_name]
+        opts = FakeOptions()
+        opts.min_healthy_slaves_fraction = 0.3
+        healthy = spark_ec2.exclude_failed_slaves(conn, slaves, failed_hosts, opts)
+        self.assertEqual(healthy, slaves[:1])
+        self.assertEqual(conn.cancelled, ['sir-2'])
+        self.assertEqual(conn.terminated, ['i-2', 'i-3'])
+
+    def test_keeps_everything_below_the_minimum_fraction(self):
+        conn = FakeConnection()
+        slaves = [FakeInstance('i-1'), FakeInstance('i-2')]
+        failed_hosts = [s.public_dns_name for s in slaves]
+        self.assertRaises(RuntimeError, spark_ec2.exclude_failed_slaves,
+                          conn, slaves, failed_hosts, FakeOptions())
+        self.assertEqual(conn.terminated, [])
+
+
+if __name__ == '__main__':
+    unittest.main()
+
+
+class RenderDeployTarTest(unittest.TestCase):
+
+    def setUp(self):
+        self.root_dir = tempfile.mkdtemp()
+        os.makedirs(os.path.join(self.root_dir, 'root', 'spark-ec2'))
+        with open(os.path.join(self.root_dir, 'root', 'spark-ec2', 'masters'), 'wb') as f:
+            f.write('# Máster\n{{active_master}}\n')
+
+    def tearDown(self):
+        shutil.rmtree(self.root_dir)
+
+    def render(self, template_vars):
+        tar = tarfile.open(fileobj=BytesIO(spark_ec2.render_deploy_tar(self.root_dir, template_vars)))
+        info = tar.getmember('root/spark-ec2/masters')
+        return info, tar.extractfile(info).read()
+
+    def test_unicode_host_names(self):
+        # boto returns the host names as unicode
+        info, content = self.render({'active_master': u'ec2-54-0-1-2.compute-1.amazonaws.com'})
+        self.assertEqual(content, '# Máster\nec2-54-0-1-2.compute-1.amazonaws.com\n')
+        self.assertEqual(info.size, len(content))
+
+    def test_non_ascii_host_names_are_encoded_as_utf8(self):
+        info, content = self.render({'active_master': u'm\xe4ster.internal'})
+        self.assertEqual(content.decode('utf-8'), u'# M\xe1ster\nm\xe4ster.internal\n')
+        self.assertEqual(info.size, len(content))
+
+
+class CacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+        self.original = spark_ec2.CACHE_DIR, spark_ec2.DEPLOY_CACHE_DIR, spark_ec2.DEPLOY_CACHE_MAX_FILES
+        spark_ec2.CACHE_DIR = self.cache_dir
+        spark_ec2.DEPLOY_CACHE_DIR = os.path.join(self.cache_dir, 'deploy')
+        spark_ec2.DEPLOY_CACHE_MAX_FILES = 2
+        self.root_dir = tempfile.mkdtemp()
+        with open(os.path.join(self.root_dir, 'slaves'), 'wb') as f:
+            f.write('{{slave_list}}\n')
+
+    def tearDown(self):
+        spark_ec2.CACHE_DIR, spark_ec2.DEPLOY_CACHE_DIR, spark_ec2.DEPLOY_CACHE_MAX_FILES = self.original
+        shutil.rmtree(self.cache_dir)
+        shutil.rmtree(self.root_dir)
+
+    def test_values_expire_after_the_ttl(self):
+        spark_ec2.save_cached('resolution', 'ami:us-east-1/hvm', 'ami-5bb18832')
+        self.assertEqual(spark_ec2.load_cached('resolution', 'ami:us-east-1/hvm', 60), 'ami-5bb18832')
+        entry_path = spark_ec2.get_cache_path('resolution', 'ami:us-east-1/hvm')
+        with open(entry_path) as f:
+            entry = json.load(f)
+        entry['timestamp'] -= 120
+        with open(entry_path, 'w') as f:
+            json.dump(entry, f)
+        self.assertIsNone(spark_ec2.load_cached('resolution', 'ami:us-east-1/hvm', 60))
+        self.assertEqual(spark_ec2.load_cached('resolution', 'ami:us-east-1/hvm', -1), 'ami-5bb18832')
+        self.assertIsNone(spark_ec2.load_cached('resolution', 'ami:us-west-2/hvm', 60))
+
+    def test_deploy_archives_are_evicted_least_recently_used_first(self):
+        def deploy(slaves):
+            spark_ec2.get_deploy_tar(self.root_dir, {'slave_list': slaves})
+            # Tell the runs apart in the file times
+            for name in os.listdir(spark_ec2.DEPLOY_CACHE_DIR):
+                path = os.path.join(spark_ec2.DEPLOY_CACHE_DIR, name)
+                os.utime(path, (os.path.getmtime(path) - 10,) * 2)
+
+        deploy('slave-1')
+        deploy('slave-2')
+        deploy('slave-1')
+        deploy('slave-3')
+        cached = os.listdir(spark_ec2.DEPLOY_CACHE_DIR)
+        self.assertEqual(len(cached), 2)
+        contents = set()
+        for name in cached:
+            with open(os.path.join(spark_ec2.DEPLOY_CACHE_DIR, name), 'rb') as f:
+                contents.add(tarfile.open(fileobj=BytesIO(f.read())).extractfile('slaves').read())
+        self.assertEqual(contents, set(['slave-1\n', 'slave-3\n']))
+
+    def test_archives_with_credentials_are_not_cached(self):
+        spark_ec2.get_deploy_tar(self.root_dir, {'slave_list': 'slave-1', 'aws_secret_access_key': 'secret'})
+        self.assertFalse(os.path.exists(spark_ec2.DEPLOY_CACHE_DIR))
+
+
+Rule = namedtuple('Rule', ['ip_protocol', 'from_port', 'to_port', 'grants'])
+Grant = namedtuple('Grant', ['group_id', 'name', 'owner_id'])
+Group = namedtuple('Group', ['id', 'name', 'vpc_id', 'rules'])
+
+
+class SharedConnection(object):
+
+    def __init__(self, groups):
+        self.groups = groups
+
+    def get_all_security_groups(self, filters):
+        return self.groups
+
+
+class WorkerConnection(object):
+
+    def __init__(self, calls):
+        self.thread = None
+        self.calls = calls
+
+    def check_thread(self):
+        # A connection is never used by two threads
+        if self.thread is None:
+            self.thread = threading.current_thread()
+        assert self.thread is threading.current_thread()
+
+    def revoke_security_group(self, **kwargs):
+        self.check_thread()
+        self.calls.append(('revoke', kwargs['group_name'], kwargs['src_security_group_name'],
+                           kwargs['ip_protocol']))
+        return True
+
+    def delete_security_group(self, group_id):
+        self.check_thread()
+        self.calls.append(('delete', group_id))
+        return True
+
+
+class DeleteClusterGroupsOptions(object):
+    region = 'test-region'
+    ssh_concurrency = 8
+    poll_interval = 0
+    max_poll_interval = 0
+    group_delete_timeout = 60
+
+
+class DeleteClusterGroupsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.calls = []
+        self.connections = []
+        self.original = spark_ec2.ec2.connect_to_region
+
+        def connect_to_region(region):
+            self.connections.append(WorkerConnection(self.calls))
+            return self.connections[-1]
+        spark_ec2.ec2.connect_to_region = connect_to_region
+
+    def tearDown(self):
+        spark_ec2.ec2.connect_to_region = self.original
+
+    def test_workers_use_their_own_connections(self):
+        def group_rules(other):
+            return [Rule(protocol, 0, 65535, [Grant(other[0], other[1], '123'),
+                                              Grant(None, None, None)])
+                    for protocol in ('tcp', 'udp', 'icmp')]
+        master, slaves = ('sg-1', 'test-master'), ('sg-2', 'test-slaves')
+        groups = [Group(master[0], master[1], None, group_rules(slaves)),
+                  Group(slaves[0], slaves[1], None, group_rules(master))]
+        conn = SharedConnection(groups)
+        spark_ec2.delete_cluster_groups(conn, DeleteClusterGroupsOptions(), 'test', [])
+        # Rules on CIDR ranges create no dependency between the groups
+        revokes = sorted(c for c in self.calls if c[0] == 'revoke')
+        self.assertEqual(revokes, sorted(('revoke', group, other, protocol)
+                                         for group, other in (('test-master', 'test-slaves'),
+                                                              ('test-slaves', 'test-master'))
+                                         for protocol in ('tcp', 'udp', 'icmp')))
+        self.assertEqual(sorted(c for c in self.calls if c[0] == 'delete'),
+                         [('delete', 'sg-1'), ('delete', 'sg-2')])
+        self.assertTrue(self.connections)
+
+
+class SetupOptions(object):
+    resume = False
+    min_healthy_slaves_fraction = 0.5
+    spark_ec2_git_repo = 'https://github.com/mesos/spark-ec2'
+    spark_ec2_git_branch = 'branch-1.4'
+    hadoop_major_version = '2'
+    ganglia = False
+
+
+class SetupCheckpointsTest(unittest.TestCase):
+
+    def setUp(self):
+        # Files on the master, and what each try did
+        self.files = {}
+        self.key_sent_to = []
+        self.deployed_to = []
+        self.deploy_fails = False
+        self.original = dict((name, getattr(spark_ec2, name)) for name in (
+            'ssh', 'ssh_read', 'ssh_write', 'ssh_write_all', 'deploy_files', 'setup_spark_cluster'))
+
+        def ssh_read(host, opts, command):
+            if isinstance(command, str) and command.startswith('cat '):
+                return self.files.get(command.split()[1], '')
+            return 'ssh key tar'
+
+        def ssh_write(host, opts, command, data):
+            self.files[command.split()[-1]] = data
+
+        def ssh_write_all(hosts, opts, command, data):
+            self.key_sent_to.append(sorted(hosts))
+            return [h for h in hosts if h.startswith('i-3.')]
+
+        def deploy_files(conn, root_dir, opts, master_nodes, slave_nodes, modules):
+            self.deployed_to.append(sorted(s.id for s in slave_nodes))
+            if self.deploy_fails:
+                raise RuntimeError('deploy failed')
+
+        spark_ec2.ssh = lambda host, opts, command: None
+        spark_ec2.ssh_read = ssh_read
+        spark_ec2.ssh_write = ssh_write
+        spark_ec2.ssh_write_all = ssh_write_all
+        spark_ec2.deploy_files = deploy_files
+        spark_ec2.setup_spark_cluster = lambda master, opts: None
+
+    def tearDown(self):
+        for name, value in self.original.items():
+            setattr(spark_ec2, name, value)
+
+    def test_resume_keeps_excluded_slaves_out_and_skips_finished_phases(self):
+        conn = FakeConnection()
+        master = FakeInstance('i-0')
+        slaves = [FakeInstance('i-1'), FakeInstance('i-2'), FakeInstance('i-3')]
+        self.deploy_fails = True
+        self.assertRaises(RuntimeError, spark_ec2.setup_cluster, conn, [master], slaves, SetupOptions(), True)
+        self.assertEqual(conn.terminated, ['i-3'])
+
+        # The excluded slave may still be listed while it shuts down
+        self.deploy_fails = False
+        opts = SetupOptions()
+        opts.resume = True
+        spark_ec2.setup_cluster(conn, [master], slaves, opts, True)
+        self.assertEqual(self.key_sent_to, [['i-1.compute.amazonaws.com', 'i-2.compute.amazonaws.com',
+                                             'i-3.compute.amazonaws.com']])
+        self.assertEqual(self.deployed_to, [['i-1', 'i-2'], ['i-1', 'i-2']])
+        spark_ec2.setup_cluster(conn, [master], slaves[:2], opts, True)
+        self.assertEqual(len(self.deployed_to), 2)
+
+    def test_resume_with_other_slaves_starts_over(self):
+        conn = FakeConnection()
+        master = FakeInstance('i-0')
+        spark_ec2.setup_cluster(conn, [master], [FakeInstance('i-1'), FakeInstance('i-2')], SetupOptions(), True)
+        opts = SetupOptions()
+        opts.resume = True
+        spark_ec2.setup_cluster(conn, [master], [FakeInstance('i-1'), FakeInstance('i-4')], opts, True)
+        self.assertEqual(len(self.key_sent_to), 2)
+        self.assertEqual(self.deployed_to, [['i-1', 'i-2'], ['i-1', 'i-4']])
+
+
+class Zone(object):
+
+    def __init__(self, name):
+        self.name = name
+
+
+class Launched(Exception):
+    pass
+
+
+class BakeConnection(object):
+
+    def __init__(self):
+        self.placements = []
+
+    def get_all_zones(self):
+        return [Zone('us-east-1b'), Zone('us-east-1c')]
+
+    def get_all_images(self, image_ids):
+        conn = self
+
+        class Image(object):
+            def run(self, placement, **kwargs):
+                conn.placements.append(placement)
+                raise Launched()
+        return [Image()]
+
+
+class BakeOptions(object):
+    identity_file = 'key.pem'
+    key_pair = 'key'
+    ami = 'ami-5bb18832'
+    vpc_id = None
+    subnet_id = None
+    instance_type = 'r3.xlarge'
+
+
+class BakeImageZoneTest(unittest.TestCase):
+
+    def setUp(self):
+        self.original = dict((name, getattr(spark_ec2, name)) for name in (
+            'get_or_make_group', 'get_existing_cluster', 'get_additional_group_ids', 'read_user_data'))
+        spark_ec2.get_or_make_group = lambda conn, name, vpc_id: Group('sg-1', name, None, ['rule'])
+        spark_ec2.get_existing_cluster = lambda conn, opts, name, die_on_error: ([], [])
+        spark_ec2.get_additional_group_ids = lambda conn, opts: []
+        spark_ec2.read_user_data = lambda opts: None
+
+    def tearDown(self):
+        for name, value in self.original.items():
+            setattr(spark_ec2, name, value)
+
+    def placement(self, zone):
+        conn = BakeConnection()
+        opts = BakeOptions()
+        opts.zone = zone
+        self.assertRaises(Launched, spark_ec2.bake_image, conn, opts, 'image')
+        return conn.placements[0]
+
+    def test_launches_in_a_single_real_zone(self):
+        self.assertIn(self.placement('all'), ['us-east-1b', 'us-east-1c'])
+        self.assertIn(self.placement(''), ['us-east-1b', 'us-east-1c'])
+        self.assertIn(self.placement('us-east-1d,us-east-1e'), ['us-east-1d', 'us-east-1e'])
+        self.assertEqual(self.placement('us-east-1d'), 'us-east-1d')
+
+
+class SpotStatus(object):
+
+    def __init__(self, code):
+        self.code = code
+        self.message = code
+
+
+class SpotRequest(object):
+
+    def __init__(self, id, granted):
+        # granted is None for a request that is still being evaluated
+        self.id = id
+        self.state = 'active' if granted else 'open'
+        self.status = SpotStatus({True: 'fulfilled', False: 'capacity-not-available',
+                                  None: 'pending-evaluation'}[granted])
+        self.instance_id = 'i-' + id if granted else None
+
+
+class SpotConnection(object):
+    """
+    Grants or fails each new spot request as scripted for its zone.
+    """
+
+    def __init__(self, outcomes):
+        self.outcomes = outcomes
+        self.requests = {}
+        self.requested_zones = []
+
+    def request_spot_instances(self, price, placement, count, **launch_spec):
+        reqs = []
+        for _ in range(count):
+            req = SpotRequest('sir-%d' % len(self.requests), self.outcomes[placement].pop(0))
+            self.requests[req.id] = req
+            self.requested_zones.append(placement)
+            reqs.append(req)
+        return reqs
+
+    def get_all_spot_instance_requests(self, request_ids):
+        return [self.requests[r] for r in request_ids]
+
+    def cancel_spot_instance_requests(self, request_ids):
+        pass
+
+    def get_all_reservations(self, instance_ids=None, filters=None, max_results=None, next_token=None):
+        # Only the granted instances, the cluster is looked up by filters on failure
+        return [Reservation([FakeInstance(i) for i in instance_ids or []])]
+
+
+class Reservation(object):
+
+    def __init__(self, instances):
+        self.instances = instances
+
+
+class SpotOptions(object):
+    spot_price = 0.1
+    spot_timeout = 10
+    spot_partial_grace = 0
+    min_healthy_slaves_fraction = 0.5
+    allow_partial_spot_grants = False
+
+
+class NoSleep(object):
+
+    def sleep(self, seconds):
+        pass
+
+
+class AcquireSpotSlavesTest(unittest.TestCase):
+
+    def setUp(self):
+        self.original = spark_ec2.time
+        spark_ec2.time = NoSleep()
+
+    def tearDown(self):
+        spark_ec2.time = self.original
+
+    def test_zone_that_failed_once_is_tried_again(self):
+        # a fails, its slave goes to b, which fails, so it goes back to a
+        conn = SpotConnection({'a': [False, True], 'b': [True, False]})
+        slaves = spark_ec2.acquire_spot_slaves(conn, SpotOptions(), 'cluster', ['a', 'b'], {}, 2)
+        self.assertEqual(len(slaves), 2)
+        self.assertEqual(conn.requested_zones, ['a', 'b', 'b', 'a'])
+
+    def test_waits_for_every_slave_by_default(self):
+        opts = SpotOptions()
+        opts.spot_timeout = -1
+        conn = SpotConnection({'a': [True], 'b': [None]})
+        self.assertRaises(SystemExit, spark_ec2.acquire_spot_slaves,
+                          conn, opts, 'cluster', ['a', 'b'], {}, 2)
+
+    def test_partial_grants_are_opt_in(self):
+        opts = SpotOptions()
+        opts.allow_partial_spot_grants = True
+        conn = SpotConnection({'a': [True], 'b': [None]})
+        slaves = spark_ec2.acquire_spot_slaves(conn, opts, 'cluster', ['a', 'b'], {}, 2)
+        self.assertEqual([s.id for s in slaves], ['i-sir-0'])
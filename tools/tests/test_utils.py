@@ -0,0 +1,69 @@
+import threading
+import unittest
+
+import utils
+
+
+class FakeReservations(list):
+    next_token = None
+
+
+class FakeConnection(object):
+
+    def __init__(self):
+        self.queries = 0
+
+    def get_all_reservations(self, filters, max_results, next_token):
+        self.queries += 1
+        return FakeReservations()
+
+
+class InventoryTest(unittest.TestCase):
+
+    def setUp(self):
+        self.conn = FakeConnection()
+        utils._connections.__dict__.setdefault('by_region', {})['test-region'] = self.conn
+        utils.invalidate_inventory()
+
+    def tearDown(self):
+        del utils._connections.by_region['test-region']
+        utils.invalidate_inventory()
+
+    def test_reuses_the_snapshot_within_the_ttl(self):
+        utils.get_inventory('test-region', 'cluster')
+        utils.get_inventory('test-region', 'cluster')
+        self.assertEqual(self.conn.queries, 1)
+        utils.get_inventory('test-region', 'cluster', ttl_seconds=-1)
+        self.assertEqual(self.conn.queries, 2)
+
+    def test_invalidate_forces_a_new_query(self):
+        utils.get_inventory('test-region', 'cluster')
+        utils.invalidate_inventory('test-region')
+        utils.get_inventory('test-region', 'cluster')
+        self.assertEqual(self.conn.queries, 2)
+
+
+class ConnectionTest(unittest.TestCase):
+
+    def setUp(self):
+        self.original = utils.boto.ec2.connect_to_region
+        utils.boto.ec2.connect_to_region = lambda region: object()
+
+    def tearDown(self):
+        utils.boto.ec2.connect_to_region = self.original
+        utils._connections.by_region.pop('other-region', None)
+
+    def test_each_thread_has_its_own_connection(self):
+        conn = utils.get_connection('other-region')
+        self.assertIs(utils.get_connection('other-region'), conn)
+        in_thread = []
+        thread = threading.Thread(target=lambda: in_thread.extend(
+            [utils.get_connection('other-region'), utils.get_connection('other-region')]))
+        thread.start()
+        thread.join()
+        self.assertIs(in_thread[0], in_thread[1])
+        self.assertIsNot(in_thread[0], conn)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,19 +1,74 @@
 #!/usr/bin/env python
+import atexit
 import logging
+import os
+import shutil
+import tempfile
 import boto.ec2
 import sys
 import subprocess
 import select
+import threading
 import time
+from collections import namedtuple
+
+# spark_ec2 is also used as a library, and its EC2 helpers are shared with it
+sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)), 'spark-ec2'))
+from spark_ec2 import ACTIVE_STATES as active_states, iter_reservations, get_cluster_instances, parallel_map
+from spark_ec2 import load_cached, save_cached
 
 logging.basicConfig(level=logging.INFO)
 
-def get_active_instances(conn):
-    active = [instance for res in conn.get_all_instances()
-              for instance in res.instances
-              if instance.state in set(['pending', 'running',
-                                        'stopping', 'stopped'])]
-    return active
+# Seconds during which an inventory snapshot is reused before querying EC2 again.
+# Longer than the 60 seconds between the health checks of wait_for_job, so
+# that the other lookups between two checks don't query EC2 again.
+inventory_ttl_seconds = 90
+
+# boto connections are not thread safe, so each thread keeps its own, by region
+_connections = threading.local()
+_inventory = {}
+_inventory_lock = threading.Lock()
+
+
+def get_connection(region):
+    connections = _connections.__dict__.setdefault('by_region', {})
+    if region not in connections:
+        connections[region] = boto.ec2.connect_to_region(region)
+    return connections[region]
+
+
+def get_cluster_group_names(cluster_name):
+    return [cluster_name + '-master', cluster_name + '-slaves']
+
+
+def get_inventory(region, cluster_name, ttl_seconds=None):
+    """
+    Returns the active instances of the cluster, reusing the snapshot taken by
+    a previous call if it is not older than ttl_seconds (by default
+    inventory_ttl_seconds).
+    """
+    if ttl_seconds is None:
+        ttl_seconds = inventory_ttl_seconds
+    conn = get_connection(region)
+    with _inventory_lock:
+        snapshot = _inventory.get((region, cluster_name))
+        if snapshot is None or time.time() - snapshot[0] > ttl_seconds:
+            snapshot = (time.time(), get_cluster_instances(conn, cluster_name))
+            _inventory[(region, cluster_name)] = snapshot
+        return snapshot[1]
+
+
+def invalidate_inventory(region=None):
+    """
+    Drops the inventory snapshots of the region (or of all regions), forcing
+    the next lookup to query EC2. Call it after launching or terminating
+    instances.
+    """
+    with _inventory_lock:
+        for key in list(_inventory):
+            if region is None or key[0] == region:
+                del _inventory[key]
+
 
 def parse_nodes(active_instances, cluster_name):
     master_nodes = []
@@ -27,23 +82,18 @@ def parse_nodes(active_instances, cluster_name):
     return (master_nodes, slave_nodes)
 
 def get_masters(cluster_name, region):
-    conn = boto.ec2.connect_to_region(region)
-
-    active = get_active_instances(conn)
-    master_nodes, slave_nodes = parse_nodes(active, cluster_name)
+    master_nodes, slave_nodes = parse_nodes(get_inventory(region, cluster_name), cluster_name)
     return master_nodes
 
-def get_active_nodes(cluster_name, region):
-    conn = boto.ec2.connect_to_region(region)
-    active = get_active_instances(conn)
-    return parse_nodes(active, cluster_name)
+def get_active_nodes(cluster_name, region, ttl_seconds=None):
+    return parse_nodes(get_inventory(region, cluster_name, ttl_seconds), cluster_name)
 
 
 def tag_instances(cluster_name, tags, region):
-    conn = boto.ec2.connect_to_region(region)
+    conn = get_connection(region)
 
-    active = get_active_instances(conn)
-    logging.info('%d active instances', len(active))
+    active = get_inventory(region, cluster_name)
+    logging.info('%d active instances in cluster', len(active))
 
     master_nodes, slave_nodes = parse_nodes(active, cluster_name)
     logging.info('%d master, %d slave', len(master_nodes), len(slave_nodes))
@@ -61,27 +111,98 @@ def tag_instances(cluster_name, tags, region):
 
     logging.info("Tagged nodes.")
 
+
+DestroyResult = namedtuple('DestroyResult', ['cluster_name', 'terminated_instance_ids',
+                                             'cancelled_spot_request_ids'])
+
+
+def destroy_clusters(cluster_names, region):
+    """
+    Terminates the instances of all the clusters with a single EC2 call,
+    after cancelling the spot requests of their slaves so no new instance
+    shows up later.
+    Returns a DestroyResult for each cluster, in the order of cluster_names.
+    """
+    conn = get_connection(region)
+    group_names = [name for cluster_name in cluster_names
+                   for name in get_cluster_group_names(cluster_name)]
+    cluster_of_group = dict((name, cluster_name) for cluster_name in cluster_names
+                            for name in get_cluster_group_names(cluster_name))
+
+    spot_requests = conn.get_all_spot_instance_requests(filters={
+        'launch.group-name': [cluster_name + '-slaves' for cluster_name in cluster_names],
+        'state': ['open', 'active']})
+    if spot_requests:
+        conn.cancel_spot_instance_requests([r.id for r in spot_requests])
+
+    instances = [instance for res in iter_reservations(conn, {'instance.group-name': group_names,
+                                                              'instance-state-name': active_states})
+                 for instance in res.instances]
+    if instances:
+        conn.terminate_instances(instance_ids=[i.id for i in instances])
+    invalidate_inventory(region)
+
+    instance_ids = dict((cluster_name, []) for cluster_name in cluster_names)
+    for instance in instances:
+        for group in instance.groups:
+            if group.name in cluster_of_group:
+                instance_ids[cluster_of_group[group.name]].append(instance.id)
+                break
+    request_ids = dict((cluster_name, []) for cluster_name in cluster_names)
+    for request in spot_requests:
+        for group in request.launch_specification.groups:
+            if group.name in cluster_of_group:
+                request_ids[cluster_of_group[group.name]].append(request.id)
+                break
+    return [DestroyResult(cluster_name, instance_ids[cluster_name], request_ids[cluster_name])
+            for cluster_name in cluster_names]
+
+
+def get_tagged_clusters(region, tags):
+    """
+    Returns a dict from cluster name to the tags of its master, for the
+    running clusters whose masters have all the given tags. Always queries
+    EC2, as the tags may have just been changed by another process.
+    """
+    filters = {'instance-state-name': ['pending', 'running'],
+               'tag:spark_node_type': 'master'}
+    filters.update(('tag:' + k, v) for k, v in tags.items())
+    clusters = {}
+    for res in iter_reservations(get_connection(region), filters):
+        for instance in res.instances:
+            cluster_name = instance.tags.get('spark_cluster_name')
+            if cluster_name:
+                clusters[cluster_name] = dict(instance.tags)
+    return clusters
+
 class ProcessTimeoutException(Exception): pass
 
-def read_from_to(_from, to):
-    data = read_non_blocking(_from)
+# Size of the chunks read at once from the pipes of a child process
+pump_chunk_size = 64 * 1024
+
+
+def pump_output(outputs, timeout):
+    """
+    Waits up to timeout seconds for data on the file descriptors of outputs,
+    a dict of fd -> file object, and copies what is available in chunks.
+    Descriptors that reached end of file are removed from outputs.
+    Returns True if any data was copied.
+    """
+    if not outputs:
+        # Both pipes are closed, so the child is about to exit
+        time.sleep(min(timeout, 0.05))
+        return False
     read_data = False
-    while data is not None:
-        read_data = True
-        to.write(data)
-        data = read_non_blocking(_from)
-    to.flush()
+    for fd in select.select(list(outputs), [], [], timeout)[0]:
+        data = os.read(fd, pump_chunk_size)
+        if data:
+            read_data = True
+            outputs[fd].write(data)
+            outputs[fd].flush()
+        else:
+            del outputs[fd]
     return read_data
 
-def read_non_blocking(f):
-    result = []
-    while select.select([f], [], [], 0)[0]:
-        c = f.read(1)
-        if c:
-            result.append(c)
-        else:
-            break
-    return ''.join(result) if result else None
 
 def check_call_with_timeout(args, stdin=None, stdout=None,
                             stderr=None, shell=False,
@@ -97,10 +218,9 @@ def check_call_with_timeout(args, stdin=None, stdout=None,
                          stderr=subprocess.PIPE,
                          shell=shell,
                          universal_newlines=False)
+    outputs = {p.stdout.fileno(): stdout, p.stderr.fileno(): stderr}
     while True:
-        if read_from_to(p.stdout, stdout):
-            begin_time_inactivity = time.time()
-        if read_from_to(p.stderr, stderr):
+        if pump_output(outputs, timeout=0.5):
             begin_time_inactivity = time.time()
         if p.poll() is not None:
             break
@@ -109,16 +229,122 @@ def check_call_with_timeout(args, stdin=None, stdout=None,
         if terminate_by_inactivity_timeout or terminate_by_total_timeout:
             p.terminate()
             for i in range(100):
-                if p.poll is not None:
+                if p.poll() is not None:
                     break
                 time.sleep(0.1)
-            p.kill()
+            else:
+                p.kill()
             message = 'Terminated by inactivity' if terminate_by_inactivity_timeout else 'Terminated by total timeout'
             raise ProcessTimeoutException(message)
-        time.sleep(0.5)
-    read_from_to(p.stdout, stdout)
-    read_from_to(p.stderr, stderr)
+    # Copy what is left on the pipes, without waiting for processes
+    # that may have inherited them from the child
+    while outputs and select.select(list(outputs), [], [], 0)[0]:
+        pump_output(outputs, timeout=0)
+    p.stdout.close()
+    p.stderr.close()
     if p.returncode != 0:
         raise subprocess.CalledProcessError(p.returncode, args)
     return p.returncode
 
+
+# Command used to open SSH connections. Point IGNITION_SSH to a fake ssh
+# script to exercise the remote commands without real hosts.
+ssh_binary = os.getenv('IGNITION_SSH', 'ssh')
+
+# Reuse one master connection per user@host for all the ssh and rsync calls
+# of this process, unless IGNITION_SSH_MULTIPLEXING=no
+ssh_multiplexing = os.getenv('IGNITION_SSH_MULTIPLEXING', 'yes') != 'no'
+ssh_control_persist_seconds = 600
+
+_ssh_control_dir = None
+_ssh_control_lock = threading.Lock()
+
+
+def get_ssh_control_dir():
+    """
+    Returns the directory holding the control sockets of the master
+    connections, creating it on first use. The connections are closed and
+    the directory removed when the process exits.
+    """
+    global _ssh_control_dir
+    with _ssh_control_lock:
+        if _ssh_control_dir is None:
+            # Under /tmp rather than TMPDIR, which is too long on OS X
+            _ssh_control_dir = tempfile.mkdtemp(prefix='ign-', dir='/tmp')
+            atexit.register(close_ssh_connections)
+        return _ssh_control_dir
+
+
+def ssh_multiplexing_options(control_dir):
+    # %C is a hash of the local host, user, host and port, so every destination
+    # gets its own master connection, and its length doesn't depend on the
+    # host names: socket paths are limited to 104 bytes on OS X
+    return ['-o', 'ControlMaster=auto',
+            '-o', 'ControlPath={0}/%C'.format(control_dir),
+            '-o', 'ControlPersist={0}'.format(ssh_control_persist_seconds)]
+
+
+def get_ssh_options():
+    return ssh_multiplexing_options(get_ssh_control_dir()) if ssh_multiplexing else []
+
+
+def close_ssh_connections():
+    global _ssh_control_dir
+    with _ssh_control_lock:
+        control_dir, _ssh_control_dir = _ssh_control_dir, None
+    if control_dir is None:
+        return
+    sockets = [os.path.join(control_dir, name) for name in os.listdir(control_dir)]
+    run_commands([[ssh_binary, '-o', 'ControlPath=' + socket, '-O', 'exit', 'ignition']
+                  for socket in sockets], timeout_seconds=10)
+    shutil.rmtree(control_dir, ignore_errors=True)
+
+
+class CommandResult(namedtuple('CommandResult', ['args', 'returncode', 'output', 'error',
+                                                 'elapsed', 'timed_out'])):
+
+    def check_returncode(self):
+        if self.returncode != 0:
+            raise subprocess.CalledProcessError(self.returncode, self.args, output=self.output)
+        return self
+
+
+def run_command(args, timeout_seconds=0):
+    """
+    Runs args to completion, capturing its output, and kills it after
+    timeout_seconds if that is positive. Failures are reported in the returned
+    CommandResult instead of raised; use check_returncode to raise them.
+    """
+    begin_time = time.time()
+    with open(os.devnull) as devnull:
+        p = subprocess.Popen(args, stdin=devnull,
+                             stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    timed_out = threading.Event()
+
+    def kill():
+        timed_out.set()
+        try:
+            p.kill()
+        except OSError:
+            pass # already finished
+
+    timer = threading.Timer(timeout_seconds, kill) if timeout_seconds > 0 else None
+    if timer:
+        timer.start()
+    try:
+        output, error = p.communicate()
+    finally:
+        if timer:
+            timer.cancel()
+    return CommandResult(args, p.returncode, output, error,
+                         time.time() - begin_time, timed_out.is_set())
+
+
+def run_commands(commands, max_concurrency=8, timeout_seconds=0):
+    """
+    Runs all the commands, at most max_concurrency at a time, each one killed
+    after timeout_seconds if that is positive.
+    Returns the list of CommandResult in the same order as commands.
+    """
+    return parallel_map(lambda args: run_command(args, timeout_seconds=timeout_seconds),
+                        list(commands), max_concurrency)